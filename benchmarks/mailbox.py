@@ -0,0 +1,101 @@
+"""Generator for reproducible synthetic mailboxes."""
+
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from typing import NamedTuple, Iterator
+import random
+
+from benchmarks.standin import MailStore
+
+WORDS = (
+    "lorem ipsum dolor sit amet consetetur sadipscing elitr sed diam nonumy eirmod "
+    "tempor invidunt ut labore et dolore magna aliquyam erat voluptua at vero eos "
+    "accusam justo duo dolores ea rebum stet clita kasd gubergren no sea takimata "
+    "sanctus est Grüße Bär Übersicht"
+).split()
+
+
+class MailboxSpec(NamedTuple):
+    messages: int = 1000
+    folders: tuple[str, ...] = ("INBOX", "Archive", "Sent")
+    body_size: int = 2_000
+    """median size of the text bodies in bytes (log-normal distribution)"""
+    attachment_ratio: float = 0.2
+    """share of the messages with attachments"""
+    attachment_size: int = 50_000
+    """median size of the attachments in bytes (log-normal distribution)"""
+    max_attachments: int = 3
+    html_ratio: float = 0.3
+    """share of the messages with an additional HTML part"""
+    size_sigma: float = 1.0
+    """standard deviation of the logarithm of the body and attachment sizes"""
+    seed: int = 0
+
+
+class MailboxGenerator:
+    def __init__(self, spec: MailboxSpec, account: str, contacts: int = 50):
+        self.spec = spec
+        self.account = account
+        self.random = random.Random(spec.seed)
+        self.contacts = [f"contact{number}@example.org" for number in range(contacts)]
+        self.start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def messages(self, count: int = None) -> Iterator[tuple[str, bytes]]:
+        """yields folder and raw message of count (default: spec.messages) new
+        messages"""
+        for _ in range(self.spec.messages if count is None else count):
+            folder = self.random.choice(self.spec.folders)
+            yield folder, self.message(outgoing=folder == "Sent")
+
+    def message(self, outgoing: bool = False) -> bytes:
+        sender = self.account if outgoing else self.random.choice(self.contacts)
+        recipients = (
+            self.random.sample(self.contacts, self.random.randint(1, 3))
+            if outgoing
+            else [self.account]
+        )
+        self.start += timedelta(minutes=self.random.randint(1, 120))
+
+        message = EmailMessage()
+        message["Subject"] = self._text(60)
+        message["From"] = sender
+        message["To"] = ", ".join(recipients)
+        if self.random.random() < 0.2:
+            message["Cc"] = self.random.choice(self.contacts)
+        message["Date"] = format_datetime(self.start)
+        message["Message-ID"] = make_msgid(domain="example.org")
+        body = self._text(self._size(self.spec.body_size))
+        message.set_content(body)
+        if self.random.random() < self.spec.html_ratio:
+            message.add_alternative(f"<html><body><p>{body}</p></body></html>", "html")
+        if self.random.random() < self.spec.attachment_ratio:
+            for number in range(self.random.randint(1, self.spec.max_attachments)):
+                message.add_attachment(
+                    self.random.randbytes(self._size(self.spec.attachment_size)),
+                    maintype="application",
+                    subtype="octet-stream",
+                    filename=f"attachment-{number}.bin",
+                )
+        return message.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+    def fill(self, store: MailStore, count: int = None) -> int:
+        """adds the messages to the account and returns their total size in bytes"""
+        size = 0
+        with store.lock:
+            for folder, raw in self.messages(count):
+                store.folder(self.account, folder).append(raw)
+                size += len(raw)
+        return size
+
+    def _size(self, median: int) -> int:
+        return max(1, int(self.random.lognormvariate(0, self.spec.size_sigma) * median))
+
+    def _text(self, size: int) -> str:
+        words = []
+        length = 0
+        while length < size:
+            word = self.random.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)
@@ -0,0 +1,669 @@
+"""In-process IMAP and SMTP stand-in servers for the benchmarks.
+
+They implement the part of IMAP4rev1 (plus UIDPLUS and MOVE, optionally
+CONDSTORE/QRESYNC) and ESMTP, that remail uses, on plain text sockets. Messages
+are kept in memory.
+"""
+
+from datetime import datetime, timezone
+import email
+import email.policy
+import re
+import socketserver
+import threading
+from email.utils import parsedate_to_datetime
+
+CRLF = b"\r\n"
+
+
+class StoredMessage:
+    def __init__(self, uid: int, raw: bytes, flags: set[bytes], date: datetime):
+        self.uid = uid
+        self.raw = raw
+        self.flags = flags
+        self.date = date
+        self.modseq = 1
+        self._parts = None
+        self._bodystructure = None
+
+    @property
+    def header(self) -> bytes:
+        end = self.raw.find(CRLF + CRLF)
+        return self.raw if end < 0 else self.raw[: end + 4]
+
+    @property
+    def text(self) -> bytes:
+        return self.raw[len(self.header) :]
+
+    def part(self, part_id: str) -> tuple[bytes, bytes]:
+        """returns MIME header and body of the part with the IMAP part id"""
+        if self._parts is None:
+            self._parse()
+        return self._parts.get(part_id, (b"", b""))
+
+    @property
+    def bodystructure(self) -> bytes:
+        if self._bodystructure is None:
+            self._parse()
+        return self._bodystructure
+
+    def _parse(self):
+        message = email.message_from_bytes(self.raw, policy=email.policy.SMTP)
+        self._parts = {}
+        if message.is_multipart():
+            self._bodystructure = self._parse_part(message, "")
+        else:
+            self._parts["1"] = (self.header, self.text)
+            self._bodystructure = self._single_structure(message, self.text)
+
+    def _parse_part(self, part, part_id: str) -> bytes:
+        if not part.is_multipart():
+            raw = part.as_bytes(policy=email.policy.SMTP)
+            end = raw.find(CRLF + CRLF)
+            header, body = raw[: end + 4], raw[end + 4 :]
+            self._parts[part_id] = (header, body)
+            return self._single_structure(part, body)
+        structures = [
+            self._parse_part(
+                sub_part, f"{part_id}.{number}" if part_id else str(number)
+            )
+            for number, sub_part in enumerate(part.get_payload(), start=1)
+        ]
+        return (
+            b"("
+            + b"".join(structures)
+            + b" "
+            + _quote(part.get_content_subtype().upper())
+            + b" "
+            + _params(part.get_params()[1:])
+            + b" NIL NIL NIL)"
+        )
+
+    @staticmethod
+    def _single_structure(part, body: bytes) -> bytes:
+        maintype = part.get_content_maintype().upper()
+        fields = [
+            _quote(maintype),
+            _quote(part.get_content_subtype().upper()),
+            _params(part.get_params()[1:] if part.get_params() else []),
+            b"NIL",
+            b"NIL",
+            _quote(str(part.get("Content-Transfer-Encoding", "7BIT")).upper()),
+            str(len(body)).encode(),
+        ]
+        if maintype == "TEXT":
+            fields.append(str(body.count(b"\n")).encode())
+        # MD5, disposition, language, location
+        fields.append(b"NIL")
+        disposition = part.get_content_disposition()
+        if disposition:
+            filename = part.get_param("filename", header="Content-Disposition")
+            fields.append(
+                b"("
+                + _quote(disposition.upper())
+                + b" "
+                + _params([("FILENAME", filename)] if filename else [])
+                + b")"
+            )
+        else:
+            fields.append(b"NIL")
+        fields += [b"NIL", b"NIL"]
+        return b"(" + b" ".join(fields) + b")"
+
+
+class Folder:
+    def __init__(self, name: str, uidvalidity: int):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages: dict[int, StoredMessage] = {}
+        self.highest_modseq = 1
+        self.vanished: dict[int, int] = {}
+        """UID -> modseq of the expunged messages"""
+
+    def append(self, raw: bytes, flags: set[bytes] = None, date: datetime = None):
+        if date is None:
+            header = email.message_from_bytes(raw.split(CRLF + CRLF, 1)[0])
+            date = (
+                parsedate_to_datetime(header["Date"])
+                if header["Date"]
+                else datetime.now(timezone.utc)
+            )
+        uid = self.uidnext
+        self.uidnext += 1
+        self.messages[uid] = StoredMessage(uid, raw, set(flags or ()), date)
+        self.messages[uid].modseq = self.next_modseq()
+        return uid
+
+    def uids(self) -> list[int]:
+        return sorted(self.messages)
+
+    def next_modseq(self) -> int:
+        self.highest_modseq += 1
+        return self.highest_modseq
+
+
+class MailStore:
+    """messages of all accounts: email -> (password, folder name -> folder)"""
+
+    def __init__(self, qresync: bool = False):
+        """qresync: the IMAP stand-in announces and supports CONDSTORE/QRESYNC"""
+        self.qresync = qresync
+        self.lock = threading.RLock()
+        self.accounts: dict[str, tuple[str, dict[str, Folder]]] = {}
+        self._uidvalidity = 1
+
+    def add_account(self, email_address: str, password: str, folders=("INBOX",)):
+        with self.lock:
+            self.accounts[email_address] = (password, {})
+            for folder in folders:
+                self.folder(email_address, folder)
+
+    def folder(self, email_address: str, name: str) -> Folder:
+        with self.lock:
+            folders = self.accounts[email_address][1]
+            if name not in folders:
+                self._uidvalidity += 1
+                folders[name] = Folder(name, self._uidvalidity)
+            return folders[name]
+
+    def deliver(self, recipients: list[str], raw: bytes):
+        with self.lock:
+            for recipient in recipients:
+                if recipient in self.accounts:
+                    self.folder(recipient, "INBOX").append(raw)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, store: MailStore):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.store = store
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ImapStandIn(_Server):
+    def __init__(self, store: MailStore):
+        super().__init__(_ImapHandler, store)
+
+
+class SmtpStandIn(_Server):
+    def __init__(self, store: MailStore):
+        super().__init__(_SmtpHandler, store)
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    CAPABILITIES = b"IMAP4rev1 UIDPLUS MOVE LITERAL+"
+
+    def setup(self):
+        super().setup()
+        self.account = None
+        self.folder: Folder = None
+        self.readonly = False
+        self.enabled = set()
+        """extensions enabled with ENABLE"""
+
+    @property
+    def store(self) -> MailStore:
+        return self.server.store
+
+    @property
+    def capabilities(self) -> bytes:
+        if self.store.qresync:
+            return self.CAPABILITIES + b" ENABLE CONDSTORE QRESYNC"
+        return self.CAPABILITIES
+
+    def handle(self):
+        self.send(b"* OK [CAPABILITY " + self.capabilities + b"] stand-in ready")
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tag, _, rest = line.partition(b" ")
+            command, _, arguments = rest.partition(b" ")
+            command = command.upper()
+            if command == b"UID":
+                command, _, arguments = arguments.partition(b" ")
+                command = b"UID " + command.upper()
+            handler = getattr(
+                self, "do_" + command.decode().replace(" ", "_").lower(), None
+            )
+            try:
+                if handler is None:
+                    raise ValueError(f"unknown command {command.decode()}")
+                with self.store.lock:
+                    result = handler(_tokenize(arguments))
+                self.send(tag + b" OK " + (result or command + b" completed"))
+            except Exception as e:
+                self.send(tag + b" BAD " + str(e).encode())
+            if command == b"LOGOUT":
+                return
+
+    def read_command(self) -> bytes:
+        """reads a command line, including literals ({n} or {n+})"""
+        line = b""
+        while True:
+            part = self.rfile.readline()
+            if not part:
+                return None
+            part = part.rstrip(CRLF)
+            literal = re.search(rb"\{(\d+)(\+?)\}$", part)
+            if not literal:
+                return line + part
+            if not literal.group(2):
+                self.send(b"+ go ahead")
+            size = int(literal.group(1))
+            data = self.rfile.read(size)
+            line += part[: literal.start()] + _quote(data.decode(errors="replace"))
+
+    def send(self, data: bytes):
+        self.wfile.write(data + CRLF)
+
+    # -- not authenticated --------------------------------------------------
+
+    def do_capability(self, arguments):
+        self.send(b"* CAPABILITY " + self.capabilities)
+
+    def do_noop(self, arguments):
+        if self.folder is not None:
+            self.send(f"* {len(self.folder.messages)} EXISTS".encode())
+
+    def do_login(self, arguments):
+        user, password = (_text(argument) for argument in arguments[:2])
+        if self.store.accounts.get(user, (None,))[0] != password:
+            raise ValueError("invalid credentials")
+        self.account = user
+        return b"[CAPABILITY " + self.capabilities + b"] LOGIN completed"
+
+    def do_logout(self, arguments):
+        self.send(b"* BYE stand-in logging out")
+
+    # -- authenticated ------------------------------------------------------
+
+    def do_enable(self, arguments):
+        enabled = [
+            _text(argument).upper()
+            for argument in arguments
+            if self.store.qresync
+            and _text(argument).upper() in ("CONDSTORE", "QRESYNC")
+        ]
+        self.enabled.update(enabled)
+        self.send(("* ENABLED " + " ".join(enabled)).strip().encode())
+
+    def do_list(self, arguments):
+        for name in self.store.accounts[self.account][1]:
+            flags = b"\\HasNoChildren"
+            if name.lower() == "trash":
+                flags += b" \\Trash"
+            self.send(b"* LIST (" + flags + b') "/" ' + _quote(name))
+
+    def do_select(self, arguments, readonly=False):
+        folder = self.store.folder(self.account, _text(arguments[0]))
+        self.folder = folder
+        self.readonly = readonly
+        self.send(b"* FLAGS (\\Seen \\Deleted)")
+        self.send(f"* {len(folder.messages)} EXISTS".encode())
+        self.send(b"* 0 RECENT")
+        self.send(f"* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid".encode())
+        self.send(f"* OK [UIDNEXT {folder.uidnext}] predicted next UID".encode())
+        if self.store.qresync:
+            self.send(f"* OK [HIGHESTMODSEQ {folder.highest_modseq}]".encode())
+        mode = b"READ-ONLY" if readonly else b"READ-WRITE"
+        return b"[" + mode + b"] SELECT completed"
+
+    def do_status(self, arguments):
+        folder = self.store.folder(self.account, _text(arguments[0]))
+        values = {
+            "MESSAGES": len(folder.messages),
+            "RECENT": 0,
+            "UIDNEXT": folder.uidnext,
+            "UIDVALIDITY": folder.uidvalidity,
+            "UNSEEN": sum(
+                b"\\Seen" not in message.flags for message in folder.messages.values()
+            ),
+        }
+        items = arguments[1] if isinstance(arguments[1], list) else [arguments[1]]
+        status = " ".join(
+            f"{_text(item).upper()} {values[_text(item).upper()]}" for item in items
+        )
+        self.send(b"* STATUS " + _quote(folder.name) + f" ({status})".encode())
+
+    def do_examine(self, arguments):
+        return self.do_select(arguments, readonly=True)
+
+    def do_close(self, arguments):
+        if not self.readonly:
+            self._expunge(None, silent=True)
+        self.folder = None
+
+    def do_unselect(self, arguments):
+        self.folder = None
+
+    # -- selected -----------------------------------------------------------
+
+    def do_uid_search(self, arguments):
+        uids = [
+            uid
+            for uid in self.folder.uids()
+            if _matches(self.folder, self.folder.messages[uid], list(arguments))
+        ]
+        self.send(b"* SEARCH" + b"".join(f" {uid}".encode() for uid in uids))
+
+    def do_uid_fetch(self, arguments):
+        uid_set, items = arguments[0], arguments[1]
+        if not isinstance(items, list):
+            items = [items]
+        # modifiers (QRESYNC), eg: (CHANGEDSINCE 10 VANISHED)
+        modifiers = arguments[2] if len(arguments) > 2 else []
+        modifiers = [_text(modifier).upper() for modifier in modifiers]
+        changed_since = None
+        if "CHANGEDSINCE" in modifiers:
+            changed_since = int(modifiers[modifiers.index("CHANGEDSINCE") + 1])
+        if "VANISHED" in modifiers:
+            # RFC 7162: VANISHED without ENABLE QRESYNC is answered with BAD
+            if "QRESYNC" not in self.enabled:
+                raise ValueError("VANISHED requires ENABLE QRESYNC")
+            vanished = [
+                uid
+                for uid in _uid_set(_text(uid_set), sorted(self.folder.vanished))
+                if self.folder.vanished[uid] > (changed_since or 0)
+            ]
+            if vanished:
+                self.send(
+                    b"* VANISHED (EARLIER) " + ",".join(map(str, vanished)).encode()
+                )
+        sequence = {uid: number for number, uid in enumerate(self.folder.uids(), 1)}
+        for uid in _uid_set(_text(uid_set), self.folder.uids()):
+            message = self.folder.messages[uid]
+            if changed_since is not None and message.modseq <= changed_since:
+                continue
+            response = [f"* {sequence[uid]} FETCH (UID {uid}".encode()]
+            if changed_since is not None:
+                response.append(f" MODSEQ ({message.modseq})".encode())
+            for item in items:
+                response += [b" "] + self._fetch_item(message, _text(item))
+            response.append(b")")
+            self.wfile.write(b"".join(response) + CRLF)
+            # BODY.PEEK[], BODYSTRUCTURE and RFC822.HEADER leave the flags unchanged
+            if not self.readonly and any(
+                _text(item).upper().startswith("BODY[")
+                or _text(item).upper() in ("RFC822", "RFC822.TEXT")
+                for item in items
+            ):
+                message.flags.add(b"\\Seen")
+
+    def _fetch_item(self, message: StoredMessage, item: str) -> list[bytes]:
+        name = item.upper()
+        if name == "UID":
+            return [f"UID {message.uid}".encode()]
+        if name == "FLAGS":
+            return [b"FLAGS (" + b" ".join(sorted(message.flags)) + b")"]
+        if name == "RFC822.SIZE":
+            return [f"RFC822.SIZE {len(message.raw)}".encode()]
+        if name == "BODYSTRUCTURE":
+            return [b"BODYSTRUCTURE " + message.bodystructure]
+        if name in ("RFC822", "RFC822.PEEK"):
+            return [b"RFC822 ", _literal(message.raw)]
+        section = re.fullmatch(
+            r"BODY(?:\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?", item, re.I
+        )
+        if not section:
+            raise ValueError(f"unsupported fetch item {item}")
+        spec, start, length = section.groups()
+        content = self._section(message, spec)
+        response_name = f"BODY[{spec}]"
+        if start is not None:
+            content = content[int(start) : int(start) + int(length)]
+            response_name += f"<{start}>"
+        return [response_name.encode() + b" ", _literal(content)]
+
+    @staticmethod
+    def _section(message: StoredMessage, spec: str) -> bytes:
+        upper = spec.upper()
+        if upper == "":
+            return message.raw
+        if upper == "HEADER":
+            return message.header
+        if upper == "TEXT":
+            return message.text
+        if upper.startswith("HEADER.FIELDS"):
+            fields = {
+                field.lower().encode()
+                for field in re.findall(r"[\w-]+", spec[spec.index("(") :])
+            }
+            lines = [
+                line
+                for line in re.split(rb"\r\n(?![ \t])", message.header)
+                if line.split(b":", 1)[0].strip().lower() in fields
+            ]
+            return b"".join(line + CRLF for line in lines) + CRLF
+        if upper.endswith(".MIME"):
+            return message.part(spec[: -len(".MIME")])[0]
+        return message.part(spec)[1]
+
+    def do_uid_store(self, arguments):
+        uid_set, mode, flags = _text(arguments[0]), _text(arguments[1]), arguments[2]
+        flags = {
+            _text(flag).encode()
+            for flag in (flags if isinstance(flags, list) else [flags])
+        }
+        for uid in _uid_set(uid_set, self.folder.uids()):
+            message = self.folder.messages[uid]
+            if mode.upper().startswith("+"):
+                message.flags |= flags
+            elif mode.upper().startswith("-"):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            message.modseq = self.folder.next_modseq()
+
+    def do_uid_move(self, arguments):
+        uids = _uid_set(_text(arguments[0]), self.folder.uids())
+        target = self.store.folder(self.account, _text(arguments[1]))
+        new_uids = [
+            target.append(
+                self.folder.messages[uid].raw,
+                self.folder.messages[uid].flags,
+                self.folder.messages[uid].date,
+            )
+            for uid in uids
+        ]
+        if uids:
+            self.send(
+                f"* OK [COPYUID {target.uidvalidity} "
+                f"{','.join(map(str, uids))} {','.join(map(str, new_uids))}]".encode()
+            )
+        self._expunge(set(uids))
+
+    def do_uid_expunge(self, arguments):
+        self._expunge(set(_uid_set(_text(arguments[0]), self.folder.uids())))
+
+    def do_expunge(self, arguments):
+        self._expunge(None)
+
+    def _expunge(self, uids: set[int] | None, silent=False):
+        """removes the given messages, or all messages flagged as deleted"""
+        for number, uid in reversed(list(enumerate(self.folder.uids(), 1))):
+            message = self.folder.messages[uid]
+            if uids is None and b"\\Deleted" not in message.flags:
+                continue
+            if uids is not None and uid not in uids:
+                continue
+            del self.folder.messages[uid]
+            self.folder.vanished[uid] = self.folder.next_modseq()
+            if not silent:
+                self.send(f"* {number} EXPUNGE".encode())
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.send(b"220 stand-in ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().decode(errors="replace")
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.send(b"250-stand-in\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME")
+            elif verb == "AUTH":
+                self.send(b"235 authenticated")
+            elif verb == "MAIL":
+                recipients = []
+                self.send(b"250 OK")
+            elif verb == "RCPT":
+                recipients.append(re.search(r"<(.*)>", command).group(1))
+                self.send(b"250 OK")
+            elif verb == "DATA":
+                self.send(b"354 end data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b".\r\n", b".\n", b""):
+                        break
+                    # removes the dot stuffing
+                    lines.append(data[1:] if data.startswith(b"..") else data)
+                self.server.store.deliver(recipients, b"".join(lines))
+                self.send(b"250 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self.send(b"250 OK")
+            elif verb == "QUIT":
+                self.send(b"221 bye")
+                return
+            else:
+                self.send(b"502 not implemented")
+
+    def send(self, data: bytes):
+        self.wfile.write(data + CRLF)
+
+
+# -- helpers ------------------------------------------------------------------
+
+
+def _tokenize(data: bytes) -> list:
+    """splits IMAP arguments into atoms, strings and (nested) lists. Brackets are
+    kept in atoms, eg: BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"""
+    stack = [[]]
+    token = b""
+    brackets = 0
+    index = 0
+    while index < len(data):
+        char = data[index : index + 1]
+        if brackets:
+            token += char
+            brackets += {b"[": 1, b"]": -1}.get(char, 0)
+        elif char == b'"':
+            end = index + 1
+            value = b""
+            while data[end : end + 1] != b'"':
+                if data[end : end + 1] == b"\\":
+                    end += 1
+                value += data[end : end + 1]
+                end += 1
+            stack[-1].append(_String(value))
+            index = end
+        elif char == b"[":
+            token += char
+            brackets = 1
+        elif char in (b" ", b"(", b")"):
+            if token:
+                stack[-1].append(token)
+                token = b""
+            if char == b"(":
+                stack.append([])
+            elif char == b")":
+                closed = stack.pop()
+                stack[-1].append(closed)
+        else:
+            token += char
+        index += 1
+    if token:
+        stack[-1].append(token)
+    return stack[0]
+
+
+class _String(bytes):
+    """quoted string argument"""
+
+
+def _text(token) -> str:
+    return bytes(token).decode(errors="replace")
+
+
+def _quote(value: str | bytes) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    return b'"' + value.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+
+def _literal(data: bytes) -> bytes:
+    return f"{{{len(data)}}}".encode() + CRLF + data
+
+
+def _params(params: list[tuple[str, str]]) -> bytes:
+    if not params:
+        return b"NIL"
+    return (
+        b"("
+        + b" ".join(
+            _quote(key.upper()) + b" " + _quote(str(value)) for key, value in params
+        )
+        + b")"
+    )
+
+
+def _uid_set(uid_set: str, uids: list[int]) -> list[int]:
+    highest = uids[-1] if uids else 0
+    selected = set()
+    for part in uid_set.split(","):
+        start, _, end = part.partition(":")
+        start = highest if start == "*" else int(start)
+        end = start if not end else highest if end == "*" else int(end)
+        low, high = sorted((start, end))
+        selected.update(uid for uid in uids if low <= uid <= high)
+    return sorted(selected)
+
+
+def _matches(folder: Folder, message: StoredMessage, criteria: list) -> bool:
+    while criteria:
+        key = _text(criteria.pop(0)).upper()
+        if key == "ALL":
+            continue
+        if key == "UID":
+            if message.uid not in _uid_set(_text(criteria.pop(0)), folder.uids()):
+                return False
+        elif key in ("SINCE", "BEFORE"):
+            day = datetime.strptime(_text(criteria.pop(0)), "%d-%b-%Y").date()
+            if (key == "SINCE") != (message.date.date() >= day):
+                return False
+        elif key == "HEADER":
+            field, value = _text(criteria.pop(0)), _text(criteria.pop(0))
+            header = email.message_from_bytes(message.header)
+            if value.lower() not in str(header.get(field, "")).lower():
+                return False
+        elif key in ("SEEN", "UNSEEN"):
+            if (key == "SEEN") != (b"\\Seen" in message.flags):
+                return False
+        elif key in ("DELETED", "UNDELETED"):
+            if (key == "DELETED") != (b"\\Deleted" in message.flags):
+                return False
+        elif key == "MODSEQ":
+            if message.modseq < int(_text(criteria.pop(0))):
+                return False
+        else:
+            raise ValueError(f"unsupported search key {key}")
+    return True
@@ -0,0 +1,334 @@
+"""Sync throughput benchmark against the local IMAP/SMTP stand-in.
+
+Measures EmailController.refresh (initial and incremental), deletion detection,
+hard_refresh and send_email on a synthetic mailbox and saves the results as
+JSON, so that runs of different commits can be compared:
+
+    python -m benchmarks.sync_benchmark --messages 2000 --output results.json
+
+The controller works in a temporary directory (database and attachments), the
+account password is kept in an in-memory keyring.
+"""
+
+from datetime import datetime, timezone
+from typing import Callable
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import keyring
+from keyring.backend import KeyringBackend
+
+from benchmarks.mailbox import MailboxGenerator, MailboxSpec
+from benchmarks.standin import ImapStandIn, MailStore, SmtpStandIn
+
+ACCOUNT = "bench@example.org"
+PASSWORD = "secret"
+DEFAULTS = MailboxSpec()
+
+
+class MemoryKeyring(KeyringBackend):
+    priority = 1
+
+    def __init__(self):
+        super().__init__()
+        self.passwords = {}
+
+    def get_password(self, service, username):
+        return self.passwords.get((service, username))
+
+    def set_password(self, service, username, password):
+        self.passwords[(service, username)] = password
+
+    def delete_password(self, service, username):
+        self.passwords.pop((service, username), None)
+
+
+class PeakMemory:
+    """samples the resident set size of this process and its child processes (eg:
+    the parse pool) while the with block runs"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+
+class DatabaseTimer:
+    """sums up the time spent in the database writes of the controller"""
+
+    METHODS = ("safe_email", "delete_emails")
+
+    def __init__(self, controller):
+        self.seconds = 0.0
+        for name in self.METHODS:
+            setattr(controller, name, self._timed(getattr(controller, name)))
+
+    def _timed(self, method: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+
+        return wrapper
+
+
+class Benchmark:
+    def __init__(self, controller, store: MailStore, generator: MailboxGenerator):
+        self.controller = controller
+        self.store = store
+        self.generator = generator
+        self.db_timer = DatabaseTimer(controller)
+        self.results = {}
+
+    def run(self, args: argparse.Namespace):
+        size = self.generator.fill(self.store)
+        self.measure(
+            "initial_refresh",
+            lambda: self.controller.refresh(True),
+            args.messages,
+            size,
+            expected=args.messages,
+        )
+
+        size = self.generator.fill(self.store, args.new_messages)
+        self.measure(
+            "incremental_refresh",
+            lambda: self.controller.refresh(True),
+            args.new_messages,
+            size,
+            expected=args.messages + args.new_messages,
+        )
+
+        total = args.messages + args.new_messages
+        deleted = self.delete_on_server(args.deleted_messages)
+        self.measure(
+            "deletion_detection",
+            lambda: self.controller.refresh(True),
+            total,
+            0,
+            expected=total - deleted,
+        )
+
+        total -= deleted
+        self.measure(
+            "hard_refresh",
+            self.controller.hard_refresh,
+            total,
+            self.mailbox_size(),
+            expected=total,
+        )
+
+        self.controller.get_contact(ACCOUNT)
+        body = self.generator._text(self.generator.spec.body_size)
+
+        def send():
+            for number in range(args.sent_messages):
+                self.controller.send_email(
+                    None, ACCOUNT, [ACCOUNT], [], [], f"Benchmark {number}", body, []
+                )
+
+        self.measure(
+            "send_email",
+            send,
+            args.sent_messages,
+            args.sent_messages * len(body.encode()),
+            expected=total + args.sent_messages,
+        )
+        return self.results
+
+    def measure(
+        self, name: str, action: Callable, messages: int, size: int, expected: int
+    ):
+        db_seconds = self.db_timer.seconds
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            action()
+            seconds = time.perf_counter() - start
+        stored = self.stored_emails()
+        self.results[name] = {
+            "seconds": round(seconds, 4),
+            "messages": messages,
+            "bytes": size,
+            "messages_per_second": round(messages / seconds, 2) if seconds else None,
+            "bytes_per_second": round(size / seconds) if seconds else None,
+            "peak_rss_bytes": memory.peak,
+            "db_write_seconds": round(self.db_timer.seconds - db_seconds, 4),
+            "stored_emails": stored,
+            # the controller logs errors instead of raising them
+            "ok": stored == expected,
+        }
+        print(f"{name}: {json.dumps(self.results[name])}", flush=True)
+
+    def delete_on_server(self, count: int) -> int:
+        """removes count messages from the folders of the account"""
+        with self.store.lock:
+            folders = self.store.accounts[ACCOUNT][1].values()
+            uids = [(folder, uid) for folder in folders for uid in folder.uids()]
+            chosen = self.generator.random.sample(uids, min(count, len(uids)))
+            for folder, uid in chosen:
+                del folder.messages[uid]
+        return len(chosen)
+
+    def mailbox_size(self) -> int:
+        with self.store.lock:
+            return sum(
+                len(message.raw)
+                for folder in self.store.accounts[ACCOUNT][1].values()
+                for message in folder.messages.values()
+            )
+
+    def stored_emails(self) -> int:
+        from sqlmodel import Session, func, select
+        from remail.database.models import Email
+
+        with Session(self.controller.engine) as session:
+            return session.exec(select(func.count()).select_from(Email)).one()
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--new-messages", type=int, default=100)
+    parser.add_argument("--deleted-messages", type=int, default=100)
+    parser.add_argument("--sent-messages", type=int, default=20)
+    parser.add_argument("--folders", default="INBOX,Archive,Sent")
+    parser.add_argument("--body-size", type=int, default=DEFAULTS.body_size)
+    parser.add_argument(
+        "--attachment-ratio", type=float, default=DEFAULTS.attachment_ratio
+    )
+    parser.add_argument("--attachment-size", type=int, default=DEFAULTS.attachment_size)
+    parser.add_argument("--html-ratio", type=float, default=DEFAULTS.html_ratio)
+    parser.add_argument("--seed", type=int, default=DEFAULTS.seed)
+    parser.add_argument(
+        "--eager-attachments",
+        action="store_true",
+        help="download the IMAP attachments during the sync",
+    )
+    parser.add_argument("--max-connections", type=int, default=4)
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    spec = MailboxSpec(
+        messages=args.messages,
+        folders=tuple(args.folders.split(",")),
+        body_size=args.body_size,
+        attachment_ratio=args.attachment_ratio,
+        attachment_size=args.attachment_size,
+        html_ratio=args.html_ratio,
+        seed=args.seed,
+    )
+    store = MailStore()
+    store.add_account(ACCOUNT, PASSWORD, spec.folders)
+    imap_server = ImapStandIn(store).start()
+    smtp_server = SmtpStandIn(store).start()
+
+    keyring.set_keyring(MemoryKeyring())
+    workdir = tempfile.mkdtemp(prefix="remail-benchmark-")
+    os.chdir(workdir)
+    try:
+        # the controller is created on import and uses the working directory
+        from remail.controller import controller
+        from remail.database.models import Protocol
+        from remail.email_api.attachments import AttachmentStore
+        from remail.email_api.pool import ConnectionPool
+
+        controller.refresh_thread.join()
+        # the refreshes are measured without the IDLE listeners
+        controller.stop_push()
+        controller.pool = ConnectionPool(
+            max_connections=args.max_connections,
+            ssl=False,
+            imap_port=imap_server.port,
+            smtp_port=smtp_server.port,
+        )
+        controller.attachment_store = AttachmentStore(
+            os.path.join(workdir, "attachments")
+        )
+        controller.lazy_attachments = not args.eager_attachments
+        controller.create_user(
+            "Benchmark", ACCOUNT, Protocol.IMAP, "127.0.0.1", PASSWORD
+        )
+
+        results = Benchmark(controller, store, MailboxGenerator(spec, ACCOUNT)).run(
+            args
+        )
+        controller.pool.close_all()
+        controller.parse_pool.shutdown()
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+    report = {
+        "commit": _commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": vars(args) | {"workdir": workdir},
+        "results": results,
+    }
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"results saved to {output}")
+    return report
+
+
+def _rss() -> int:
+    """resident set size of this process and its running child processes in bytes"""
+    pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            if pid == os.getpid():
+                # no procfs: peak of this process
+                return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return total
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,36 @@
-from sqlmodel import Session, select, create_engine
+from sqlmodel import Session, select, create_engine, delete, func, update
 from remail.database.models import (
     Email,
+    EmailRecord,
     Contact,
     EmailReception,
     RecipientKind,
     Attachment,
     User,
     Protocol,
+    FolderSyncState,
+    MessageLocation,
 )
+from collections.abc import Callable, Iterator
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import duckdb
+import multiprocessing
 import logging
+import os
+import tempfile
 from sqlmodel import SQLModel
+from sqlalchemy.exc import DBAPIError
+from remail.database.migrations import migrate
 from remail.email_api.service import ImapProtocol, ExchangeProtocol, ProtocolTemplate
+from remail.email_api.push import ExchangeStreamingListener, ImapIdleListener
+from remail.email_api.pool import ConnectionPool
+from remail.email_api.folder_cache import ExchangeFolderCache
+from remail.email_api.throttling import ThrottlingScheduler
+from remail.database.contacts import ContactResolver
+from remail.database.bulk import bulk_insert, id_list
+from remail.email_api.attachments import attachment_store, PackedAttachmentStore
 import remail.email_api.email_errors as errors
 import keyring
 from tzlocal import get_localzone
@@ -31,6 +49,11 @@ def error_handler(func):
             logging.error(
                 "Fehler beim Aktualisieren der E-Mails: Serververbindung fehlgeschlagen"
             )
+        except errors.ServerBusy:
+            logging.error(
+                "Fehler beim Aktualisieren der E-Mails: Server ausgelastet, die "
+                "Synchronisation wird beim nächsten Mal fortgesetzt"
+            )
         except Exception as e:
             logging.error(e, exc_info=True)
             logging.error("Fehler beim Aktualisieren der E-Mails")
@@ -39,18 +62,61 @@ def error_handler(func):
 
 
 class EmailController:
-    def __init__(self):
+    SAVE_BATCH_SIZE = 500
+    """emails that are stored together during a sync"""
+    DELETE_ATTEMPTS = 3
+    """attempts to delete the emails, after their recipients and attachments were
+    deleted (see _delete_email_rows)"""
+
+    def __init__(self, packed_attachments: bool = False):
+        """packed_attachments: stores the attachments in large segment files instead
+        of one file per attachment (see PackedAttachmentStore)"""
         # Connect to the DuckDB database (will create a file-based database if it doesn't exist)
         conn = duckdb.connect("database.db")
         conn.close()
 
         engine = create_engine("duckdb:///database.db")
         SQLModel.metadata.create_all(engine)
+        migrate(engine)
         self.engine = engine
+        # senders and recipients of the synced emails are resolved in memory
+        self.contacts = ContactResolver(engine)
+        # authenticated connections are shared by refresh, send, mark and delete
+        self.pool = ConnectionPool()
+        # Exchange accounts and their folder lists are reused between the logins
+        self.exchange_folders = ExchangeFolderCache()
+        # new Exchange items and their attachments are downloaded with 4 threads
+        self.exchange_fetch_workers = 4
+        # the EWS requests of an account share one throttling state (email -> scheduler)
+        self.exchange_schedulers = {}
+        # IMAP attachments are only downloaded when they are opened
+        self.lazy_attachments = True
+        self.attachment_store = (
+            PackedAttachmentStore(engine) if packed_attachments else attachment_store
+        )
+        # named copies of the attachments (see get_attachment_file)
+        self._attachment_files = None
+        # large syncs without lazy_attachments are parsed on all cores, the
+        # processes are started on first use
+        # (spawn, because forking a process with running threads is unsafe)
+        self.parse_pool = ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("spawn")
+        )
 
-        self.refresh_thread = threading.Thread(target=self.refresh, args=(True,))
+        # refreshes must not run at the same time (eg: initial refresh and IDLE)
+        self._refresh_lock = threading.RLock()
+        self.push_listeners = []
+        self._push_arguments = None
+        """arguments of the running start_push, None if push is stopped"""
+
+        self.refresh_thread = threading.Thread(target=self._refresh_and_listen)
         self.refresh_thread.start()
 
+    def _refresh_and_listen(self):
+        """Refreshes all emails once and then waits for changes on the server"""
+        self.refresh(True)
+        self.start_push()
+
     def has_user(self):
         with Session(self.engine) as session:
             return session.exec(select(User).limit(1)).first() is not None
@@ -58,51 +124,148 @@ class EmailController:
     @error_handler
     def refresh(self, observe_last_refresh: bool):
         """Aktualisiert alle E-Mails in der Datenbank."""
-        with Session(self.engine) as session:
+        with self._refresh_lock, Session(self.engine) as session:
             users = session.exec(select(User)).all()
             accounts = []
             for user in users:
-                password = keyring.get_password("remail/Account", user.email)
-
-                if user.protocol == Protocol.IMAP:
-                    accounts += [
-                        (
-                            ImapProtocol(
-                                email=user.email,
-                                host=user.extra_information,
-                                password=password,
-                                controller=self,
-                            ),
-                            user.last_refresh if observe_last_refresh else None,
-                            user.email,
-                        )
-                    ]
-                elif user.protocol == Protocol.EXCHANGE:
-                    accounts += [
-                        (
-                            ExchangeProtocol(
-                                email=user.email,
-                                username=user.extra_information,
-                                password=password,
-                                controller=self,
-                            ),
-                            user.last_refresh if observe_last_refresh else None,
-                            user.email,
-                        )
-                    ]
+                accounts += [
+                    (
+                        self._create_protocol(user),
+                        user.last_refresh if observe_last_refresh else None,
+                        user.email,
+                    )
+                ]
 
             self._refresh(accounts)
             for user in users:
                 self._update_user_last_refresh(user.email)
 
     @error_handler
-    def hard_refresh(self):
-        emails = []
+    def refresh_folder(self, email: str, folder: str):
+        """Fetches the new emails and removes the deleted emails of one folder of an
+        account"""
+        self.refresh_folders(email, [folder])
+
+    @error_handler
+    def refresh_folders(self, email: str, folders: list[str]):
+        """Fetches the new emails and removes the deleted emails of some folders of
+        an account (folder names for IMAP, folder ids for Exchange)"""
+        with self._refresh_lock:
+            with Session(self.engine) as session:
+                user = session.exec(select(User).where(User.email == email)).first()
+            if not user:
+                return
+            protocol = self._create_protocol(user)
+            protocol.login()
+            try:
+                self._store_emails(
+                    partial(protocol.iter_emails, user.last_refresh, folders=folders)
+                )
+                all_mails_database = self.get_emails(sender_email=email)
+                all_mails_database += self.get_emails(recipient_email=email)
+                deleted_mails = protocol.get_deleted_emails(
+                    [mail.message_id for mail in all_mails_database], folders=folders
+                )
+            finally:
+                protocol.logout()
+            self.delete_emails(self._get_email_ids_of_account(email, deleted_mails))
+
+    def start_push(self, folders: tuple[str, ...] = ("INBOX",), exchange: bool = True):
+        """Starts an IDLE listener per IMAP account, that refreshes the folder as
+        soon as the server reports new or deleted messages, and (if exchange) a
+        streaming listener per Exchange account, that refreshes the changed mail
+        folders"""
+        self.stop_push()
+        self._push_arguments = (folders, exchange)
         with Session(self.engine) as session:
-            emails = session.exec(select(Email)).all()
-        for email in emails:
-            self.delete_email(email.id)
-        self.refresh(False)
+            if exchange:
+                users = session.exec(
+                    select(User).where(User.protocol == Protocol.EXCHANGE)
+                )
+                for user in users.all():
+                    listener = ExchangeStreamingListener(
+                        email=user.email,
+                        create_protocol=partial(self._create_protocol, user),
+                        on_change=self.refresh_folders,
+                    )
+                    listener.start()
+                    self.push_listeners.append(listener)
+            users = session.exec(select(User).where(User.protocol == Protocol.IMAP))
+            for user in users.all():
+                password = keyring.get_password("remail/Account", user.email)
+                for folder in folders:
+                    listener = ImapIdleListener(
+                        email=user.email,
+                        password=password,
+                        host=user.extra_information,
+                        folder=folder,
+                        on_change=self.refresh_folder,
+                        ssl=self.pool.ssl,
+                        port=self.pool.imap_port,
+                    )
+                    listener.start()
+                    self.push_listeners.append(listener)
+
+    def stop_push(self):
+        """Stops all running push listeners"""
+        for listener in self.push_listeners:
+            listener.stop()
+        self.push_listeners = []
+        self._push_arguments = None
+
+    def _restart_push(self):
+        """Starts the push listeners again, if they are running, so they use the
+        current accounts and passwords"""
+        if self._push_arguments is not None:
+            self.start_push(*self._push_arguments)
+
+    def _create_protocol(self, user: User) -> ProtocolTemplate:
+        """Returns the protocol object to connect to the account of the user"""
+        password = keyring.get_password("remail/Account", user.email)
+        if user.protocol == Protocol.IMAP:
+            return ImapProtocol(
+                email=user.email,
+                host=user.extra_information,
+                password=password,
+                controller=self,
+                pool=self.pool,
+                # one connection of the pool is used by the protocol itself
+                folder_workers=self.pool.max_connections - 1,
+                lazy_attachments=self.lazy_attachments,
+                parse_pool=self.parse_pool,
+            )
+        elif user.protocol == Protocol.EXCHANGE:
+            return ExchangeProtocol(
+                email=user.email,
+                username=user.extra_information,
+                password=password,
+                controller=self,
+                folder_cache=self.exchange_folders,
+                fetch_workers=self.exchange_fetch_workers,
+                scheduler=self.exchange_schedulers.setdefault(
+                    user.email, ThrottlingScheduler(self.exchange_fetch_workers)
+                ),
+            )
+
+    @error_handler
+    def hard_refresh(self):
+        with self._refresh_lock:
+            with Session(self.engine) as session:
+                digests = set(
+                    session.exec(
+                        select(Attachment.sha256).where(Attachment.sha256.is_not(None))
+                    ).all()
+                )
+            # the attachment files are kept for the synced emails, so they don't have
+            # to be written again
+            self._delete_email_rows()
+            # the folders are synced from the beginning
+            with Session(self.engine) as session:
+                session.exec(delete(FolderSyncState))
+                session.exec(delete(MessageLocation))
+                session.commit()
+            self.refresh(False)
+            self._remove_unused_attachment_files(digests)
 
     def change_password(self, email: str, password: str):
         """Ändert das Passwort eines Benutzers"""
@@ -111,6 +274,9 @@ class EmailController:
             if not user:
                 raise ValueError(f"Benutzer mit der E-Mail {email} nicht gefunden.")
             keyring.set_password("remail/Account", email, password)
+            self.pool.close_account(email)
+            self.exchange_folders.invalidate(email)
+        self._restart_push()
 
     def create_user(
         self,
@@ -140,6 +306,7 @@ class EmailController:
             session.commit()
             keyring.set_password("remail/Account", email, password)
             # self.logger.info(f"Benutzer erstellt: {name} ({email})")
+        self._restart_push()
 
     def _update_user_last_refresh(self, email: str):
         """updates the date time of the last refresh to the current time"""
@@ -149,6 +316,126 @@ class EmailController:
             session.commit()
             session.refresh(user)
 
+    def get_folder_sync_state(self, account: str, folder: str) -> FolderSyncState:
+        """Returns the stored sync state of a folder or None if it was never synced"""
+        with Session(self.engine) as session:
+            return session.exec(
+                select(FolderSyncState).where(
+                    (FolderSyncState.account == account)
+                    & (FolderSyncState.folder == folder)
+                )
+            ).first()
+
+    def update_folder_sync_state(self, account: str, folder: str, **values):
+        """Creates or updates the sync state of a folder with the given values"""
+        with Session(self.engine) as session:
+            state = session.exec(
+                select(FolderSyncState).where(
+                    (FolderSyncState.account == account)
+                    & (FolderSyncState.folder == folder)
+                )
+            ).first()
+            if not state:
+                state = FolderSyncState(account=account, folder=folder)
+            for key, value in values.items():
+                setattr(state, key, value)
+            session.add(state)
+            session.commit()
+
+    def get_message_locations(self, account: str, folder: str) -> dict[int, str]:
+        """Returns the known UIDs of a folder mapped to their message ids"""
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(MessageLocation.uid, MessageLocation.message_id).where(
+                    (MessageLocation.account == account)
+                    & (MessageLocation.folder == folder)
+                )
+            ).all()
+            return dict(rows)
+
+    def add_message_locations(
+        self, account: str, folder: str, locations: dict[int, str]
+    ):
+        """Stores where (folder and UID) the message ids are located on the server"""
+        with Session(self.engine) as session:
+            session.add_all(
+                MessageLocation(
+                    account=account, folder=folder, uid=uid, message_id=message_id
+                )
+                for uid, message_id in locations.items()
+            )
+            session.commit()
+
+    def get_item_locations(self, account: str, folder: str) -> dict[str, str]:
+        """Returns the known Exchange item ids of a folder mapped to their message ids"""
+        with Session(self.engine) as session:
+            rows = session.exec(
+                select(MessageLocation.item_id, MessageLocation.message_id).where(
+                    (MessageLocation.account == account)
+                    & (MessageLocation.folder == folder)
+                    & MessageLocation.item_id.is_not(None)
+                )
+            ).all()
+            return dict(rows)
+
+    def add_item_locations(self, account: str, folder: str, locations: dict[str, str]):
+        """Stores in which folder the Exchange items with the message ids are"""
+        with Session(self.engine) as session:
+            session.add_all(
+                MessageLocation(
+                    account=account,
+                    folder=folder,
+                    item_id=item_id,
+                    message_id=message_id,
+                )
+                for item_id, message_id in locations.items()
+            )
+            session.commit()
+
+    def remove_item_locations(
+        self, account: str, folder: str, item_ids: list[str] = None
+    ):
+        """Removes the given Exchange items of a folder from the location index.
+        If no item ids are passed, the whole folder is removed"""
+        statement = delete(MessageLocation).where(
+            (MessageLocation.account == account) & (MessageLocation.folder == folder)
+        )
+        if item_ids is not None:
+            statement = statement.where(MessageLocation.item_id.in_(item_ids))
+        with Session(self.engine) as session:
+            session.exec(statement)
+            session.commit()
+
+    def get_locations_of_messages(
+        self, account: str, message_ids: list[str]
+    ) -> list[tuple[str, int, str]]:
+        """Returns folder, UID and message id of the messages of the account"""
+        with Session(self.engine) as session:
+            return session.exec(
+                select(
+                    MessageLocation.folder,
+                    MessageLocation.uid,
+                    MessageLocation.message_id,
+                ).where(
+                    (MessageLocation.account == account)
+                    & (MessageLocation.message_id.in_(message_ids))
+                )
+            ).all()
+
+    def remove_message_locations(
+        self, account: str, folder: str, uids: list[int] = None
+    ):
+        """Removes the given UIDs of a folder from the location index.
+        If no UIDs are passed, the whole folder is removed"""
+        statement = delete(MessageLocation).where(
+            (MessageLocation.account == account) & (MessageLocation.folder == folder)
+        )
+        if uids is not None:
+            statement = statement.where(MessageLocation.uid.in_(uids))
+        with Session(self.engine) as session:
+            session.exec(statement)
+            session.commit()
+
     @error_handler
     def send_email(
         self,
@@ -207,7 +494,10 @@ class EmailController:
                 sender=sender,
                 subject=subject,
                 body=body,
-                attachments=attachments,
+                attachments=[
+                    Attachment(filename=filename, name=os.path.basename(filename))
+                    for filename in attachments or []
+                ],
                 recipients=recipients,
                 date=datetime.now(tz=get_localzone())
                 if date is None
@@ -215,79 +505,163 @@ class EmailController:
                 urgency=urgency,
             )
 
-            with Session(self.engine) as session:
-                user = session.exec(
-                    select(User).where(User.email == sender_email)
-                ).first()
-                password = keyring.get_password("remail/Account", user.email)
-                if user.protocol == Protocol.IMAP:
-                    protocol = ImapProtocol(
-                        email=user.email, host=user.extra_information, password=password
-                    )
-                elif user.protocol == Protocol.EXCHANGE:
-                    protocol = ExchangeProtocol(
-                        email=user.email,
-                        username=user.extra_information,
-                        password=password,
-                        controller=self,
-                    )
+            user = session.exec(select(User).where(User.email == sender_email)).first()
+            protocol = self._create_protocol(user)
 
-                protocol.login()
+            protocol.login()
+            try:
                 protocol.send_email(email)
+            finally:
                 protocol.logout()
 
-            if attachments:
-                email.attachments = [
-                    Attachment(filename=filename) for filename in attachments
-                ]
-
             session.add(email)
             session.commit()
 
     def safe_email(self, list_of_mails: list[Email]):
-        """Speichert die E-Mail Objekte aus dem Email_Api Modul"""
+        """Speichert die E-Mail Objekte aus dem Email_Api Modul. The emails, their
+        recipients and attachments are inserted with one statement per table in one
+        transaction. Emails whose message id is already stored only get their read
+        state updated"""
+        mails = {}
+        for mail in list_of_mails:
+            mails.setdefault(mail.message_id, mail)
+        if not mails:
+            return
         with Session(self.engine) as session:
-            for mail in list_of_mails:
-                session.merge(mail)
-                session.commit()
+            stored = dict(
+                session.exec(
+                    select(Email.message_id, Email.id).where(
+                        Email.message_id.in_(list(mails))
+                    )
+                ).all()
+            )
+            for read in (True, False):
+                ids = [
+                    stored[message_id]
+                    for message_id, mail in mails.items()
+                    if message_id in stored and mail.read is read
+                ]
+                if ids:
+                    session.exec(
+                        update(Email).where(Email.id.in_(ids)).values(read=read)
+                    )
+
+            new_mails = [
+                mail for message_id, mail in mails.items() if message_id not in stored
+            ]
+            if new_mails:
+                self._insert_emails(session, new_mails)
+            session.commit()
+
+    def _insert_emails(self, session: Session, mails: list[Email]):
+        # contacts that were not created by the contact resolver
+        contacts = [
+            contact
+            for mail in mails
+            for contact in [mail.sender] + [rec.contact for rec in mail.recipients]
+            if contact is not None and contact.id is None
+        ]
+        resolved = self.contacts.resolve(
+            (contact.email_address, contact.name) for contact in contacts
+        )
+        for contact in contacts:
+            contact.id = resolved[contact.email_address]
+
+        ids = session.exec(
+            select(func.nextval("email_id_seq")).select_from(func.range(len(mails)))
+        ).all()
+        emails, receptions, attachments = [], [], []
+        for id, mail in zip(ids, mails):
+            emails.append(
+                mail.model_dump()
+                | {"id": id, "sender_id": mail.sender_id or mail.sender.id}
+            )
+            contact_ids = set()
+            for rec in mail.recipients:
+                contact_id = rec.contact_id or rec.contact.id
+                # a contact can only receive an email once (eg: as to and cc)
+                if contact_id not in contact_ids:
+                    contact_ids.add(contact_id)
+                    receptions.append(
+                        {"email_id": id, "contact_id": contact_id, "kind": rec.kind}
+                    )
+            for attachment in mail.attachments or []:
+                attachments.append(
+                    attachment.model_dump(exclude={"id"}) | {"email_id": id}
+                )
+        bulk_insert(session, Email.__table__, emails)
+        bulk_insert(session, EmailReception.__table__, receptions)
+        bulk_insert(session, Attachment.__table__, attachments)
+
+    def _store_emails(self, iter_emails: Callable[..., Iterator[Email]]):
+        """Stores the emails in batches of at most SAVE_BATCH_SIZE, while they are
+        streamed from the server. iter_emails is called with the flush callback of
+        ProtocolTemplate.iter_emails, so the emails are stored before the protocol
+        stores the sync state, that includes them"""
+        batch = []
+
+        def flush():
+            nonlocal batch
+            # a failing batch is not stored again
+            mails, batch = batch, []
+            self.safe_email(mails)
+
+        try:
+            for mail in iter_emails(flush=flush):
+                batch.append(mail)
+                if len(batch) >= self.SAVE_BATCH_SIZE:
+                    flush()
+        finally:
+            # the emails fetched before an error are kept
+            flush()
 
     def _refresh(self, list_of_protocols: list[ProtocolTemplate, datetime, str]):
         all_mails_database = []
         all_message_ids = []
-        all_new_mails = []
         deleted_mails_id = []
 
         for protocol, date, email_address_acc in list_of_protocols:
             protocol.login()
-            with Session(self.engine) as session:
+            try:
                 all_mails_database += self.get_emails(sender_email=email_address_acc)
                 all_mails_database += self.get_emails(recipient_email=email_address_acc)
                 all_message_ids = [mail.message_id for mail in all_mails_database]
 
-            all_new_mails += protocol.get_emails(date)
-            deleted_mails = set(protocol.get_deleted_emails(all_message_ids))
-            with Session(self.engine) as session:
-                statement_1 = select(Email.id).where(
-                    (Email.sender.has(email_address=email_address_acc))
-                    & (Email.message_id.in_(deleted_mails))
-                )
-                statement_2 = (
-                    select(EmailReception.email_id)
-                    .join(Contact, Contact.id == EmailReception.contact_id)
-                    .join(Email, EmailReception.email_id == Email.id)
-                    .where(
-                        (Contact.email_address == email_address_acc)
-                        & (Email.message_id.in_(deleted_mails))
-                    )
+                # emails are stored while they are streamed from the server
+                self._store_emails(partial(protocol.iter_emails, date))
+                deleted_mails = protocol.get_deleted_emails(all_message_ids)
+                deleted_mails_id += self._get_email_ids_of_account(
+                    email_address_acc, deleted_mails
                 )
-                deleted_mails_id += session.exec(statement_1).all()
-                deleted_mails_id += session.exec(statement_2).all()
-            protocol.logout()
-        for id in deleted_mails_id:
-            self.delete_email(id)
+            finally:
+                # gives the connection back to the pool
+                protocol.logout()
+        self.delete_emails(deleted_mails_id)
 
+    def _get_email_ids_of_account(
+        self, email_address_acc: str, message_ids: list[str]
+    ) -> list[int]:
+        """Returns the ids of the emails with the given message ids, that were sent or
+        received by the account"""
+        message_ids = set(message_ids)
         with Session(self.engine) as session:
-            self.safe_email(all_new_mails)
+            statement_1 = select(Email.id).where(
+                (Email.sender.has(email_address=email_address_acc))
+                & (Email.message_id.in_(message_ids))
+            )
+            statement_2 = (
+                select(EmailReception.email_id)
+                .join(Contact, Contact.id == EmailReception.contact_id)
+                .join(Email, EmailReception.email_id == Email.id)
+                .where(
+                    (Contact.email_address == email_address_acc)
+                    & (Email.message_id.in_(message_ids))
+                )
+            )
+            return list(
+                set(session.exec(statement_1).all())
+                | set(session.exec(statement_2).all())
+            )
 
     def get_emails(self, sender_email=None, recipient_email=None):
         """Liest E-Mails basierend auf Absender oder Empfänger aus."""
@@ -304,6 +678,44 @@ class EmailController:
             emails = session.exec(query).all()
             return emails
 
+    def update_read_state(self, message_ids: list[str], read: bool):
+        """Marks the emails with the given message ids as read(True)/unread(False)"""
+        if not message_ids:
+            return
+        with Session(self.engine) as session:
+            session.exec(
+                update(Email).where(Email.message_id.in_(message_ids)).values(read=read)
+            )
+            session.commit()
+
+    @error_handler
+    def mark_emails(self, email: str, message_ids: list[str], read: bool):
+        """Marks the emails of the account as read(True)/unread(False) on the server
+        and in the database"""
+        with Session(self.engine) as session:
+            user = session.exec(select(User).where(User.email == email)).first()
+        protocol = self._create_protocol(user)
+        protocol.login()
+        try:
+            protocol.mark_emails(message_ids, read)
+        finally:
+            protocol.logout()
+        self.update_read_state(message_ids, read)
+
+    @error_handler
+    def remove_emails(self, email: str, message_ids: list[str], hard_delete=False):
+        """Deletes the emails of the account on the server (hard_delete = False ->
+        moves them to the trash folder) and in the database"""
+        with Session(self.engine) as session:
+            user = session.exec(select(User).where(User.email == email)).first()
+        protocol = self._create_protocol(user)
+        protocol.login()
+        try:
+            protocol.delete_emails(message_ids, hard_delete)
+        finally:
+            protocol.logout()
+        self.delete_emails(self._get_email_ids_of_account(email, message_ids))
+
     def update_email_subject(self, email_id: int, new_subject: str):
         """Aktualisiert den Betreff einer E-Mail."""
         with Session(self.engine) as session:
@@ -317,27 +729,78 @@ class EmailController:
     def delete_email(self, email_id: int):
         """Löscht eine E-Mail basierend auf ihrer ID."""
         with Session(self.engine) as session:
-            email = session.get(Email, email_id)
-            if not email:
+            if not session.get(Email, email_id):
                 raise ValueError("E-Mail nicht gefunden")
+        self.delete_emails([email_id])
 
-            recs = email.recipients
-            for rec in recs:
-                session.delete(rec)
+    def delete_emails(self, email_ids: list[int]):
+        """Deletes the emails with the ids together with their recipients and
+        attachments with one DELETE statement per table"""
+        if not email_ids:
+            return
+        ids = id_list(email_ids)
+        with Session(self.engine) as session:
+            digests = set(
+                session.exec(
+                    select(Attachment.sha256).where(
+                        Attachment.email_id.in_(ids), Attachment.sha256.is_not(None)
+                    )
+                ).all()
+            )
+        self._delete_email_rows(ids)
+        self._remove_unused_attachment_files(digests)
 
-            atts = email.attachments
-            for att in atts:
-                session.delete(att)
-            session.commit()
+    def _delete_email_rows(self, ids: list[int] = None):
+        """Deletes the emails with the ids (all emails without ids) together with
+        their recipients and attachments.
 
+        DuckDB rejects deleting the emails in the transaction, that deletes their
+        references (foreign key limitation). So the emails are deleted in a second
+        transaction, that is tried DELETE_ATTEMPTS times. If it still fails, the
+        emails are left without recipients and attachments and the error is raised.
+        Deleting them again completes the deletion (the sync reports them as deleted
+        again)"""
+        # synchronize_session: the deleted rows are not loaded into the session
+        options = {"synchronize_session": False}
+        statements = [delete(EmailReception), delete(Attachment), delete(Email)]
+        if ids is not None:
+            statements = [
+                statement.where(column.in_(ids))
+                for statement, column in zip(
+                    statements, (EmailReception.email_id, Attachment.email_id, Email.id)
+                )
+            ]
         with Session(self.engine) as session:
-            email = session.get(Email, email_id)
-            if not email:
-                raise ValueError("E-Mail nicht gefunden")
-
-            session.delete(email)
+            for statement in statements[:2]:
+                session.exec(statement, execution_options=options)
             session.commit()
 
+        for attempt in range(1, self.DELETE_ATTEMPTS + 1):
+            try:
+                with Session(self.engine) as session:
+                    session.exec(statements[2], execution_options=options)
+                    session.commit()
+                return
+            except DBAPIError:
+                # eg: a conflict with a concurrent update of the emails
+                if attempt == self.DELETE_ATTEMPTS:
+                    raise
+
+    def _remove_unused_attachment_files(self, digests: set[str]):
+        """Removes the stored attachment files, that are not referenced by any
+        attachment anymore. A running sync may have stored a file for emails, that
+        are not in the database yet, so this waits for the sync to finish"""
+        if not digests:
+            return
+        with self._refresh_lock, Session(self.engine) as session:
+            used = set(
+                session.exec(
+                    select(Attachment.sha256).where(Attachment.sha256.in_(digests))
+                ).all()
+            )
+            for digest in digests - used:
+                self.attachment_store.remove(digest)
+
     def create_contact(self, email_address: str, name: str = None):
         """Erstellt einen neuen Kontakt."""
         try:
@@ -367,7 +830,6 @@ class EmailController:
                 raise ValueError(f"Kontakt mit E-Mail {email_address} existiert nicht.")
             contact.name = name
             session.commit()
-            session.refresh(contact)
 
     def get_contacts(self):
         """Gibt alle Kontakte aus."""
@@ -378,22 +840,12 @@ class EmailController:
 
     def get_contact(self, email: str, name: str = None) -> Contact:
         """Gibt den Kontakt mit der Emailadresse zurück oder erstellt einen neuen"""
-        contacts = self.get_contacts()
-        contact = [con for con in contacts if con.email_address == email]
-        if len(contact) > 0:
-            return contact[0]
-        else:
-            return self.create_contact(email, name)
-        
+        return self.contacts.get(email, name)
 
     def get_contact_by_id(self, id: int) -> Contact:
         """Returns contact by ID"""
-        contacts=self.get_contacts()
-        contact = [con for con in contacts if con.id == id]
-        if len(contact) > 0:
-            return contact[0]
-        else:
-            return None
+        with Session(self.engine) as session:
+            return session.get(Contact, id)
     
     def get_recipients(self, mail_id: int):
         """Returns a list of all recipients of an email"""
@@ -421,26 +873,99 @@ class EmailController:
 
     def get_full_email_data(self, mail: Email):
         """Returns all metadata about an email"""
-        id = mail.id
-        message_id = mail.message_id
-        subject = mail.subject
-        body = mail.body
-        date = mail.date.strftime("%Y-%m-%d %H:%M:%S")
-        urgency = mail.urgency
-
-        sender = self.get_contact_by_id(mail.sender_id).email_address
-        recipients = [contact.email_address for contact in self.get_recipients(id)]
-        recipients_str = ", ".join(recipients)
-        # Attachments are to be handled separately
-
-        return {"id":id,
-                "message_id":message_id,
-                "subject":subject,
-                "body":body,
-                "date":date,
-                "urgency":urgency,
-                "sender":sender,
-                "recipients":recipients_str}
+        return next(self.iter_full_email_data(email_ids=[mail.id]))
+
+    def iter_full_email_data(self, **filters) -> Iterator[dict]:
+        """Yields the metadata of the emails like get_full_email_data, the emails are
+        selected like in iter_email_records"""
+        for record in self.iter_email_records(**filters):
+            # Attachments are to be handled separately
+            yield {
+                "id": record.id,
+                "message_id": record.message_id,
+                "subject": record.subject,
+                "body": record.body,
+                "date": record.date.strftime("%Y-%m-%d %H:%M:%S"),
+                "urgency": record.urgency,
+                "sender": record.sender,
+                "recipients": ", ".join(record.to + record.cc + record.bcc),
+            }
+
+    def iter_email_records(
+        self,
+        email_ids: list[int] = None,
+        sender_email: str = None,
+        recipient_email: str = None,
+        batch_size: int = 1000,
+    ) -> Iterator[EmailRecord]:
+        """Yields the emails (all or only the ones with the ids, the sender or the
+        recipient) ordered by id together with the addresses of their contacts and
+        the names of their attachments. The records are read with one query and
+        fetched in batches of batch_size rows"""
+        # recipients and attachments are aggregated per email before the join, so
+        # the rows of both don't multiply
+        recipients = (
+            select(
+                EmailReception.email_id,
+                *[
+                    func.list(Contact.email_address)
+                    .filter(EmailReception.kind == kind)
+                    .label(kind.value)
+                    for kind in RecipientKind
+                ],
+            )
+            .join(Contact, Contact.id == EmailReception.contact_id)
+            .group_by(EmailReception.email_id)
+            .subquery()
+        )
+        attachments = (
+            select(
+                Attachment.email_id,
+                func.list(Attachment.name)
+                .filter(Attachment.name.is_not(None))
+                .label("names"),
+            )
+            .group_by(Attachment.email_id)
+            .subquery()
+        )
+        sender = Contact.__table__.alias("sender")
+        query = (
+            select(
+                Email.id,
+                Email.message_id,
+                Email.subject,
+                Email.body,
+                Email.date,
+                Email.urgency,
+                Email.read,
+                sender.c.email_address,
+                recipients.c.to,
+                recipients.c.cc,
+                recipients.c.bcc,
+                attachments.c.names,
+            )
+            .join(sender, sender.c.id == Email.sender_id)
+            .outerjoin(recipients, recipients.c.email_id == Email.id)
+            .outerjoin(attachments, attachments.c.email_id == Email.id)
+            .order_by(Email.id)
+        )
+        if email_ids is not None:
+            query = query.where(Email.id.in_(email_ids))
+        if sender_email:
+            query = query.where(sender.c.email_address == sender_email)
+        if recipient_email:
+            query = query.where(
+                Email.id.in_(
+                    select(EmailReception.email_id)
+                    .join(Contact, Contact.id == EmailReception.contact_id)
+                    .where(Contact.email_address == recipient_email)
+                )
+            )
+        with Session(self.engine) as session:
+            rows = session.execute(query.execution_options(yield_per=batch_size))
+            for row in rows:
+                # the lists are NULL without matching recipients or attachments
+                yield EmailRecord(*row[:8], *(names or [] for names in row[8:]))
 
     def get_attachments(self, mail:Email):
         """Returns Attachments for an Email"""
@@ -451,5 +976,82 @@ class EmailController:
             attachments= session.exec(query).all()
         return attachments
 
+    def get_attachment_file(self, attachment_id: int) -> str:
+        """Returns the path of a file named like the attachment. Attachments that
+        were left out during the sync are downloaded from the server first. The
+        stored files are named after their content digest (or packed into segment
+        files), so their content is copied into the temporary folder of the
+        controller, which is removed when the controller is. Raises the error if the
+        download fails"""
+        attachment = self._get_stored_attachment(attachment_id)
+        if not (
+            attachment.sha256 and self.attachment_store.contains(attachment.sha256)
+        ):
+            # older attachments and sent files are stored under their own name
+            return attachment.filename
+        if self._attachment_files is None:
+            self._attachment_files = tempfile.TemporaryDirectory(prefix="remail-")
+        # one folder per attachment, attachments of several emails share names
+        path = os.path.join(
+            self._attachment_files.name,
+            str(attachment.id),
+            _safe_file_name(attachment.name),
+        )
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(self.attachment_store.read(attachment.sha256))
+        return path
+
+    def get_attachment_content(self, attachment_id: int) -> memoryview:
+        """Returns the content of the attachment (memory mapped). Attachments that
+        were left out during the sync are downloaded from the server first. Raises
+        the error if the download fails"""
+        attachment = self._get_stored_attachment(attachment_id)
+        if attachment.sha256 and self.attachment_store.contains(attachment.sha256):
+            return self.attachment_store.read(attachment.sha256)
+        with open(attachment.filename, "rb") as file:
+            return memoryview(file.read())
+
+    def _get_stored_attachment(self, attachment_id: int) -> Attachment:
+        """Returns the attachment, it is downloaded first if it is not stored yet"""
+        with Session(self.engine) as session:
+            attachment = session.get(Attachment, attachment_id)
+            if not attachment:
+                raise ValueError("Anhang nicht gefunden")
+            if attachment.filename and os.path.exists(attachment.filename):
+                return attachment
+            if attachment.sha256 and self.attachment_store.contains(attachment.sha256):
+                return attachment
+            message_id = attachment.email.message_id
+            account = session.exec(
+                select(MessageLocation.account).where(
+                    MessageLocation.message_id == message_id
+                )
+            ).first()
+            user = session.exec(select(User).where(User.email == account)).first()
+            if not user:
+                raise ValueError("Konto der E-Mail nicht gefunden")
+
+        protocol = self._create_protocol(user)
+        protocol.login()
+        try:
+            attachment.filename = protocol.download_attachment(message_id, attachment)
+        finally:
+            protocol.logout()
+
+        with Session(self.engine) as session:
+            session.add(attachment)
+            session.commit()
+            session.refresh(attachment)
+        return attachment
+
+
+def _safe_file_name(name: str) -> str:
+    """returns the file name of the attachment without folders, names like ".."
+    sent by the server could otherwise leave the folder"""
+    name = os.path.basename((name or "").replace("\\", "/"))
+    return name if name not in ("", ".", "..") else "attachment"
+
 
 controller = EmailController()
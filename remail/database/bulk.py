@@ -0,0 +1,63 @@
+from collections.abc import Iterable
+from datetime import datetime
+from enum import Enum
+import json
+from sqlalchemy import Boolean, Column, DateTime, Integer, Select, Table, func, text
+from sqlmodel import Session, select
+
+
+def bulk_insert(session: Session, table: Table, rows: list[dict]):
+    """inserts the rows into the table with one INSERT ... SELECT statement.
+
+    Binding the parameters of a multi-row insert costs about a millisecond per row
+    in DuckDB, so the rows are passed as one JSON document instead and unpacked by
+    DuckDB (from_json). Every row needs the same keys, they are the inserted
+    columns"""
+    if not rows:
+        return
+    columns = [table.c[name] for name in rows[0]]
+    structure = json.dumps([{column.name: _json_type(column) for column in columns}])
+    names = ", ".join(f'"{column.name}"' for column in columns)
+    values = ", ".join(_select_value(column) for column in columns)
+    session.execute(
+        text(
+            f'INSERT INTO "{table.name}" ({names}) SELECT {values} FROM '
+            f"(SELECT unnest(from_json(:rows, '{structure}'), recursive := true))"
+        ),
+        {"rows": json.dumps(rows, default=_json_value)},
+    )
+
+
+def id_list(ids: Iterable[int]) -> Select:
+    """returns a subquery of the ids for IN conditions. Like the rows in
+    bulk_insert, the ids are passed as one JSON parameter instead of binding every
+    id of a large IN list"""
+    return select(func.unnest(func.from_json(json.dumps(list(ids)), '["BIGINT"]')))
+
+
+def _json_type(column: Column) -> str:
+    if isinstance(column.type, DateTime):
+        # cast in the SELECT (see _select_value), from_json reads naive ones as UTC
+        return "VARCHAR"
+    if isinstance(column.type, Boolean):
+        return "BOOLEAN"
+    if isinstance(column.type, Integer):
+        return "BIGINT"
+    # strings and enums (stored by name)
+    return "VARCHAR"
+
+
+def _select_value(column: Column) -> str:
+    if isinstance(column.type, DateTime):
+        # converted like a bound datetime: naive ones keep their time, aware ones are
+        # converted to the time zone of the connection
+        return f'CAST("{column.name}" AS TIMESTAMPTZ)'
+    return f'"{column.name}"'
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.name
+    raise TypeError(f"{type(value).__name__} can't be stored with bulk_insert")
@@ -0,0 +1,79 @@
+from collections.abc import Iterable
+from typing import Optional
+import threading
+from sqlalchemy import Engine, insert
+from sqlmodel import Session, select
+from remail.database.models import Contact
+
+
+class ContactResolver:
+    """Maps email addresses to their contacts, so the sender and the recipients of
+    the synced emails don't have to be looked up one by one.
+
+    The ids of the contacts are kept in memory once they were loaded. Addresses that
+    are not known yet are looked up with one query per batch and the missing contacts
+    are created with one insert. Only ids are cached, no Contact objects: the emails
+    linked to a cached object through its relationships would never be freed."""
+
+    QUERY_SIZE = 1000
+    """addresses per IN query"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._contacts = {}
+        """email address -> contact id"""
+
+    def resolve(self, addresses: Iterable[tuple[str, Optional[str]]]) -> dict[str, int]:
+        """returns the contact ids of the (email address, name) pairs by their
+        address. Missing contacts are created with the first name given for their
+        address"""
+        names = {}
+        for address, name in addresses:
+            if names.get(address) is None:
+                names[address] = name
+        # creating the missing contacts must not run twice for the same address
+        with self._lock:
+            missing = [address for address in names if address not in self._contacts]
+            if missing:
+                self._load(missing)
+                new = [address for address in missing if address not in self._contacts]
+                if new:
+                    with Session(self.engine) as session:
+                        session.execute(
+                            insert(Contact),
+                            [
+                                {"email_address": address, "name": names[address]}
+                                for address in new
+                            ],
+                        )
+                        session.commit()
+                    self._load(new)
+            return {address: self._contacts[address] for address in names}
+
+    def get(self, address: str, name: str = None) -> Contact:
+        """returns the contact of the address, it is created if it doesn't exist"""
+        contact_id = self.resolve([(address, name)])[address]
+        with Session(self.engine) as session:
+            return session.get(Contact, contact_id)
+
+    def clear(self):
+        with self._lock:
+            self._contacts = {}
+
+    def _load(self, addresses: list[str]):
+        with Session(self.engine) as session:
+            for start in range(0, len(addresses), self.QUERY_SIZE):
+                contacts = session.exec(
+                    select(Contact.email_address, Contact.id)
+                    .where(
+                        Contact.email_address.in_(
+                            addresses[start : start + self.QUERY_SIZE]
+                        )
+                    )
+                    .order_by(Contact.id)
+                )
+                # older databases can contain an address more than once, the first
+                # contact is used
+                for address, contact_id in contacts:
+                    self._contacts.setdefault(address, contact_id)
@@ -0,0 +1,122 @@
+import logging
+from sqlalchemy import Connection, Engine
+
+MIGRATIONS = [
+    # read state of the emails and CONDSTORE state of the folders
+    "ALTER TABLE email ADD COLUMN IF NOT EXISTS read BOOLEAN",
+    "ALTER TABLE foldersyncstate ADD COLUMN IF NOT EXISTS highest_modseq BIGINT",
+    # attachments that are downloaded on demand
+    "ALTER TABLE attachment ADD COLUMN IF NOT EXISTS name VARCHAR",
+    "ALTER TABLE attachment ADD COLUMN IF NOT EXISTS size INTEGER",
+    "ALTER TABLE attachment ADD COLUMN IF NOT EXISTS part_id VARCHAR",
+    # attachments stored by their content digest
+    "ALTER TABLE attachment ADD COLUMN IF NOT EXISTS sha256 VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_attachment_sha256 ON attachment (sha256)",
+    # Exchange folders synced with SyncFolderItems
+    "ALTER TABLE foldersyncstate ADD COLUMN IF NOT EXISTS sync_state VARCHAR",
+    "ALTER TABLE messagelocation ADD COLUMN IF NOT EXISTS item_id VARCHAR",
+]
+"""schema changes of the tables of older databases, every statement runs on each
+start and has to be idempotent"""
+
+DATA_MIGRATIONS = [
+    # the stored files of older attachments are named like the attachment
+    "UPDATE attachment SET name = regexp_extract(filename, '[^/\\\\]+$')"
+    " WHERE name IS NULL AND filename IS NOT NULL",
+]
+"""updates of the rows of older databases, they run after the schema changes in a
+separate transaction, because DuckDB doesn't commit changes to rows of a table that
+was altered in the same transaction"""
+
+NULLABLE_COLUMNS = [
+    # attachments that are downloaded on demand have no file yet
+    ("attachment", "filename"),
+    # Exchange items are located by their item id instead of a UID
+    ("messagelocation", "uid"),
+]
+"""(table, column) of the columns that were NOT NULL in older databases"""
+
+BIGINT_COLUMNS = [
+    # MODSEQ is 63 bit (RFC 7162), UIDs and UIDVALIDITY are unsigned 32 bit
+    ("foldersyncstate", "uidvalidity"),
+    ("foldersyncstate", "last_uid"),
+    ("foldersyncstate", "highest_modseq"),
+    ("messagelocation", "uid"),
+]
+"""(table, column) of the columns that were INTEGER (32 bit) in older databases"""
+
+UNIQUE_INDEXES = [
+    # one contact per email address
+    ("ix_contact_email_address", "contact", "email_address"),
+]
+"""(index, table, column) of the unique indexes of older databases"""
+
+
+def migrate(engine: Engine):
+    """adds the columns and indexes, that were added to existing tables, to an
+    older database. SQLModel.metadata.create_all only creates missing tables"""
+    with engine.begin() as connection:
+        for table, column in NULLABLE_COLUMNS:
+            _drop_not_null(connection, table, column)
+        for statement in MIGRATIONS:
+            connection.exec_driver_sql(statement)
+        for table, column in BIGINT_COLUMNS:
+            _widen_to_bigint(connection, table, column)
+        for name, table, column in UNIQUE_INDEXES:
+            _create_unique_index(connection, name, table, column)
+    with engine.begin() as connection:
+        for statement in DATA_MIGRATIONS:
+            connection.exec_driver_sql(statement)
+
+
+def _drop_not_null(connection: Connection, table: str, column: str):
+    """removes the NOT NULL constraint of the column, if it still has one"""
+    if _column_info(connection, table, column, "is_nullable") == "NO":
+        _alter_column(connection, table, f'ALTER COLUMN "{column}" DROP NOT NULL')
+
+
+def _widen_to_bigint(connection: Connection, table: str, column: str):
+    """changes the type of the column to BIGINT, if it is still an INTEGER"""
+    if _column_info(connection, table, column, "data_type") == "INTEGER":
+        _alter_column(connection, table, f'ALTER COLUMN "{column}" TYPE BIGINT')
+
+
+def _column_info(connection: Connection, table: str, column: str, field: str):
+    return connection.exec_driver_sql(
+        f"SELECT {field} FROM information_schema.columns"
+        " WHERE table_name = $1 AND column_name = $2",
+        (table, column),
+    ).scalar()
+
+
+def _alter_column(connection: Connection, table: str, alteration: str):
+    """runs the ALTER TABLE statement. DuckDB can't alter a column of a table with
+    indexes, so they are dropped and created again"""
+    indexes = connection.exec_driver_sql(
+        "SELECT index_name, sql FROM duckdb_indexes() WHERE table_name = $1",
+        (table,),
+    ).all()
+    for name, _ in indexes:
+        connection.exec_driver_sql(f'DROP INDEX "{name}"')
+    connection.exec_driver_sql(f'ALTER TABLE "{table}" {alteration}')
+    for _, sql in indexes:
+        connection.exec_driver_sql(sql)
+
+
+def _create_unique_index(connection: Connection, name: str, table: str, column: str):
+    """creates the unique index, unless the table already contains duplicates. They
+    can't be merged here, because DuckDB doesn't update rows that are referenced by
+    foreign keys"""
+    duplicates = connection.exec_driver_sql(
+        f'SELECT count(*) FROM (SELECT "{column}" FROM "{table}"'
+        f' GROUP BY "{column}" HAVING count(*) > 1)'
+    ).scalar()
+    if duplicates:
+        logging.warning(
+            f"Index {name} nicht erstellt, {duplicates} Werte von {table}.{column}"
+            " sind mehrfach vorhanden"
+        )
+        return
+    connection.exec_driver_sql(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS "{name}" ON "{table}" ("{column}")'
+    )
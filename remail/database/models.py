@@ -1,9 +1,9 @@
 from enum import Enum, auto
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 import sqlalchemy
 from sqlmodel import Field, SQLModel, Relationship
 from datetime import datetime
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import BigInteger, Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -19,7 +19,7 @@ def id_field(table_name: str):
 
 class Contact(SQLModel, table=True):
     id: Optional[int] = id_field("contact")
-    email_address: str
+    email_address: str = Field(index=True, unique=True)
     name: Optional[str] = None
     receptions: List["EmailReception"] = Relationship(back_populates="contact")
     sent_emails: List["Email"] = Relationship(back_populates="sender")
@@ -41,7 +41,19 @@ class EmailReception(SQLModel, table=True):
 
 class Attachment(SQLModel, table=True):
     id: Optional[int] = id_field("attachment")
-    filename: str
+    filename: Optional[str] = None
+    """path of the stored file, None if the attachment is downloaded on demand or
+    packed into a segment file (see PackedAttachmentStore)"""
+    name: Optional[str] = None
+    """file name of the attachment in the email"""
+    size: Optional[int] = None
+    """size in bytes, as reported by the server (still transfer encoded) until the
+    attachment is downloaded"""
+    part_id: Optional[str] = None
+    """MIME part id of the attachment in the IMAP message (eg: "2" or "1.2")"""
+    sha256: Optional[str] = Field(default=None, index=True)
+    """digest of the content, the file is shared by all attachments with the same
+    content (see AttachmentStore)"""
     email_id: int = Field(default=None, foreign_key="email.id")
     email: "Email" = Relationship(back_populates="attachments")
 
@@ -57,6 +69,25 @@ class Email(SQLModel, table=True):
     recipients: List[EmailReception] = Relationship(back_populates="email")
     date: datetime
     urgency: Optional[int]
+    read: Optional[bool] = None
+
+
+class EmailRecord(NamedTuple):
+    """an email with the addresses of its sender and recipients and the names of
+    its attachments (see EmailController.iter_email_records)"""
+
+    id: int
+    message_id: str
+    subject: str
+    body: str
+    date: datetime
+    urgency: Optional[int]
+    read: Optional[bool]
+    sender: str
+    to: list[str]
+    cc: list[str]
+    bcc: list[str]
+    attachments: list[str]
 
 
 class Protocol(Enum):
@@ -72,3 +103,39 @@ class User(SQLModel, table=True):
     extra_information: str
     """if Exchange: extra_information = username else: extra_information = host"""
     last_refresh: Optional[datetime] = None
+
+
+class FolderSyncState(SQLModel, table=True):
+    id: Optional[int] = id_field("foldersyncstate")
+    account: str
+    """email address of the account the folder belongs to"""
+    folder: str
+    """folder name (IMAP) or folder id (Exchange)"""
+    # UIDs are unsigned 32 bit and MODSEQ 63 bit, too large for INTEGER
+    uidvalidity: Optional[int] = Field(default=None, sa_type=BigInteger)
+    last_uid: Optional[int] = Field(default=None, sa_type=BigInteger)
+    """highest UID that has already been synced into the database"""
+    highest_modseq: Optional[int] = Field(default=None, sa_type=BigInteger)
+    """HIGHESTMODSEQ (CONDSTORE) up to which flag changes and deletions are known"""
+    sync_state: Optional[str] = None
+    """SyncState of SyncFolderItems (Exchange), the changes since then are synced next"""
+
+
+class MessageLocation(SQLModel, table=True):
+    id: Optional[int] = id_field("messagelocation")
+    account: str = Field(index=True)
+    folder: str
+    uid: Optional[int] = Field(default=None, sa_type=BigInteger)
+    item_id: Optional[str] = None
+    """id of the item on the Exchange server, instead of the UID"""
+    message_id: str
+
+
+class PackedBlob(SQLModel, table=True):
+    id: Optional[int] = id_field("packedblob")
+    sha256: str = Field(index=True)
+    """digest of the attachment content"""
+    segment: int
+    """number of the segment file, the content is stored in"""
+    offset: int
+    size: int
@@ -0,0 +1,405 @@
+from collections.abc import Iterator
+import binascii
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Optional
+from sqlalchemy import func
+from sqlmodel import Session, select
+from remail.database.models import PackedBlob
+
+ATTACHMENT_FOLDER = os.path.join("remail", "database", "attachments")
+MAX_ATTACHMENT_SIZE = 200 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SEGMENT_SIZE = 256 * 1024 * 1024
+STREAMED_ENCODINGS = ("base64", "quoted-printable", "7bit", "8bit", "binary", "")
+"""transfer encodings, that AttachmentWriter decodes itself"""
+
+
+class AttachmentStore:
+    """Content addressed store for the attachment files. Every distinct content is
+    stored only once, in a file named after its SHA-256 digest
+    (<folder>/<first 2 characters>/<digest>). The Attachment rows with the digest
+    are the references to the file, it is removed when the last one is deleted"""
+
+    def __init__(self, folder: str = ATTACHMENT_FOLDER):
+        self.folder = folder
+
+    def path(self, sha256: str) -> Optional[str]:
+        """returns the path of the file with the given content digest"""
+        return os.path.join(os.path.abspath(self.folder), sha256[:2], sha256)
+
+    def contains(self, sha256: str) -> bool:
+        """checks if the content with the given digest is stored"""
+        return os.path.exists(self.path(sha256))
+
+    def put(
+        self, content: bytes | str | Iterator[bytes], encoding: str = None
+    ) -> tuple[Optional[str], str, int]:
+        """stores the content (see AttachmentWriter for encoding) if it is not stored
+        yet and returns path, SHA-256 digest and size of the decoded content"""
+        if isinstance(content, (bytes, str)):
+            check_encoded_size(len(content), encoding)
+            # content in memory is hashed first, so existing files are not written
+            # again (eg: the same attachment in several emails or a hard refresh)
+            with AttachmentWriter(None, encoding) as writer:
+                for chunk in iter_chunks(content):
+                    writer.write(chunk)
+            if self.contains(writer.sha256):
+                return self.path(writer.sha256), writer.sha256, writer.size
+            content = iter_chunks(content)
+        return self._write(content, encoding)
+
+    def read(self, sha256: str) -> memoryview:
+        """returns the content with the given digest, the file is memory mapped"""
+        return _map_file(self.path(sha256))
+
+    def _write(
+        self, content: Iterator[bytes], encoding: str = None
+    ) -> tuple[Optional[str], str, int]:
+        os.makedirs(os.path.abspath(self.folder), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.abspath(self.folder))
+        os.close(handle)
+        try:
+            with AttachmentWriter(temp_path, encoding) as writer:
+                for chunk in content:
+                    writer.write(chunk)
+            path = self.path(writer.sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # atomic, a file with the same content is simply replaced
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return path, writer.sha256, writer.size
+
+    def remove(self, sha256: str):
+        """removes the file with the given content digest"""
+        try:
+            os.remove(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+
+class PackedAttachmentStore(AttachmentStore):
+    """Content addressed store, that appends the attachments to segment files of
+    about SEGMENT_SIZE bytes (<folder>/segments/<number>.pack) instead of writing
+    one file per attachment. The offsets are stored in the PackedBlob table, reads
+    are zero copy slices of the memory mapped segment. Segments, that are less than
+    half used after deletions, are compacted into the current segment"""
+
+    def __init__(
+        self,
+        engine,
+        folder: str = ATTACHMENT_FOLDER,
+        segment_size: int = SEGMENT_SIZE,
+    ):
+        super().__init__(folder)
+        self.engine = engine
+        self.segment_size = segment_size
+        self._segment = None
+        """number of the segment, new attachments are appended to"""
+        self._maps = {}
+        """segment -> memory maps of the segment, the last one is the current"""
+        self._removed = set()
+        """compacted segments, whose files are removed once their maps are closed"""
+        self._lock = threading.RLock()
+
+    def path(self, sha256: str) -> Optional[str]:
+        # the attachments have no own files
+        return None
+
+    def contains(self, sha256: str) -> bool:
+        with Session(self.engine) as session:
+            return self._get_blob(session, sha256) is not None
+
+    def read(self, sha256: str) -> memoryview:
+        with Session(self.engine) as session:
+            blob = self._get_blob(session, sha256)
+        if blob is None:
+            raise FileNotFoundError(f"Attachment {sha256} not found")
+        if blob.size == 0:
+            return memoryview(b"")
+        with self._lock:
+            maps = self._maps.get(blob.segment)
+            if not maps or len(maps[-1]) < blob.offset + blob.size:
+                # the segment has grown since it was mapped
+                self._close_maps(blob.segment)
+                maps = self._maps.setdefault(blob.segment, [])
+                maps.append(_map_file(self._segment_path(blob.segment)).obj)
+            return memoryview(maps[-1])[blob.offset : blob.offset + blob.size]
+
+    def remove(self, sha256: str):
+        with self._lock:
+            self._remove_segments()
+            with Session(self.engine) as session:
+                blob = self._get_blob(session, sha256)
+                if blob is None:
+                    return
+                segment = blob.segment
+                session.delete(blob)
+                session.commit()
+                used = session.exec(
+                    select(func.sum(PackedBlob.size)).where(
+                        PackedBlob.segment == segment
+                    )
+                ).one()
+            if (
+                segment != self._current_segment()
+                and (used or 0) < os.path.getsize(self._segment_path(segment)) / 2
+            ):
+                self._compact(segment)
+
+    def _write(
+        self, content: Iterator[bytes], encoding: str = None
+    ) -> tuple[Optional[str], str, int]:
+        with self._lock:
+            segment, offset, writer = self._append(content, encoding)
+            with Session(self.engine) as session:
+                if self._get_blob(session, writer.sha256) is not None:
+                    # streamed content, that was already stored
+                    os.truncate(self._segment_path(segment), offset)
+                else:
+                    session.add(
+                        PackedBlob(
+                            sha256=writer.sha256,
+                            segment=segment,
+                            offset=offset,
+                            size=writer.size,
+                        )
+                    )
+                    session.commit()
+        return None, writer.sha256, writer.size
+
+    def _append(
+        self, content: Iterator[bytes], encoding: str = None
+    ) -> tuple[int, int, "AttachmentWriter"]:
+        """appends the decoded content to the current segment and returns segment,
+        offset and the writer. Must be called with the lock held"""
+        segment = self._current_segment()
+        with open(self._segment_path(segment), "ab") as file:
+            offset = file.tell()
+            try:
+                with AttachmentWriter(None, encoding, file=file) as writer:
+                    for chunk in content:
+                        writer.write(chunk)
+            except BaseException:
+                # removes the partly written attachment
+                file.truncate(offset)
+                raise
+        return segment, offset, writer
+
+    def _compact(self, segment: int):
+        """moves the remaining attachments of the segment to the current segment and
+        removes the segment file. Must be called with the lock held"""
+        with Session(self.engine) as session:
+            blobs = session.exec(
+                select(PackedBlob).where(PackedBlob.segment == segment)
+            ).all()
+            with open(self._segment_path(segment), "rb") as file:
+                for blob in blobs:
+                    blob.segment, blob.offset, _ = self._append(
+                        _read_range(file, blob.offset, blob.size)
+                    )
+                    session.add(blob)
+            session.commit()
+        self._removed.add(segment)
+        self._remove_segments()
+
+    def _remove_segments(self):
+        """removes the files of the compacted segments. Mapped files can't be removed
+        on Windows, so segments with slices still in use are removed by a later call.
+        Must be called with the lock held"""
+        for segment in list(self._removed):
+            if self._close_maps(segment):
+                os.remove(self._segment_path(segment))
+                self._removed.discard(segment)
+
+    def _close_maps(self, segment: int) -> bool:
+        """closes the memory maps of the segment, that no slice uses anymore, and
+        returns whether all are closed. Must be called with the lock held"""
+        maps = [
+            mapped for mapped in self._maps.pop(segment, []) if not _close_map(mapped)
+        ]
+        if maps:
+            self._maps[segment] = maps
+        return not maps
+
+    def _current_segment(self) -> int:
+        """returns the segment new attachments are appended to, a new one is started
+        if it is full"""
+        with self._lock:
+            if self._segment is None:
+                os.makedirs(os.path.dirname(self._segment_path(0)), exist_ok=True)
+                with Session(self.engine) as session:
+                    self._segment = (
+                        session.exec(select(func.max(PackedBlob.segment))).one() or 1
+                    )
+            path = self._segment_path(self._segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+                self._segment += 1
+            return self._segment
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(
+            os.path.abspath(self.folder), "segments", f"{segment:06d}.pack"
+        )
+
+    @staticmethod
+    def _get_blob(session: Session, sha256: str) -> Optional[PackedBlob]:
+        return session.exec(
+            select(PackedBlob).where(PackedBlob.sha256 == sha256)
+        ).first()
+
+
+class AttachmentWriter:
+    """Writes an attachment to a file while decoding its transfer encoding
+    (base64/quoted-printable) chunk by chunk, so the attachment is never kept in
+    memory as a whole. The SHA-256 digest is calculated while writing. If the
+    attachment exceeds max_size or writing fails, the file is removed again.
+    Without path the content is only hashed, or written into the given file
+    (eg: a segment file), which is not closed or cleaned up by the writer.
+
+    with AttachmentWriter(path, "base64") as writer:
+        for chunk in chunks:
+            writer.write(chunk)"""
+
+    def __init__(
+        self,
+        path: Optional[str],
+        encoding: str = None,
+        max_size: int = MAX_ATTACHMENT_SIZE,
+        file: BinaryIO = None,
+    ):
+        self.path = path
+        self.encoding = (encoding or "").strip().lower()
+        self.max_size = max_size
+        self.size = 0
+        """number of decoded bytes written so far"""
+        self._hash = hashlib.sha256()
+        self._rest = b""
+        """encoded bytes, that can only be decoded together with the next chunk"""
+        self._file = None
+        self._target = file
+
+    def __enter__(self) -> "AttachmentWriter":
+        if self.path is not None:
+            self._file = open(self.path, "wb")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        completed = False
+        try:
+            if exc_type is None:
+                self._write_decoded(self._flush())
+                completed = True
+        finally:
+            if self._file is not None:
+                self._file.close()
+                if not completed:
+                    os.remove(self.path)
+
+    @property
+    def sha256(self) -> str:
+        """hex digest of the decoded content written so far"""
+        return self._hash.hexdigest()
+
+    def write(self, data: bytes):
+        """decodes and writes the next chunk of the (still encoded) attachment"""
+        self._write_decoded(self._decode(data))
+
+    def _decode(self, data: bytes) -> bytes:
+        if self.encoding == "base64":
+            # line breaks are removed, only complete 4 character groups are decoded
+            data = self._rest + b"".join(data.split())
+            complete = len(data) - len(data) % 4
+            self._rest = data[complete:]
+            return binascii.a2b_base64(data[:complete])
+        if self.encoding == "quoted-printable":
+            # escapes and soft line breaks never span a line end
+            data = self._rest + data
+            complete = data.rfind(b"\n") + 1
+            self._rest = data[complete:]
+            return binascii.a2b_qp(data[:complete])
+        return data
+
+    def _flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        if self.encoding == "base64" and rest:
+            # tolerates missing padding at the end
+            return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4))
+        if self.encoding == "quoted-printable":
+            return binascii.a2b_qp(rest)
+        return rest
+
+    def _write_decoded(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise BufferError(f"File size exceeds limit of {self.max_size} bytes")
+        self._hash.update(data)
+        if self._file is not None:
+            self._file.write(data)
+        elif self._target is not None:
+            self._target.write(data)
+
+
+def check_encoded_size(
+    encoded_size: int, encoding: str = None, max_size: int = MAX_ATTACHMENT_SIZE
+):
+    """rejects an attachment before it is downloaded or decoded, if already its
+    encoded size shows that it exceeds max_size"""
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        # at least 57 bytes per line of 76 characters and CRLF
+        min_size = encoded_size * 57 // 78
+    elif encoding == "quoted-printable":
+        # escapes need 3 characters per byte, plus the soft line breaks
+        min_size = encoded_size // 4
+    else:
+        min_size = encoded_size
+    if min_size > max_size:
+        raise BufferError(f"File size exceeds limit of {max_size} bytes")
+
+
+def _read_range(file: BinaryIO, offset: int, size: int) -> Iterator[bytes]:
+    """reads size bytes from the offset of the file in chunks"""
+    file.seek(offset)
+    while size > 0:
+        chunk = file.read(min(CHUNK_SIZE, size))
+        if not chunk:
+            return
+        size -= len(chunk)
+        yield chunk
+
+
+def _map_file(path: str) -> memoryview:
+    """maps the file read only into memory"""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return memoryview(b"")
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _close_map(mapped: mmap.mmap) -> bool:
+    """closes the memory map, unless slices of it are still in use"""
+    try:
+        mapped.close()
+    except BufferError:
+        return False
+    return True
+
+
+def iter_chunks(content: bytes | str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """splits the content into chunks for AttachmentWriter. Payloads of parsed
+    messages are str, they are converted back to the original bytes chunk by chunk"""
+    for start in range(0, len(content), chunk_size):
+        chunk = content[start : start + chunk_size]
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8", errors="surrogateescape")
+        yield chunk
+
+
+attachment_store = AttachmentStore()
@@ -38,3 +38,23 @@ class SMTPDataFalse(EmailError):
     """Server replied with an unexpected error code (other than a refusal of a recipient)"""
 
     pass
+
+
+class MessageNotFound(EmailError):
+    """The email doesn't exist on the server (anymore)"""
+
+    pass
+
+
+class ServerBusy(EmailError):
+    """The server throttles the requests and asks to try again later"""
+
+    def __init__(self, back_off: float = None):
+        super().__init__(f"server busy, back off for {back_off} seconds")
+        self.back_off = back_off
+
+
+class ConnectionPoolTimeout(EmailError):
+    """No pooled connection of the account became free in time"""
+
+    pass
@@ -0,0 +1,64 @@
+from collections.abc import Callable
+import threading
+import time
+from exchangelib import Account
+
+
+class ExchangeFolderCache:
+    """Keeps the Account objects and the mail folders of the Exchange accounts, so
+    refresh, mark and delete don't have to run autodiscover and walk the folder tree
+    (several EWS requests) every time.
+
+    The folders are bound to the Account they were loaded with, so both are cached
+    together. The folder list is loaded again after TTL seconds, a new password
+    creates a new Account."""
+
+    TTL = 10 * 60
+
+    def __init__(self, ttl: float = TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._accounts = {}
+        """email -> (account, username, password)"""
+        self._folders = {}
+        """email -> (folders, time of loading)"""
+
+    def get_account(
+        self, email: str, username: str, password: str, connect: Callable[[], Account]
+    ) -> Account:
+        """returns the cached account or the one created by connect, if the account
+        was not used before or the credentials changed"""
+        with self._lock:
+            cached = self._accounts.get(email)
+        if cached and cached[1:] == (username, password):
+            return cached[0]
+        account = connect()
+        with self._lock:
+            self._accounts[email] = (account, username, password)
+            self._folders.pop(email, None)
+        return account
+
+    def get_folders(
+        self, email: str, account: Account, load: Callable[[Account], list]
+    ) -> list:
+        """returns the cached folders of the account. They are loaded with load, if
+        they are older than ttl seconds or belong to another account object"""
+        with self._lock:
+            cached = self._folders.get(email)
+            fresh = cached and time.monotonic() - cached[1] < self.ttl
+        if fresh and all(folder.account is account for folder in cached[0]):
+            return cached[0]
+        if cached:
+            # walk() uses the folder tree, that the account root has cached
+            account.root.clear_cache()
+        folders = load(account)
+        with self._lock:
+            self._folders[email] = (folders, time.monotonic())
+        return folders
+
+    def invalidate(self, email: str):
+        """removes the account and its folders from the cache (eg: after a password
+        change)"""
+        with self._lock:
+            self._accounts.pop(email, None)
+            self._folders.pop(email, None)
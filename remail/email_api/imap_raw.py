@@ -0,0 +1,58 @@
+import imapclient
+from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientError
+from imapclient.response_parser import parse_fetch_response
+
+SUPPORTED_VERSIONS = (3,)
+"""major versions of IMAPClient whose imaplib connection is used (see
+pyproject.toml)"""
+
+
+def is_supported(client: IMAPClient) -> bool:
+    """IMAPClient has no API for VANISHED responses and the connection state, so they
+    are read from its imaplib connection (IMAPClient._imap). This is only done with
+    the IMAPClient versions it was tested with"""
+    return imapclient.version_info[0] in SUPPORTED_VERSIONS and hasattr(
+        getattr(client, "_imap", None), "untagged_responses"
+    )
+
+
+def has_selected_folder(client: IMAPClient) -> bool:
+    """whether a folder is still selected (eg: the connection was left in the middle
+    of a command). Always True if the state is unknown"""
+    if not is_supported(client):
+        return True
+    return client._imap.state != "AUTH"
+
+
+def fetch_changes(client: IMAPClient, modseq: int) -> tuple[dict, list[int]]:
+    """returns the FLAGS of the messages changed since the modseq and the UIDs of the
+    deleted messages (QRESYNC). IMAPClient.fetch can't request "1:*" and drops the
+    VANISHED responses"""
+    if not is_supported(client):
+        raise IMAPClientError(
+            f"FETCH VANISHED is not supported with IMAPClient {imapclient.__version__}"
+        )
+    typ, data = client._imap.uid(
+        "FETCH", "1:*", "(FLAGS)", f"(CHANGEDSINCE {modseq} VANISHED)"
+    )
+    if typ != "OK":
+        raise IMAPClientError(f"FETCH CHANGEDSINCE failed: {data}")
+    changed = parse_fetch_response(data, client.normalise_times, True)
+    vanished = []
+    for line in client._imap.untagged_responses.pop("VANISHED", []):
+        # eg: b"(EARLIER) 41,43:116"
+        vanished += parse_uid_set(line.split()[-1])
+    return changed, vanished
+
+
+def parse_uid_set(uid_set: bytes) -> list[int]:
+    """converts an IMAP sequence set like b"41,43:116" into a list of UIDs"""
+    uids = []
+    for part in uid_set.decode().split(","):
+        if ":" in part:
+            start, end = sorted(int(uid) for uid in part.split(":"))
+            uids += range(start, end + 1)
+        else:
+            uids.append(int(part))
+    return uids
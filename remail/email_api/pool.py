@@ -0,0 +1,240 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+import threading
+import time
+from imapclient import IMAPClient
+from smtplib import SMTP, SMTP_PORT, SMTP_SSL, SMTP_SSL_PORT
+import remail.email_api.email_errors as ee
+
+
+class ConnectionPool:
+    """Keeps authenticated IMAP and SMTP connections per account open, so refresh,
+    send, mark and delete don't have to connect and log in every time.
+
+    Connections are checked with NOOP before they are handed out again, if they
+    were not used for HEALTH_CHECK_AFTER seconds, and closed after IDLE_TIMEOUT
+    seconds without use. Broken connections are replaced by new ones."""
+
+    IDLE_TIMEOUT = 5 * 60
+    HEALTH_CHECK_AFTER = 30
+    ACQUIRE_TIMEOUT = 2 * 60
+
+    def __init__(
+        self,
+        max_connections: int = 4,
+        ssl: bool = True,
+        imap_port: int = None,
+        smtp_port: int = None,
+        acquire_timeout: float = ACQUIRE_TIMEOUT,
+    ):
+        """max_connections: maximum number of connections per account and connection
+        type, that are in use at the same time. Further requests wait until a
+        connection is released, at most acquire_timeout seconds
+        ssl, imap_port, smtp_port: connection settings of the servers, by default
+        IMAP and SMTP over TLS on the standard ports (eg: plain text for a local test
+        server)"""
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.ssl = ssl
+        self.imap_port = imap_port
+        self.smtp_port = smtp_port
+        self._lock = threading.Condition()
+        self._idle = {}
+        """(kind, host, email) -> list of (connection, last use)"""
+        self._in_use = {}
+        """(kind, host, email) -> number of connections that are handed out"""
+
+    def acquire_imap(
+        self,
+        email: str,
+        password: str,
+        host: str,
+        setup: Callable[[IMAPClient], None] = None,
+    ) -> IMAPClient:
+        """returns a logged in IMAP connection of the account. setup is called once
+        for every new connection (eg: to enable extensions). All connections of an
+        account share one pool, so every caller has to pass the same setup"""
+
+        def connect():
+            client = IMAPClient(host, port=self.imap_port, use_uid=True, ssl=self.ssl)
+            try:
+                client.login(email, password)
+                if setup:
+                    setup(client)
+            except Exception:
+                _close_imap(client)
+                raise
+            return client
+
+        return self._acquire(("imap", host, email), connect, _check_imap)
+
+    def release_imap(self, email: str, host: str, client: IMAPClient, broken=False):
+        """gives the connection back to the pool. Broken connections (eg: after an
+        error in the middle of a command) are closed"""
+        self._release(("imap", host, email), client, broken, _close_imap)
+
+    def acquire_smtp(self, email: str, password: str, host: str) -> SMTP:
+        """returns a logged in SMTP connection of the account"""
+
+        def connect():
+            if self.ssl:
+                smtp_server = SMTP_SSL(host, port=self.smtp_port or SMTP_SSL_PORT)
+            else:
+                smtp_server = SMTP(host, port=self.smtp_port or SMTP_PORT)
+            try:
+                smtp_server.login(email, password)
+            except Exception:
+                _close_smtp(smtp_server)
+                raise
+            return smtp_server
+
+        return self._acquire(("smtp", host, email), connect, _check_smtp)
+
+    def release_smtp(self, email: str, host: str, smtp_server: SMTP_SSL, broken=False):
+        """gives the connection back to the pool"""
+        self._release(("smtp", host, email), smtp_server, broken, _close_smtp)
+
+    @contextmanager
+    def imap(
+        self,
+        email: str,
+        password: str,
+        host: str,
+        setup: Callable[[IMAPClient], None] = None,
+    ) -> Iterator[IMAPClient]:
+        """acquires an IMAP connection for the duration of the with block (setup:
+        see acquire_imap)"""
+        client = self.acquire_imap(email, password, host, setup)
+        broken = True
+        try:
+            yield client
+            broken = False
+        finally:
+            self.release_imap(email, host, client, broken)
+
+    @contextmanager
+    def smtp(self, email: str, password: str, host: str) -> Iterator[SMTP_SSL]:
+        """acquires an SMTP connection for the duration of the with block"""
+        smtp_server = self.acquire_smtp(email, password, host)
+        broken = True
+        try:
+            yield smtp_server
+            broken = False
+        finally:
+            self.release_smtp(email, host, smtp_server, broken)
+
+    def close_account(self, email: str):
+        """closes the unused connections of the account (eg: after a password change)"""
+        with self._lock:
+            keys = [key for key in self._idle if key[2] == email]
+            closing = [(key, self._idle.pop(key)) for key in keys]
+        for key, connections in closing:
+            for connection, _ in connections:
+                _close(key, connection)
+
+    def close_all(self):
+        """closes all unused connections"""
+        with self._lock:
+            closing = list(self._idle.items())
+            self._idle = {}
+        for key, connections in closing:
+            for connection, _ in connections:
+                _close(key, connection)
+
+    def _acquire(self, key, connect, check):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._lock:
+                expired = self._pop_expired()
+                while (
+                    not self._idle.get(key)
+                    and self._in_use.get(key, 0) >= self.max_connections
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ee.ConnectionPoolTimeout(
+                            f"no free connection after {self.acquire_timeout} s"
+                        )
+                    self._lock.wait(remaining)
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+                idle = self._idle.get(key)
+                connection, last_use = idle.pop() if idle else (None, None)
+            for expired_key, expired_connection in expired:
+                _close(expired_key, expired_connection)
+
+            if connection is None:
+                try:
+                    return connect()
+                except Exception:
+                    self._give_back(key)
+                    raise
+            if time.monotonic() - last_use < self.HEALTH_CHECK_AFTER or check(
+                connection
+            ):
+                return connection
+            # the connection was closed by the server in the meantime
+            _close(key, connection)
+            self._give_back(key)
+
+    def _release(self, key, connection, broken, close):
+        if broken:
+            close(connection)
+        else:
+            with self._lock:
+                self._idle.setdefault(key, []).append((connection, time.monotonic()))
+        self._give_back(key)
+
+    def _give_back(self, key):
+        with self._lock:
+            self._in_use[key] -= 1
+            self._lock.notify_all()
+
+    def _pop_expired(self) -> list:
+        """removes the connections, that were not used for IDLE_TIMEOUT seconds,
+        from the pool and returns them to be closed. Must be called with the lock
+        held"""
+        now = time.monotonic()
+        expired = []
+        for key, connections in self._idle.items():
+            for connection, last_use in list(connections):
+                if now - last_use > self.IDLE_TIMEOUT:
+                    connections.remove((connection, last_use))
+                    expired.append((key, connection))
+        return expired
+
+
+def _check_imap(client: IMAPClient) -> bool:
+    try:
+        client.noop()
+        return True
+    except Exception:
+        return False
+
+
+def _check_smtp(smtp_server: SMTP_SSL) -> bool:
+    try:
+        return smtp_server.noop()[0] == 250
+    except Exception:
+        return False
+
+
+def _close_imap(client: IMAPClient):
+    try:
+        client.logout()
+    except Exception:
+        # the connection is already closed
+        pass
+
+
+def _close_smtp(smtp_server: SMTP_SSL):
+    try:
+        smtp_server.quit()
+    except Exception:
+        smtp_server.close()
+
+
+def _close(key, connection):
+    if key[0] == "imap":
+        _close_imap(connection)
+    else:
+        _close_smtp(connection)
@@ -0,0 +1,169 @@
+from collections.abc import Callable
+import logging
+import threading
+import time
+from imapclient import IMAPClient
+from remail.email_api.service import ExchangeProtocol
+
+
+class ImapIdleListener(threading.Thread):
+    """Keeps an own connection to the IMAP server open and calls
+    on_change(account, folder) as soon as the server reports new (EXISTS) or
+    deleted (EXPUNGE) messages in the folder. Uses IDLE if the server supports it,
+    otherwise the folder is polled with NOOP."""
+
+    IDLE_TIMEOUT = 29 * 60
+    """IDLE has to be renewed before the server drops the connection (RFC 2177)"""
+    CHECK_INTERVAL = 30
+    """seconds after which a stop request is noticed while idling"""
+    NOOP_INTERVAL = 60
+    RECONNECT_DELAY = 30
+
+    def __init__(
+        self,
+        email: str,
+        password: str,
+        host: str,
+        folder: str,
+        on_change: Callable[[str, str], None],
+        ssl: bool = True,
+        port: int = None,
+    ):
+        """ssl, port: connection settings of the server, like the ones of the
+        ConnectionPool"""
+        super().__init__(name=f"idle-{email}-{folder}", daemon=True)
+        self.email = email
+        self.password = password
+        self.host = host
+        self.folder = folder
+        self.on_change = on_change
+        self.ssl = ssl
+        self.port = port
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """stops listening, the connection is closed within CHECK_INTERVAL seconds"""
+        self._stop_event.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self._listen()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                logging.error(f"IDLE-Verbindung für {self.email} unterbrochen")
+                # reconnects after a short break
+                self._stop_event.wait(self.RECONNECT_DELAY)
+
+    def _listen(self):
+        client = IMAPClient(self.host, port=self.port, use_uid=True, ssl=self.ssl)
+        try:
+            client.login(self.email, self.password)
+            client.select_folder(self.folder, readonly=True)
+            if client.has_capability("IDLE"):
+                self._idle(client)
+            else:
+                self._poll(client)
+        finally:
+            try:
+                client.logout()
+            except Exception:
+                pass
+
+    def _idle(self, client: IMAPClient):
+        while not self.stopped:
+            client.idle()
+            started = time.monotonic()
+            responses = []
+            try:
+                while (
+                    not self.stopped
+                    and not self._has_changes(responses)
+                    and time.monotonic() - started < self.IDLE_TIMEOUT
+                ):
+                    responses += client.idle_check(timeout=self.CHECK_INTERVAL)
+            finally:
+                responses += client.idle_done()[1]
+            if self._has_changes(responses):
+                self.on_change(self.email, self.folder)
+
+    def _poll(self, client: IMAPClient):
+        while not self._stop_event.wait(self.NOOP_INTERVAL):
+            if self._has_changes(client.noop()[1]):
+                self.on_change(self.email, self.folder)
+
+    @staticmethod
+    def _has_changes(responses: list) -> bool:
+        """checks the untagged responses for new or deleted messages,
+        eg: [(b'OK', b'Still here'), (1, b'EXISTS')]"""
+        return any(
+            len(response) > 1 and response[1] in (b"EXISTS", b"EXPUNGE")
+            for response in responses
+        )
+
+
+class ExchangeStreamingListener(threading.Thread):
+    """Keeps a streaming subscription (EWS notifications) for the mail folders of an
+    Exchange account and calls on_change(account, folder_ids) as soon as the server
+    reports new, deleted, moved or changed items. create_protocol returns a new
+    ExchangeProtocol for the account, that is logged in by the listener."""
+
+    CONNECTION_TIMEOUT = 1
+    """minutes a streaming connection stays open, a stop request is noticed after
+    that at the latest. The subscription is kept for the next connection"""
+    RECONNECT_DELAY = 30
+
+    def __init__(
+        self,
+        email: str,
+        create_protocol: Callable[[], ExchangeProtocol],
+        on_change: Callable[[str, list[str]], None],
+    ):
+        super().__init__(name=f"streaming-{email}", daemon=True)
+        self.email = email
+        self.create_protocol = create_protocol
+        self.on_change = on_change
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """stops listening within CONNECTION_TIMEOUT minutes"""
+        self._stop_event.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self._listen()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                logging.error(f"Streaming-Verbindung für {self.email} unterbrochen")
+                # subscribes again after a short break (eg: expired subscription)
+                self._stop_event.wait(self.RECONNECT_DELAY)
+
+    def _listen(self):
+        protocol = self.create_protocol()
+        protocol.login()
+        subscription_id = None
+        try:
+            subscription_id = protocol.subscribe()
+            while not self.stopped:
+                for folder_ids in protocol.iter_changed_folders(
+                    subscription_id, self.CONNECTION_TIMEOUT
+                ):
+                    self.on_change(self.email, sorted(folder_ids))
+                    if self.stopped:
+                        break
+        finally:
+            try:
+                if subscription_id is not None:
+                    protocol.unsubscribe(subscription_id)
+                protocol.logout()
+            except Exception:
+                pass
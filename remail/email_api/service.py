@@ -1,4 +1,12 @@
 from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
+import inspect
+import queue
+import threading
+from typing import NamedTuple, Optional
 from remail.database.models import (
     Email,
     EmailReception,
@@ -24,6 +32,7 @@ from imapclient.exceptions import (
     CapabilityError,
 )
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from datetime import datetime
 from exchangelib import (
     Credentials,
@@ -34,56 +43,185 @@ from exchangelib import (
     FolderCollection,
     UTC,
 )
+from exchangelib.items import HARD_DELETE, ID_ONLY, MOVE_TO_DELETED_ITEMS
+from exchangelib.services import SyncFolderItems
 import os
 import mimetypes
-from werkzeug.utils import secure_filename
 import tempfile
 from email.header import decode_header
-from email.utils import parsedate_to_datetime, getaddresses
+from email.utils import (
+    parsedate_to_datetime,
+    getaddresses,
+    decode_rfc2231,
+    collapse_rfc2231_value,
+    make_msgid,
+)
 import remail.email_api.email_errors as ee
+from remail.email_api.pool import ConnectionPool
+import remail.email_api.imap_raw as imap_raw
+from remail.email_api.folder_cache import ExchangeFolderCache
+from remail.email_api.throttling import ThrottlingScheduler
+from remail.email_api.attachments import (
+    CHUNK_SIZE,
+    STREAMED_ENCODINGS,
+    AttachmentStore,
+    attachment_store,
+    check_encoded_size,
+)
 from pytz import timezone
 
 
 def error_handler(func):
-    def wrapper(self, *args, **kwargs):
-        RECIPIENTSFAIL = (SMTPRecipientsRefused, exch_errors.ErrorInvalidRecipients)
-        CONNECTIONFAIL = (
-            SMTPConnectError,
-            exch_errors.ErrorConnectionFailed,
-            exch_errors.TransportError,
-            SMTPServerDisconnected,
-            SMTPHeloError,
-            IMAPClientError,
-            IMAPClientAbortError,
-            CapabilityError,
-        )
-        INVALIDLOGINDATA = (
-            exch_errors.UnauthorizedError,
-            LoginError,
-            SMTPAuthenticationError,
-        )
+    if inspect.isgeneratorfunction(func):
 
-        try:
+        def generator_wrapper(self, *args, **kwargs):
+            with _translate_errors():
+                yield from func(self, *args, **kwargs)
+
+        return generator_wrapper
+
+    def wrapper(self, *args, **kwargs):
+        with _translate_errors():
             return func(self, *args, **kwargs)
-        except ee.EmailError as e:
-            raise e
-        except ValueError as e:
-            if "is not an email address" in str(e):
-                raise ee.InvalidLoginData()
-            else:
-                raise ee.UnknownError(f"An unexpected error occurred: {str(e)}") from e
-        except INVALIDLOGINDATA:
+
+    return wrapper
+
+
+@contextmanager
+def _translate_errors():
+    """converts the errors of the protocol libraries into remail exceptions"""
+    RECIPIENTSFAIL = (SMTPRecipientsRefused, exch_errors.ErrorInvalidRecipients)
+    CONNECTIONFAIL = (
+        SMTPConnectError,
+        exch_errors.ErrorConnectionFailed,
+        exch_errors.TransportError,
+        SMTPServerDisconnected,
+        SMTPHeloError,
+        IMAPClientError,
+        IMAPClientAbortError,
+        CapabilityError,
+    )
+    INVALIDLOGINDATA = (
+        exch_errors.UnauthorizedError,
+        LoginError,
+        SMTPAuthenticationError,
+    )
+
+    try:
+        yield
+    except ee.EmailError as e:
+        raise e
+    except ValueError as e:
+        if "is not an email address" in str(e):
             raise ee.InvalidLoginData()
-        except CONNECTIONFAIL:
-            raise ee.ServerConnectionFail()
-        except SMTPDataError:
-            raise ee.SMTPDataFalse()
-        except RECIPIENTSFAIL:
-            raise ee.RecipientsFail()
-        except Exception as e:
+        else:
             raise ee.UnknownError(f"An unexpected error occurred: {str(e)}") from e
+    except INVALIDLOGINDATA:
+        raise ee.InvalidLoginData()
+    except exch_errors.ErrorServerBusy as e:
+        raise ee.ServerBusy(e.back_off) from e
+    except CONNECTIONFAIL:
+        raise ee.ServerConnectionFail()
+    except SMTPDataError:
+        raise ee.SMTPDataFalse()
+    except RECIPIENTSFAIL:
+        raise ee.RecipientsFail()
+    except Exception as e:
+        raise ee.UnknownError(f"An unexpected error occurred: {str(e)}") from e
+
+
+# only the Message-ID header is needed to detect deleted emails
+MESSAGE_ID_FETCH = "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"
+MESSAGE_ID_RESPONSE = b"BODY[HEADER.FIELDS (MESSAGE-ID)]"
+HEADER_FETCH_BATCH_SIZE = 1000
+SEEN = b"\\Seen"
+# maximum number of UIDs, that are sent with one STORE/MOVE/EXPUNGE command
+UID_COMMAND_BATCH_SIZE = 1000
+# upper bounds for the messages that are downloaded with one FETCH command
+FETCH_BATCH_BYTES = 16 * 1024 * 1024
+FETCH_BATCH_MAX_MESSAGES = 500
+# smaller batches (eg: incremental syncs) are parsed without the parse_pool
+PARSE_POOL_MIN_MESSAGES = 16
+# number of messages, that are sent to a parse process at once
+PARSE_POOL_CHUNK_SIZE = 4
+# attachments are downloaded on demand in parts of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# item fields, that are requested from EWS to create the emails
+EXCHANGE_EMAIL_FIELDS = (
+    "message_id",
+    "subject",
+    "sender",
+    "to_recipients",
+    "cc_recipients",
+    "bcc_recipients",
+    "datetime_received",
+    "is_read",
+    "body",
+    "text_body",
+    "attachments",
+)
+# items per FindItem request, if only a few fields are requested (EWS maximum)
+EXCHANGE_ID_PAGE_SIZE = 1000
+# item fields of the first phase of a two-phase fetch (see ExchangeProtocol)
+EXCHANGE_SYNC_FIELDS = ("message_id", "datetime_received", "is_read")
+# number of items, that are downloaded with one GetItem request
+EXCHANGE_FETCH_BATCH_SIZE = 100
+# number of message ids, that are searched with one FindItem request
+EXCHANGE_SEARCH_BATCH_SIZE = 100
+# changes per SyncFolderItems request (EWS maximum), the sync state is stored after
+# every page
+EXCHANGE_SYNC_PAGE_SIZE = 512
+# events of the streaming notifications, after which a folder is synced
+EXCHANGE_PUSH_EVENT_TYPES = (
+    "NewMailEvent",
+    "CreatedEvent",
+    "DeletedEvent",
+    "ModifiedEvent",
+    "MovedEvent",
+    "CopiedEvent",
+)
 
-    return wrapper
+
+class LazyMessage(NamedTuple):
+    """message without the content of its attachments, those are downloaded on
+    demand with ImapProtocol.download_attachment"""
+
+    header: bytes
+    texts: list[tuple[str, str]]
+    """content type and decoded text of the text/plain and text/html parts"""
+    attachments: list[tuple[str, str, int]]
+    """MIME part id, file name and size of the attachments"""
+
+
+class ParsedMessage(NamedTuple):
+    """contents of a raw message as plain values, so messages can be parsed in
+    other processes (see parse_message)"""
+
+    message_id: str
+    sender: str
+    subject: str
+    body: Optional[str]
+    html_parts: list[str]
+    attachments: list[tuple[str, str | bytes, Optional[str]]]
+    """file name, payload still in its transfer encoding and the encoding"""
+    to_recipients: list[tuple[str, str]]
+    cc_recipients: list[tuple[str, str]]
+    bcc_recipients: list[tuple[str, str]]
+    date: datetime
+
+
+class FetchBatch(NamedTuple):
+    """messages of a folder, that were downloaded with one FETCH command"""
+
+    messages: list[tuple[bytes | LazyMessage, bool]]
+    """raw message (or LazyMessage) and read flag of the messages, that have to be
+    stored"""
+    locations: dict[int, str]
+    """UID -> message id of all downloaded messages"""
+    uidvalidity: Optional[int]
+    last_uid: int
+    reset: bool
+    """the folder is synced from scratch"""
 
 
 class ProtocolTemplate(ABC):
@@ -119,6 +257,11 @@ class ProtocolTemplate(ABC):
         """Marks the email with given message_id as read(True)/unread(False)"""
         pass
 
+    def mark_emails(self, message_ids: list[str], read: bool):
+        """Marks all emails with the given message_ids as read(True)/unread(False)"""
+        for message_id in message_ids:
+            self.mark_email(message_id, read)
+
     @abstractmethod
     def delete_email(self, message_id: str, hard_delete: bool = False):
         """Deletes the email with given message_id
@@ -126,6 +269,17 @@ class ProtocolTemplate(ABC):
         hard_delete = False -> moves to trash folder"""
         pass
 
+    def delete_emails(self, message_ids: list[str], hard_delete: bool = False):
+        """Deletes all emails with the given message_ids (see delete_email)"""
+        for message_id in message_ids:
+            self.delete_email(message_id, hard_delete)
+
+    def download_attachment(self, message_id: str, attachment: Attachment) -> str:
+        """Downloads the attachment of the email with given message_id, that was left
+        out during the sync, and returns the path of the stored file"""
+        # attachments are stored during the sync by default
+        return attachment.filename
+
     @abstractmethod
     def get_emails(self, date: datetime = None) -> list[Email]:
         """Returns a list of email objects later than the datetime.
@@ -135,6 +289,15 @@ class ProtocolTemplate(ABC):
             ->import: tzlocal"""
         pass
 
+    def iter_emails(
+        self, date: datetime = None, flush: Callable[[], None] = None
+    ) -> Iterator[Email]:
+        """Like get_emails, but yields the email objects one after another, so
+        not all emails have to be kept in memory
+        flush: called before the protocol stores how far a folder has been synced,
+        the consumer must store the emails yielded so far"""
+        yield from self.get_emails(date)
+
 
 class ImapProtocol(ProtocolTemplate):
     def __init__(
@@ -143,12 +306,31 @@ class ImapProtocol(ProtocolTemplate):
         password: str,
         host: str,
         controller: "EmailController",  # type: ignore
+        pool: ConnectionPool = None,
+        folder_workers: int = 1,
+        lazy_attachments: bool = False,
+        parse_pool: Executor = None,
     ):
+        """pool: if given, the IMAP and SMTP connections are taken from the pool and
+        given back on logout instead of being closed
+        folder_workers: number of folders, that are fetched at the same time with own
+        connections from the pool
+        lazy_attachments: only the header, the BODYSTRUCTURE and the text parts are
+        downloaded during the sync, attachments are downloaded on demand
+        parse_pool: if given, larger batches of messages are parsed by its processes
+        (eg: ProcessPoolExecutor) while the emails are stored. Only used without
+        lazy_attachments, lazily fetched messages only have their header parsed,
+        which is cheaper than sending it to another process"""
         self.user_username = email
         self.user_password = password
         self.host = host
         self._logged_in = False
-        self.IMAP = IMAPClient(self.host, use_uid=True)
+        self._qresync = False
+        self.pool = pool
+        self.folder_workers = folder_workers
+        self.lazy_attachments = lazy_attachments
+        self.parse_pool = parse_pool
+        self.IMAP = None if pool else IMAPClient(self.host, use_uid=True)
         self.controller = controller
 
     @property
@@ -162,16 +344,48 @@ class ImapProtocol(ProtocolTemplate):
         if self.user_password is None:
             raise ee.InvalidLoginData() from None
         try:
-            self.IMAP.login(self.user_username, self.user_password)
+            if self.pool:
+                self.IMAP = self.pool.acquire_imap(
+                    self.user_username,
+                    self.user_password,
+                    self.host,
+                    setup=self._enable_extensions,
+                )
+            else:
+                self.IMAP.login(self.user_username, self.user_password)
+                self._enable_extensions(self.IMAP)
+            self._qresync = imap_raw.is_supported(self.IMAP) and all(
+                self.IMAP.has_capability(capability)
+                for capability in ("ENABLE", "QRESYNC")
+            )
             self._logged_in = True
         except LoginError:
             raise ee.InvalidLoginData() from None
         except Exception as e:
             raise e
 
+    @staticmethod
+    def _enable_extensions(client: IMAPClient):
+        """lets the server report flag changes and deleted messages (RFC 7162)"""
+        if client.has_capability("ENABLE"):
+            if client.has_capability("QRESYNC"):
+                client.enable("QRESYNC")
+            elif client.has_capability("CONDSTORE"):
+                client.enable("CONDSTORE")
+
     @error_handler
     def logout(self):
-        self.IMAP.logout()
+        if self.pool:
+            # a connection with a selected folder was left in the middle of a command
+            self.pool.release_imap(
+                self.user_username,
+                self.host,
+                self.IMAP,
+                broken=imap_raw.has_selected_folder(self.IMAP),
+            )
+            self.IMAP = None
+        else:
+            self.IMAP.logout()
         self.user_password = None
         self.user_username = None
         self._logged_in = False
@@ -205,22 +419,32 @@ class ImapProtocol(ProtocolTemplate):
         msg["Cc"] = cc
         if len(bcc) > 0:
             msg["Bcc"] = ",".join(bcc)
+        # the sent email is stored with its message id
+        if not email.message_id:
+            email.message_id = make_msgid(domain=from_email.rpartition("@")[2])
+        msg["Message-ID"] = email.message_id
         msg.set_content(email.body)
 
         # attachment
         for att in email.attachments:
-            filename = os.path.basename(att.filename)  # Sanitize filename
+            filename = att.name or os.path.basename(att.filename)  # Sanitize filename
             if not os.path.exists(att.filename) or not os.path.isfile(att.filename):
                 raise FileNotFoundError()
             with open(os.path.abspath(att.filename), "rb") as file:
                 file_data = file.read()
-                type = mimetypes.guess_type(file.name)[0].split("/")
+                type = mimetypes.guess_type(filename)[0].split("/")
                 main_type = type[0]
                 sub_type = type[1]
             msg.add_attachment(
                 file_data, maintype=main_type, subtype=sub_type, filename=filename
             )
 
+        if self.pool:
+            # reuses the authenticated connection of the account
+            with self.pool.smtp(SMTP_USER, SMTP_PASS, self.host) as smtp_server:
+                smtp_server.send_message(msg)
+            return
+
         # connect/authenticate
         smtp_server = SMTP_SSL(self.host, port=SMTP_SSL_PORT)
         smtp_server.login(SMTP_USER, SMTP_PASS)
@@ -230,169 +454,648 @@ class ImapProtocol(ProtocolTemplate):
         smtp_server.quit()
 
     @error_handler
-    def delete_email(self, message_id: str, hard_delete: bool):
+    def delete_email(self, message_id: str, hard_delete: bool = False):
+        self.delete_emails([message_id], hard_delete)
+
+    @error_handler
+    def delete_emails(self, message_ids: list[str], hard_delete: bool = False):
         if not self.logged_in:
             raise ee.NotLoggedIn()
-        # gets all accessable folder names from the connection
-        folder_names = self._get_folder_names()
-        for mailbox in folder_names:
-            # searches through all folders for the message_id
+        if not hard_delete:
+            trash_folder = self._get_folder_name_with_flags([b"\\Trash"])[0]
+        for mailbox, messages_ids in self._locate_emails(message_ids).items():
             self.IMAP.select_folder(mailbox)
-            messages_ids = self.IMAP.search(["HEADER", "Message-ID", message_id])
-            if messages_ids:
-                if hard_delete:
-                    # deletes the email completely
-                    self.IMAP.delete_messages(messages_ids)
-                    self.IMAP.expunge()
-                else:
-                    # only moves email to Trash folder
-                    folder_name = self._get_folder_name_with_flags([b"\\Trash"])
-                    self.IMAP.move(messages_ids, folder_name[0])
+            try:
+                for start in range(0, len(messages_ids), UID_COMMAND_BATCH_SIZE):
+                    uids = messages_ids[start : start + UID_COMMAND_BATCH_SIZE]
+                    if hard_delete:
+                        # deletes the email completely
+                        self.IMAP.delete_messages(uids)
+                        if self.IMAP.has_capability("UIDPLUS"):
+                            self.IMAP.expunge(uids)
+                        else:
+                            self.IMAP.expunge()
+                    else:
+                        # only moves email to Trash folder
+                        self.IMAP.move(uids, trash_folder)
+                self.controller.remove_message_locations(
+                    self.user_username, mailbox, messages_ids
+                )
+            finally:
+                self.IMAP.close_folder()
 
     @error_handler
     def get_emails(self, date: datetime = None) -> list[Email]:
+        return list(self.iter_emails(date))
+
+    @error_handler
+    def iter_emails(
+        self,
+        date: datetime = None,
+        folders: list[str] = None,
+        flush: Callable[[], None] = None,
+    ) -> Iterator[Email]:
+        """folders: only the emails of these folders are returned
+        flush: see ProtocolTemplate.iter_emails"""
         if not self.logged_in:
             raise ee.NotLoggedIn()
-        listofMails = []
         folder_names = self._get_folder_names()
+        if folders is not None:
+            folder_names = [folder for folder in folder_names if folder in folders]
+        if self.pool and self.folder_workers > 1 and len(folder_names) > 1:
+            yield from self._get_emails_parallel(folder_names, date, flush)
+            return
         for mailbox in folder_names:
-            # goes through all email folders and sums its content
-            listofMails += self._get_emails(mailbox, date)
-        return listofMails
+            # goes through all email folders one after another
+            yield from self._get_emails(mailbox, date, flush)
 
     @error_handler
-    def _get_emails(self, folder: str, date: datetime = None) -> list[Email]:
-        listofMails = []
+    def _get_emails(
+        self, folder: str, date: datetime = None, flush: Callable[[], None] = None
+    ) -> Iterator[Email]:
+        """yields the emails of the folder. Messages are downloaded in batches, the
+        sync state is stored after the emails of a batch have been consumed"""
+        for batch in self._fetch_batches(self.IMAP, folder, date):
+            yield from self._create_emails(batch)
+            self._save_batch(folder, batch, flush)
+
+    def _get_emails_parallel(
+        self,
+        folder_names: list[str],
+        date: datetime = None,
+        flush: Callable[[], None] = None,
+    ) -> Iterator[Email]:
+        """fetches the folders with folder_workers own connections from the pool at
+        the same time. The emails are created in this thread, at most
+        2 * folder_workers downloaded batches are waiting to be processed"""
+        batches = queue.Queue(maxsize=2 * self.folder_workers)
+        stop = threading.Event()
+        failed = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch_folder(folder: str):
+            if failed.is_set():
+                # another folder failed, the sync is cancelled
+                return
+            try:
+                # the connection goes back into the pool, that login() draws from
+                with self.pool.imap(
+                    self.user_username,
+                    self.user_password,
+                    self.host,
+                    setup=self._enable_extensions,
+                ) as client:
+                    for batch in self._fetch_batches(client, folder, date):
+                        if not put((folder, batch)):
+                            return
+            except Exception as e:
+                # the error is raised by the consuming thread
+                failed.set()
+                put((folder, e))
+            else:
+                # marks the folder as finished
+                put((folder, None))
+
+        with ThreadPoolExecutor(max_workers=self.folder_workers) as executor:
+            futures = [executor.submit(fetch_folder, f) for f in folder_names]
+            try:
+                finished = 0
+                while finished < len(folder_names):
+                    folder, batch = batches.get()
+                    if isinstance(batch, Exception):
+                        raise batch
+                    if batch is None:
+                        finished += 1
+                        continue
+                    yield from self._create_emails(batch)
+                    self._save_batch(folder, batch, flush)
+            finally:
+                # the running folders stop after their current batch, the waiting
+                # ones are not fetched anymore
+                stop.set()
+                for future in futures:
+                    future.cancel()
+
+    def _fetch_batches(
+        self, client: IMAPClient, folder: str, date: datetime = None
+    ) -> Iterator["FetchBatch"]:
+        """downloads the new messages of the folder in batches with the given
+        connection. Messages older than the date are left out"""
         try:
-            self.IMAP.select_folder(folder)
-            if date is not None:
+            folder_info = client.select_folder(folder)
+            uidvalidity = folder_info.get(b"UIDVALIDITY")
+            state = self.controller.get_folder_sync_state(self.user_username, folder)
+            reset = False
+            if date is None or (state and state.uidvalidity != uidvalidity):
+                # no date time given or the UIDs of the folder were reassigned:
+                # return all emails
+                messages_ids = client.search(["ALL"])
+                date = None
+                last_uid = 0
+                reset = True
+            elif state and state.last_uid is not None:
+                # folder was synced before: only fetch messages with a higher UID
+                # ("n:*" always matches the newest message, so it is filtered out)
+                messages_ids = [
+                    uid
+                    for uid in client.search(["UID", f"{state.last_uid + 1}:*"])
+                    if uid > state.last_uid
+                ]
+                # new UIDs are new in the folder, even with an older date (eg: moved)
+                date = None
+                last_uid = state.last_uid
+            else:
                 # if date time is given filter all emails after this date
-                messages_ids = self.IMAP.search(["SINCE", date])
+                messages_ids = client.search(["SINCE", date])
                 date = date.astimezone(timezone("UTC"))
-            else:
-                # no date time given: return all emails
-                messages_ids = self.IMAP.search(["ALL"])
-            for _, message_data in self.IMAP.fetch(messages_ids, ["RFC822"]).items():
-                email_message = email.message_from_bytes(message_data[b"RFC822"])
-                if date is not None and date > parsedate_to_datetime(
-                    email_message["Date"]
-                ).astimezone(timezone("UTC")):
-                    continue
-                attachments_file_names = []
-                html_parts = []
-                body = None
-                if email_message.is_multipart():
-                    # iter over all parts
-                    for part in email_message.walk():
-                        ctype = part.get_content_type()
-                        cdispo = str(part.get("Content-Disposition"))
-
-                        # get attachments part
-                        if part.get_content_disposition() == "attachment":
-                            filename = part.get_filename()
-                            # safe attachments
-                            if filename:
-                                file, encoding = decode_header(filename)[0]
-                                if isinstance(file, bytes):
-                                    filename = file.decode(
-                                        encoding or "utf-8", errors="replace"
-                                    )
-                                else: 
-                                    filename = file
-                                attachments_file_names += [
-                                    safe_file(
-                                        filename,
-                                        part.get_payload(decode=True),
-                                        email_message["Message-Id"],
-                                    )
-                                ]
-
-                        # get HTML parts
-                        if part.get_content_type() == "text/html":
-                            html_content = part.get_payload(decode=True).decode(
-                                part.get_content_charset() or "utf-8", errors="replace"
-                            )
-                            html_parts.append(html_content)
-
-                        # get plain text from email
-                        if ctype == "text/plain" and "attachment" not in cdispo:
-                            body = part.get_payload(decode=True).decode(
-                                part.get_content_charset() or "utf-8", errors="replace"
-                            )
-
-                # get plain if no multipart
-                else:
-                    body = email_message.get_payload(decode=True).decode(
-                        email_message.get_content_charset() or "utf-8", errors="replace"
-                    )
+                last_uid = 0
+                # only the location index of the folder exists (deletion check), it
+                # is rebuilt with the synced messages
+                reset = state is not None
+
+            for uids in self._get_fetch_batches(client, sorted(messages_ids)):
+                messages = []
+                locations = {}
+                for uid, message, header, flags in self._fetch_messages(client, uids):
+                    header = BytesHeaderParser().parsebytes(header)
+                    locations[uid] = get_message_id(header)
+                    if date is not None and date > parsedate_to_datetime(
+                        header["Date"]
+                    ).astimezone(timezone("UTC")):
+                        continue
+                    messages.append((message, SEEN in flags))
+                last_uid = max(last_uid, *uids)
+                yield FetchBatch(messages, locations, uidvalidity, last_uid, reset)
+                reset = False
+
+            yield FetchBatch(
+                [],
+                {},
+                uidvalidity,
+                max(last_uid, folder_info.get(b"UIDNEXT", 1) - 1),
+                reset,
+            )
+        finally:
+            client.close_folder()
+
+    def _fetch_messages(
+        self, client: IMAPClient, uids: list[int]
+    ) -> Iterator[tuple[int, bytes | LazyMessage, bytes, tuple]]:
+        """yields UID, message, header and flags of the messages. The message is the
+        raw message or, with lazy_attachments, a LazyMessage"""
+        if not self.lazy_attachments:
+            # BODY.PEEK doesn't mark the messages as read like RFC822 does
+            response = client.fetch(uids, ["BODY.PEEK[]", "FLAGS"])
+            for uid in uids:
+                message_data = response.pop(uid, None)
+                if message_data is not None:
+                    raw = message_data[b"BODY[]"]
+                    yield uid, raw, raw, message_data.get(b"FLAGS", ())
+            return
 
-                x = getaddresses([email_message["From"]])
-                saddr = x[0][1]
-                listofMails += [
-                    create_email(
-                        uid=email_message["Message-Id"],
-                        sender=saddr,
-                        subject=email_message["Subject"],
-                        body=body,
-                        attachments=attachments_file_names,
-                        to_recipients=[
-                            (name, addr)
-                            for name, addr in getaddresses([email_message["To"]])
-                            if addr and addr.lower() != "none"
-                        ],
-                        cc_recipients=[
-                            (name, addr)
-                            for name, addr in getaddresses([email_message["Cc"]])
-                            if addr and addr.lower() != "none"
-                        ],
-                        bcc_recipients=[
-                            (name, addr)
-                            for name, addr in getaddresses([email_message["Bcc"]])
-                            if addr and addr.lower() != "none"
-                        ],
-                        date=parsedate_to_datetime(email_message["Date"]).astimezone(
-                            timezone("UTC")
+        response = client.fetch(uids, ["BODY.PEEK[HEADER]", "BODYSTRUCTURE", "FLAGS"])
+        parts = {}
+        uids_by_sections = {}
+        for uid, message_data in response.items():
+            texts, attachments = get_message_parts(message_data[b"BODYSTRUCTURE"])
+            parts[uid] = (texts, attachments)
+            sections = tuple(part_id for part_id, _, _, _ in texts)
+            uids_by_sections.setdefault(sections, []).append(uid)
+
+        # the text parts are fetched with one command for all messages with the same
+        # structure (most messages of a batch have the same)
+        contents = {}
+        for sections, section_uids in uids_by_sections.items():
+            if sections:
+                contents.update(
+                    client.fetch(
+                        section_uids, [f"BODY.PEEK[{part_id}]" for part_id in sections]
+                    )
+                )
+
+        for uid in uids:
+            message_data = response.pop(uid, None)
+            if message_data is None:
+                continue
+            texts, attachments = parts[uid]
+            content = contents.pop(uid, {})
+            header = message_data[b"BODY[HEADER]"]
+            message = LazyMessage(
+                header,
+                [
+                    (
+                        content_type,
+                        decode_part(
+                            content.get(f"BODY[{part_id}]".encode(), b""),
+                            encoding,
+                            charset,
                         ),
-                        controller=self.controller,
-                        html_files=html_parts,
                     )
-                ]
-        except Exception as e:
-            raise e
-        finally:
-            self.IMAP.close_folder()
-        return listofMails
+                    for part_id, content_type, encoding, charset in texts
+                ],
+                attachments,
+            )
+            yield uid, message, header, message_data.get(b"FLAGS", ())
+
+    def _create_emails(self, batch: "FetchBatch") -> Iterator[Email]:
+        """parses the downloaded messages of the batch. Larger batches of raw
+        messages are parsed by the processes of the parse_pool, while the emails are
+        created from the already parsed messages"""
+        parsed_messages = None
+        raw_count = sum(
+            not isinstance(message, LazyMessage) for message, _ in batch.messages
+        )
+        if self.parse_pool and raw_count >= PARSE_POOL_MIN_MESSAGES:
+            # all messages are submitted at once, the tasks of the pool only keep
+            # the raw messages until they are parsed
+            parsed_messages = self.parse_pool.map(
+                parse_message,
+                [
+                    message
+                    for message, _ in batch.messages
+                    if not isinstance(message, LazyMessage)
+                ],
+                chunksize=PARSE_POOL_CHUNK_SIZE,
+            )
+
+        while batch.messages:
+            # pops the message, so the raw message is released once its email is
+            # created
+            message, read = batch.messages.pop(0)
+            if isinstance(message, LazyMessage):
+                yield self._create_lazy_email(message, read)
+            elif parsed_messages is not None:
+                yield self._create_email(next(parsed_messages), read)
+            else:
+                yield self._create_email(parse_message(message), read)
+
+    def _create_lazy_email(self, message: LazyMessage, read: bool = None) -> Email:
+        """creates the email object from a message without attachment contents, the
+        attachments only get their metadata"""
+        body = None
+        html_parts = []
+        for content_type, text in message.texts:
+            if content_type == "text/html":
+                html_parts.append(text)
+            else:
+                body = text
+        attachments = [
+            Attachment(name=name, size=size, part_id=part_id)
+            for part_id, name, size in message.attachments
+        ]
+        return self._build_email(
+            parse_header(
+                BytesHeaderParser().parsebytes(message.header), body, html_parts, []
+            ),
+            attachments,
+            read,
+        )
+
+    def _save_batch(
+        self, folder: str, batch: "FetchBatch", flush: Callable[[], None] = None
+    ):
+        """remembers where the messages of the batch are and how far the folder has
+        been synced. flush stores the emails of the batch first"""
+        if batch.uidvalidity is None:
+            return
+        if flush is not None:
+            flush()
+        if batch.reset:
+            self.controller.remove_message_locations(self.user_username, folder)
+            self.controller.update_folder_sync_state(
+                self.user_username, folder, highest_modseq=None
+            )
+        if batch.locations:
+            self.controller.add_message_locations(
+                self.user_username, folder, batch.locations
+            )
+        self.controller.update_folder_sync_state(
+            self.user_username,
+            folder,
+            uidvalidity=batch.uidvalidity,
+            last_uid=batch.last_uid,
+        )
+
+    def _get_fetch_batches(
+        self, client: IMAPClient, uids: list[int]
+    ) -> Iterator[list[int]]:
+        """splits the UIDs into batches, whose messages together are not larger than
+        FETCH_BATCH_BYTES (using RFC822.SIZE)"""
+        sizes = {}
+        for start in range(0, len(uids), HEADER_FETCH_BATCH_SIZE):
+            batch = uids[start : start + HEADER_FETCH_BATCH_SIZE]
+            for uid, message_data in client.fetch(batch, ["RFC822.SIZE"]).items():
+                sizes[uid] = message_data.get(b"RFC822.SIZE", 0)
+
+        batch = []
+        batch_size = 0
+        for uid in uids:
+            if uid not in sizes:
+                # message was deleted in the meantime
+                continue
+            if batch and (
+                batch_size + sizes[uid] > FETCH_BATCH_BYTES
+                or len(batch) >= FETCH_BATCH_MAX_MESSAGES
+            ):
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(uid)
+            batch_size += sizes[uid]
+        if batch:
+            yield batch
+
+    def _create_email(self, message: "ParsedMessage", read: bool = None) -> Email:
+        """creates the email object from the parsed message and stores its
+        attachments"""
+        attachments = [
+            safe_file(filename, content, encoding, self.controller.attachment_store)
+            for filename, content, encoding in message.attachments
+        ]
+        return self._build_email(message, attachments, read)
+
+    def _build_email(
+        self,
+        message: "ParsedMessage",
+        attachments: list[Attachment],
+        read: bool = None,
+    ) -> Email:
+        """creates the email object from the parsed message and the already stored
+        attachments"""
+        return create_email(
+            uid=message.message_id,
+            sender=message.sender,
+            subject=message.subject,
+            body=message.body,
+            attachments=attachments,
+            to_recipients=message.to_recipients,
+            cc_recipients=message.cc_recipients,
+            bcc_recipients=message.bcc_recipients,
+            date=message.date,
+            controller=self.controller,
+            html_files=message.html_parts,
+            read=read,
+        )
 
     @error_handler
-    def get_deleted_emails(self, message_ids: list[str]) -> list[str]:
+    def get_deleted_emails(
+        self, message_ids: list[str], folders: list[str] = None
+    ) -> list[str]:
+        """folders: only these folders are checked on the server, for the other
+        folders the location index is used. Then only emails that were located in
+        these folders are reported as deleted"""
         if not self.logged_in:
             raise ee.NotLoggedIn()
-        listofUIPsIMAP = []
+        listofUIPsIMAP = set()
         folder_names = self._get_folder_names()
+        if folders is not None:
+            # emails of folders that are not indexed (yet) are not deleted
+            checked = set()
+            for mailbox in folder_names:
+                if mailbox in folders:
+                    checked |= set(
+                        self.controller.get_message_locations(
+                            self.user_username, mailbox
+                        ).values()
+                    )
+            message_ids = [
+                message_id for message_id in message_ids if message_id in checked
+            ]
         for mailbox in folder_names:
             # iterates over all available folders
-            self.IMAP.select_folder(mailbox)
-            list_messages_ids = self.IMAP.search(["ALL"])
-            # gets all message ids from the connection
-            for _, message_data in self.IMAP.fetch(
-                list_messages_ids, ["RFC822"]
-            ).items():
-                email_message = email.message_from_bytes(message_data[b"RFC822"])
-                listofUIPsIMAP.append(email_message["Message-Id"])
-            self.IMAP.close_folder()
+            if folders is None or mailbox in folders:
+                listofUIPsIMAP |= self._get_message_ids(mailbox)
+            else:
+                listofUIPsIMAP |= set(
+                    self.controller.get_message_locations(
+                        self.user_username, mailbox
+                    ).values()
+                )
         # given ids without the ids, that are currently on the connection
-        return list(set(message_ids) - set(listofUIPsIMAP))
+        return list(set(message_ids) - listofUIPsIMAP)
+
+    @error_handler
+    def _get_message_ids(self, folder: str) -> set[str]:
+        """returns the message ids of all emails in the folder. If the server supports
+        CONDSTORE/QRESYNC, it reports the flag changes and deleted messages since the
+        last sync. Otherwise the UIDs of the folder are compared with the location
+        index and the Message-ID header is fetched for unknown UIDs only"""
+        try:
+            folder_info = self.IMAP.select_folder(folder, readonly=True)
+            highest_modseq = folder_info.get(b"HIGHESTMODSEQ")
+            state = self.controller.get_folder_sync_state(self.user_username, folder)
+            if state and state.uidvalidity == folder_info.get(b"UIDVALIDITY"):
+                known = self.controller.get_message_locations(
+                    self.user_username, folder
+                )
+            else:
+                # the stored UIDs of this folder are not valid anymore
+                self.controller.remove_message_locations(self.user_username, folder)
+                known = {}
+                state = None
+
+            vanished = None
+            if state and state.highest_modseq and highest_modseq:
+                if highest_modseq == state.highest_modseq:
+                    # nothing changed in this folder since the last sync
+                    return set(known.values())
+                changed, vanished = self._get_changes_since(state.highest_modseq)
+                self._update_read_state(changed, known)
+
+            locations = {}
+            if vanished is None:
+                server_uids = set(self.IMAP.search(["ALL"]))
+                vanished = [uid for uid in known if uid not in server_uids]
+                unknown = sorted(server_uids - known.keys())
+                for start in range(0, len(unknown), HEADER_FETCH_BATCH_SIZE):
+                    batch = unknown[start : start + HEADER_FETCH_BATCH_SIZE]
+                    response = self.IMAP.fetch(batch, [MESSAGE_ID_FETCH])
+                    for uid, message_data in response.items():
+                        header = message_data.get(MESSAGE_ID_RESPONSE)
+                        if header is None:
+                            continue
+                        message_id = get_message_id(
+                            BytesHeaderParser().parsebytes(header)
+                        )
+                        if message_id:
+                            locations[uid] = message_id
+
+            vanished = [uid for uid in vanished if uid in known]
+            if vanished:
+                self.controller.remove_message_locations(
+                    self.user_username, folder, vanished
+                )
+                for uid in vanished:
+                    del known[uid]
+            if locations:
+                self.controller.add_message_locations(
+                    self.user_username, folder, locations
+                )
+            if state is None:
+                # the location index of the folder is complete, its emails haven't
+                # been synced with these UIDs yet
+                self.controller.update_folder_sync_state(
+                    self.user_username,
+                    folder,
+                    uidvalidity=folder_info.get(b"UIDVALIDITY"),
+                    last_uid=None,
+                    highest_modseq=highest_modseq,
+                )
+            elif highest_modseq:
+                # the location index of the folder is complete up to this point
+                self.controller.update_folder_sync_state(
+                    self.user_username, folder, highest_modseq=highest_modseq
+                )
+
+            return set(known.values()) | set(locations.values())
+        finally:
+            self.IMAP.close_folder()
+
+    def _get_changes_since(self, modseq: int) -> tuple[dict, list[int]]:
+        """returns the FLAGS of the messages changed since the modseq and the UIDs
+        of the deleted messages. Without QRESYNC the deleted messages are unknown
+        (None)"""
+        if not self._qresync:
+            changed_uids = self.IMAP.search(["MODSEQ", modseq + 1])
+            return self.IMAP.fetch(changed_uids, ["FLAGS"]), None
+
+        return imap_raw.fetch_changes(self.IMAP, modseq)
+
+    def _update_read_state(self, changed: dict, known: dict[int, str]):
+        """stores the \\Seen flag of the changed messages in the database"""
+        read = []
+        unread = []
+        for uid, message_data in changed.items():
+            if uid not in known or b"FLAGS" not in message_data:
+                continue
+            if SEEN in message_data[b"FLAGS"]:
+                read.append(known[uid])
+            else:
+                unread.append(known[uid])
+        self.controller.update_read_state(read, True)
+        self.controller.update_read_state(unread, False)
 
     @error_handler
     def mark_email(self, message_id: str, read: bool):
+        self.mark_emails([message_id], read)
+
+    @error_handler
+    def mark_emails(self, message_ids: list[str], read: bool):
         if not self.logged_in:
             raise ee.NotLoggedIn()
-        if read:
-            # mark email as seen
-            self.IMAP.add_flags(message_id, ["SEEN"])
-        else:
-            # mark email as unseen
-            self.IMAP.remove_flags(message_id, ["SEEN"])
+        for mailbox, messages_ids in self._locate_emails(message_ids).items():
+            self.IMAP.select_folder(mailbox)
+            try:
+                for start in range(0, len(messages_ids), UID_COMMAND_BATCH_SIZE):
+                    uids = messages_ids[start : start + UID_COMMAND_BATCH_SIZE]
+                    if read:
+                        # mark email as seen
+                        self.IMAP.add_flags(uids, [SEEN], silent=True)
+                    else:
+                        # mark email as unseen
+                        self.IMAP.remove_flags(uids, [SEEN], silent=True)
+            finally:
+                self.IMAP.close_folder()
+
+    @error_handler
+    def download_attachment(self, message_id: str, attachment: Attachment) -> str:
+        if not self.logged_in:
+            raise ee.NotLoggedIn()
+        if attachment.part_id is None:
+            return attachment.filename
+        part_id = attachment.part_id
+        for mailbox, uids in self._locate_emails([message_id]).items():
+            self.IMAP.select_folder(mailbox, readonly=True)
+            try:
+                # the MIME header of the part contains the transfer encoding
+                section = f"BODY[{part_id}.MIME]"
+                response = self.IMAP.fetch(uids[:1], [f"BODY.PEEK[{part_id}.MIME]"])
+                if section.encode() not in response.get(uids[0], {}):
+                    continue
+                encoding = BytesHeaderParser().parsebytes(
+                    response[uids[0]][section.encode()]
+                )["Content-Transfer-Encoding"]
+                if attachment.size is not None:
+                    check_encoded_size(attachment.size, encoding)
+                stored = safe_file(
+                    attachment.name,
+                    self._iter_part(uids[0], part_id),
+                    encoding,
+                    self.controller.attachment_store,
+                )
+            finally:
+                self.IMAP.close_folder()
+            attachment.filename = stored.filename
+            attachment.sha256 = stored.sha256
+            attachment.size = stored.size
+            return attachment.filename
+        raise ee.MessageNotFound()
+
+    def _iter_part(self, uid: int, part_id: str) -> Iterator[bytes]:
+        """downloads the content of a part of the message in the selected folder
+        with partial fetches of DOWNLOAD_CHUNK_SIZE bytes"""
+        start = 0
+        while True:
+            response = self.IMAP.fetch(
+                [uid], [f"BODY.PEEK[{part_id}]<{start}.{DOWNLOAD_CHUNK_SIZE}>"]
+            )
+            chunk = response.get(uid, {}).get(f"BODY[{part_id}]<{start}>".encode())
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < DOWNLOAD_CHUNK_SIZE:
+                return
+            start += len(chunk)
+
+    def _locate_emails(self, message_ids: list[str]) -> dict[str, list[int]]:
+        """returns the UIDs of the emails per folder. The location index of the sync
+        is used, only emails missing there are searched in all folders"""
+        located = {}
+        found = set()
+        valid = {}
+        """folder -> whether the indexed UIDs are still valid"""
+        for mailbox, uid, message_id in self.controller.get_locations_of_messages(
+            self.user_username, message_ids
+        ):
+            if mailbox not in valid:
+                valid[mailbox] = self._has_valid_uids(mailbox)
+            if valid[mailbox]:
+                located.setdefault(mailbox, []).append(uid)
+                found.add(message_id)
+
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        if missing:
+            for mailbox in self._get_folder_names():
+                # searches through all folders for the message_ids
+                self.IMAP.select_folder(mailbox, readonly=True)
+                try:
+                    for message_id in missing:
+                        located.setdefault(mailbox, []).extend(
+                            self.IMAP.search(["HEADER", "Message-ID", message_id])
+                        )
+                finally:
+                    self.IMAP.close_folder()
+        return {mailbox: sorted(set(uids)) for mailbox, uids in located.items() if uids}
+
+    def _has_valid_uids(self, folder: str) -> bool:
+        """compares the UIDVALIDITY of the folder with the one of the last sync. If
+        the UIDs were reassigned, the location index of the folder is removed"""
+        state = self.controller.get_folder_sync_state(self.user_username, folder)
+        uidvalidity = self.IMAP.folder_status(folder, [b"UIDVALIDITY"]).get(
+            b"UIDVALIDITY"
+        )
+        if state and state.uidvalidity == uidvalidity:
+            return True
+        self.controller.remove_message_locations(self.user_username, folder)
+        return False
 
     @error_handler
     def _get_folder_names(self) -> list[str]:
@@ -441,7 +1144,16 @@ class ExchangeProtocol(ProtocolTemplate):
         password: str,
         username: str,
         controller: "EmailController",  # type: ignore
+        folder_cache: ExchangeFolderCache = None,
+        fetch_workers: int = 1,
+        fetch_batch_size: int = EXCHANGE_FETCH_BATCH_SIZE,
+        scheduler: ThrottlingScheduler = None,
     ):
+        """folder_cache: keeps the account and its folders between the logins
+        fetch_workers: with more than one worker, the sync first collects the ids of
+        the new items and then downloads the items and their attachments in batches
+        of fetch_batch_size with this number of threads
+        scheduler: runs the EWS requests and waits, while the server is busy"""
         self.cred = None
         self.acc = None
         self._logged_in = False
@@ -449,6 +1161,15 @@ class ExchangeProtocol(ProtocolTemplate):
         self.password = password
         self.username = username
         self.controller = controller
+        self.folder_cache = folder_cache
+        self.fetch_workers = fetch_workers
+        self.fetch_batch_size = fetch_batch_size
+        self.scheduler = scheduler or ThrottlingScheduler(max(fetch_workers, 1))
+        self._synced = False
+        """true, if all folders were synced (iter_emails), so the location index
+        contains all items on the server"""
+        self._subscribed_folders = set()
+        """ids of the folders of the streaming subscription"""
 
     @property
     def logged_in(self) -> bool:
@@ -460,13 +1181,22 @@ class ExchangeProtocol(ProtocolTemplate):
             return
 
         self.cred = Credentials(self.username, self.password)
-        self.acc = Account(self.email, credentials=self.cred, autodiscover=True)
+        if self.folder_cache:
+            self.acc = self.folder_cache.get_account(
+                self.email, self.username, self.password, self._connect
+            )
+        else:
+            self.acc = self._connect()
         self._logged_in = True
 
+    def _connect(self) -> Account:
+        return Account(self.email, credentials=self.cred, autodiscover=True)
+
     def logout(self):
         self.acc = None
         self.cred = None
         self._logged_in = False
+        self._synced = False
 
     @error_handler
     def send_email(self, email: Email):
@@ -500,61 +1230,155 @@ class ExchangeProtocol(ProtocolTemplate):
                 continue  # jumps to the next attachment if path doesn't exist
             with open(path, "rb") as f:
                 content = f.read()
-                att = FileAttachment(name=os.path.basename(path), content=content)
+                att = FileAttachment(
+                    name=attachement.name or os.path.basename(path), content=content
+                )
                 m.attach(att)
 
         m.send()
 
     @error_handler
     def mark_email(self, message_id: str, read: bool):
+        self.mark_emails([message_id], read)
+
+    @error_handler
+    def mark_emails(self, message_ids: list[str], read: bool):
+        """marks the items with one UpdateItem request per batch"""
         if not self.logged_in:
             raise ee.NotLoggedIn()
 
-        for item in self._get_items(message_id=message_id):
-            item.is_read = read
-            item.save(update_fields=["is_read"])
+        for items in self._find_items(message_ids):
+            for item in items:
+                item.is_read = read
+            self.scheduler.call(
+                self._bulk_request,
+                self.acc.bulk_update,
+                items=[(item, ["is_read"]) for item in items],
+            )
 
     @error_handler
     def delete_email(self, message_id: str, hard_delete: bool = False):
+        self.delete_emails([message_id], hard_delete)
+
+    @error_handler
+    def delete_emails(self, message_ids: list[str], hard_delete: bool = False):
+        """deletes or moves the items to the trash with one DeleteItem request per
+        batch"""
         if not self.logged_in:
             raise ee.NotLoggedIn()
 
-        for item in self._get_items(message_id=message_id):
-            if hard_delete:
-                item.delete()
-            else:
-                item.move_to_trash()
+        delete_type = HARD_DELETE if hard_delete else MOVE_TO_DELETED_ITEMS
+        for items in self._find_items(message_ids):
+            self.scheduler.call(
+                self._bulk_request,
+                self.acc.bulk_delete,
+                ids=items,
+                delete_type=delete_type,
+            )
+
+    def _find_items(self, message_ids: list[str]) -> Iterator[list[Message]]:
+        """yields the items with the message ids in batches, one FindItem request
+        per EXCHANGE_SEARCH_BATCH_SIZE message ids"""
+        message_ids = list(dict.fromkeys(message_ids))
+        for start in range(0, len(message_ids), EXCHANGE_SEARCH_BATCH_SIZE):
+            batch = message_ids[start : start + EXCHANGE_SEARCH_BATCH_SIZE]
+            # item id and change key are always part of the response
+            items = self.scheduler.call(
+                lambda: list(self._get_items(message_id=batch, only=("message_id",)))
+            )
+            if items:
+                yield items
+
+    @staticmethod
+    def _bulk_request(method, **kwargs):
+        """raises the first error of an exchangelib bulk operation. Items, that don't
+        exist anymore, are ignored"""
+        for result in method(**kwargs):
+            if isinstance(result, Exception) and not isinstance(
+                result, exch_errors.ErrorItemNotFound
+            ):
+                raise result
 
     @error_handler
-    def get_deleted_emails(self, message_ids: list[str]) -> list[str]:
+    def get_deleted_emails(
+        self, message_ids: list[str], folders: list[str] = None
+    ) -> list[str]:
+        """folders: the folders synced before (see iter_emails), the location index
+        is used for all folders"""
         if not self.logged_in:
             raise ee.NotLoggedIn()
 
-        server_uids = [item.message_id for item in self._get_items()]
+        if self._synced:
+            # the location index is up to date after the sync
+            located = {
+                message_id
+                for _, _, message_id in self.controller.get_locations_of_messages(
+                    self.email, message_ids
+                )
+            }
+            return list(set(message_ids) - located)
+
+        server_uids = self.scheduler.call(
+            lambda: [
+                item.message_id
+                for item in self._get_items(
+                    only=("message_id",), page_size=EXCHANGE_ID_PAGE_SIZE
+                )
+            ]
+        )
 
         return list(set(message_ids) - set(server_uids))
 
-    def _get_items(self, start_date: datetime = None, message_id=""):
-        if start_date:
-            start_date = start_date.astimezone(UTC)
+    def _get_email_folders(self) -> list:
+        """returns the mail folders without trash, junk and drafts"""
+        if self.folder_cache:
+            return self.folder_cache.get_folders(
+                self.email, self.acc, self._load_email_folders
+            )
+        return self._load_email_folders(self.acc)
 
-        email_folders = [
+    @staticmethod
+    def _load_email_folders(account: Account) -> list:
+        return [
             f
-            for f in self.acc.root.walk()
+            for f in account.root.walk()
             if f.CONTAINER_CLASS == "IPF.Note"
-            and f not in {self.acc.trash, self.acc.junk, self.acc.drafts}
+            and f not in {account.trash, account.junk, account.drafts}
         ]
+
+    def _get_items(
+        self,
+        start_date: datetime = None,
+        message_id="",
+        only: tuple[str, ...] = None,
+        page_size: int = None,
+    ):
+        """message_id: one message id or a list of message ids
+        only: the item fields, that are requested from the server (default: all)
+        page_size: number of items per request (default of exchangelib: 100)"""
+        if start_date:
+            start_date = start_date.astimezone(UTC)
+        if isinstance(message_id, list):
+            message_filter = {"message_id__in": message_id}
+        else:
+            message_filter = {"message_id": message_id}
+
+        email_folders = self._get_email_folders()
         folder_collection = FolderCollection(account=self.acc, folders=email_folders)
         if start_date and message_id:
             generator = folder_collection.filter(
-                datetime_received__gte=start_date, message_id=message_id
+                datetime_received__gte=start_date, **message_filter
             )
         elif start_date:
             generator = folder_collection.filter(datetime_received__gte=start_date)
         elif message_id:
-            generator = folder_collection.filter(message_id=message_id)
+            generator = folder_collection.filter(**message_filter)
         else:
             generator = folder_collection.all()
+        if only:
+            generator = generator.only(*only)
+        if page_size:
+            generator.page_size = page_size
         for item in generator:
             if isinstance(item, Message):
                 yield item
@@ -565,18 +1389,273 @@ class ExchangeProtocol(ProtocolTemplate):
             raise ee.NotLoggedIn()
 
         result = []
-        for item in self._get_items(start_date=date):
+        for item in self._get_items(start_date=date, only=EXCHANGE_EMAIL_FIELDS):
             result += self._get_email_exchange(item)
         return result
 
     @error_handler
-    def _get_email_exchange(self, item):
+    def iter_emails(
+        self,
+        date: datetime = None,
+        folders: list[str] = None,
+        flush: Callable[[], None] = None,
+    ) -> Iterator[Email]:
+        """yields the emails, that were created since the last sync of the folders
+        (SyncFolderItems). Read state changes are stored directly, the deleted emails
+        are returned by get_deleted_emails afterwards. The date only filters the
+        emails of folders without sync state
+        folders: only these folders (ids) are synced
+        flush: see ProtocolTemplate.iter_emails"""
+        if not self.logged_in:
+            raise ee.NotLoggedIn()
+
+        self._synced = False
+        email_folders = self._get_email_folders()
+        for folder in email_folders:
+            if folders is None or folder.id in folders:
+                yield from self._sync_folder(folder, date, flush)
+        # the location index is complete, if every folder was synced once
+        self._synced = folders is None or all(
+            self.controller.get_folder_sync_state(self.email, folder.id)
+            for folder in email_folders
+        )
+
+    @error_handler
+    def subscribe(self) -> str:
+        """creates a streaming subscription for the changes in the mail folders and
+        returns its id"""
+        if not self.logged_in:
+            raise ee.NotLoggedIn()
+
+        folders = self._get_email_folders()
+        self._subscribed_folders = {folder.id for folder in folders}
+        return self.scheduler.call(
+            FolderCollection(account=self.acc, folders=folders).subscribe_to_streaming,
+            event_types=EXCHANGE_PUSH_EVENT_TYPES,
+        )
+
+    @error_handler
+    def iter_changed_folders(
+        self, subscription_id: str, connection_timeout: int = 1
+    ) -> Iterator[set[str]]:
+        """yields the ids of the mail folders with new, deleted, moved or changed
+        items, as soon as the server reports them. Returns after connection_timeout
+        minutes"""
+        if not self.logged_in:
+            raise ee.NotLoggedIn()
+
+        for notification in self.acc.inbox.get_streaming_events(
+            subscription_id, connection_timeout=connection_timeout
+        ):
+            changed = set()
+            for event in notification.events:
+                # moved items are also removed from their previous folder
+                for folder_id in (
+                    getattr(event, "parent_folder_id", None),
+                    getattr(event, "old_parent_folder_id", None),
+                ):
+                    if (
+                        folder_id is not None
+                        and folder_id.id in self._subscribed_folders
+                    ):
+                        changed.add(folder_id.id)
+            if changed:
+                yield changed
+
+    @error_handler
+    def unsubscribe(self, subscription_id: str):
+        if not self.logged_in:
+            raise ee.NotLoggedIn()
+
+        self.acc.inbox.unsubscribe(subscription_id)
+
+    def _sync_folder(
+        self, folder, date: datetime, flush: Callable[[], None] = None
+    ) -> Iterator[Email]:
+        """yields the emails created in the folder since the stored sync state. The
+        changes are synced in pages, the sync state is stored after the emails of a
+        page have been consumed, so an interrupted sync continues with the next
+        page. Without sync state, only emails received after the date are returned"""
+        state = self.controller.get_folder_sync_state(self.email, folder.id)
+        sync_state = state.sync_state if state else None
+        if sync_state is None:
+            # all items of the folder are reported as created
+            self.controller.remove_item_locations(self.email, folder.id)
+            known = {}
+        else:
+            known = self.controller.get_item_locations(self.email, folder.id)
+            date = None
+        if date is not None:
+            date = date.astimezone(UTC)
+
+        two_phase = self.fetch_workers > 1
+        only_fields = EXCHANGE_SYNC_FIELDS if two_phase else EXCHANGE_EMAIL_FIELDS
+        last_page = False
+        while not last_page:
+            changes, sync_state, last_page = self.scheduler.call(
+                self._sync_page, folder, sync_state, only_fields
+            )
+            yield from self._apply_changes(folder, changes, known, date)
+            if flush is not None:
+                # the emails of the page are stored before the new sync state
+                flush()
+            self.controller.update_folder_sync_state(
+                self.email, folder.id, sync_state=sync_state
+            )
+
+    def _sync_page(
+        self, folder, sync_state: str, only_fields: tuple[str, ...]
+    ) -> tuple[list[tuple[str, object]], str, bool]:
+        """returns the next page of changes of the folder after the sync state, the
+        new sync state and whether it was the last page"""
+        for field in only_fields:
+            folder.validate_item_field(field=field, version=self.acc.version)
+        additional_fields = {
+            field
+            for field in folder.normalize_fields(fields=only_fields)
+            if not field.field.is_attribute
+        }
+        service = SyncFolderItems(account=self.acc)
+        changes = list(
+            service.call(
+                folder=folder,
+                shape=ID_ONLY,
+                additional_fields=additional_fields,
+                sync_state=sync_state,
+                ignore=None,
+                max_changes_returned=EXCHANGE_SYNC_PAGE_SIZE,
+                sync_scope=None,
+            )
+        )
+        return (
+            changes,
+            service.sync_state,
+            # the same sync state is returned, if there are no further changes
+            service.includes_last_item_in_range or service.sync_state == sync_state,
+        )
+
+    def _apply_changes(
+        self, folder, changes: list, known: dict[str, str], date: datetime
+    ) -> Iterator[Email]:
+        """yields the created emails and stores the read state and the location of
+        the changed items. known (item id -> message id) is updated. With a date,
+        only emails received after it are returned"""
+        two_phase = self.fetch_workers > 1
+        created = {}
+        fetch = []
+        removed = []
+        read = []
+        unread = []
+        for change_type, item in changes:
+            if change_type == "delete":
+                if item.id in created:
+                    del created[item.id]
+                elif item.id in known:
+                    removed.append(item.id)
+            elif change_type == "read_flag_change":
+                item_id, is_read = item
+                if item_id.id in known:
+                    (read if is_read else unread).append(known[item_id.id])
+            elif not isinstance(item, Message) or not item.message_id:
+                continue
+            elif item.id in known:
+                # update: only the read state is stored
+                (read if item.is_read else unread).append(known[item.id])
+            elif item.id not in created:
+                created[item.id] = item.message_id
+                if date and item.datetime_received < date:
+                    # received before the last refresh without sync state
+                    continue
+                if two_phase:
+                    fetch.append((item.id, item.changekey))
+                else:
+                    yield from self._get_email_exchange(item)
+
+        # items, that were deleted again during the sync, are left out
+        fetch = [ids for ids in fetch if ids[0] in created]
+        for item, attachments in self._fetch_items(fetch):
+            yield from self._get_email_exchange(item, attachments)
+
+        self.controller.update_read_state(read, True)
+        self.controller.update_read_state(unread, False)
+        if removed:
+            self.controller.remove_item_locations(self.email, folder.id, removed)
+            for item_id in removed:
+                known.pop(item_id, None)
+        if created:
+            self.controller.add_item_locations(self.email, folder.id, created)
+            known.update(created)
+
+    def _fetch_items(
+        self, ids: list[tuple[str, str]]
+    ) -> Iterator[tuple[Message, list[Attachment]]]:
+        """downloads the items with the given ids and changekeys and their
+        attachments in batches with fetch_workers threads. At most
+        2 * fetch_workers downloaded batches are waiting to be processed"""
+        if not ids:
+            return
+        batches = [
+            ids[start : start + self.fetch_batch_size]
+            for start in range(0, len(ids), self.fetch_batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            pending = deque()
+            try:
+                for batch in batches:
+                    pending.append(executor.submit(self._fetch_batch, batch))
+                    if len(pending) >= 2 * self.fetch_workers:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _fetch_batch(
+        self, ids: list[tuple[str, str]]
+    ) -> list[tuple[Message, list[Attachment]]]:
+        """downloads the items with one GetItem request and stores their
+        attachments. Runs in the worker threads of _fetch_items"""
+        with _translate_errors():
+            items = self.scheduler.call(self._get_batch_items, ids)
+            # the attachments of an item are downloaded again, if the server is busy
+            return [
+                (item, self.scheduler.call(self._store_attachments, item))
+                for item in items
+            ]
+
+    def _get_batch_items(self, ids: list[tuple[str, str]]) -> list[Message]:
+        """the GetItem request of _fetch_batch. It is repeated by the scheduler, if
+        any item of the response is ErrorServerBusy, so no attachment is stored
+        before the whole response has arrived"""
+        items = list(self.acc.fetch(ids=ids, only_fields=EXCHANGE_EMAIL_FIELDS))
+        for item in items:
+            if isinstance(item, exch_errors.ErrorServerBusy):
+                raise item
+        # items, that were deleted in the meantime, are returned as errors
+        return [item for item in items if isinstance(item, Message)]
+
+    def _store_attachments(self, item: Message) -> list[Attachment]:
         attachments = []
         for attachment in item.attachments:
             if isinstance(attachment, FileAttachment):
-                attachments += [
-                    safe_file(attachment.name, attachment.content, item.message_id)
-                ]
+                # streams the content from the server instead of loading it at once
+                with attachment.fp as fp:
+                    chunks = iter(lambda: fp.read(CHUNK_SIZE), b"")
+                    attachments += [
+                        safe_file(
+                            attachment.name,
+                            chunks,
+                            store=self.controller.attachment_store,
+                        )
+                    ]
+        return attachments
+
+    @error_handler
+    def _get_email_exchange(self, item, attachments: list[Attachment] = None):
+        """attachments: the already stored attachments of the item"""
+        if attachments is None:
+            attachments = self._store_attachments(item)
 
         ews_datetime_str = item.datetime_received.astimezone()
         parsed_datetime = datetime.fromisoformat(
@@ -608,6 +1687,7 @@ class ExchangeProtocol(ProtocolTemplate):
                 date=parsed_datetime,
                 controller=self.controller,
                 html_files=html,
+                read=item.is_read,
             )
         ]
 
@@ -620,84 +1700,246 @@ def create_email(
     sender: str,
     subject: str,
     body: str,
-    attachments: list[str],
+    attachments: list[Attachment],
     to_recipients: list[str],
     cc_recipients: list[str],
     bcc_recipients: list[str],
     date: datetime,
     controller: "EmailController",  # type: ignore
     html_files: list[str] = None,
+    read: bool = None,
 ) -> Email:
-    sender_contact = controller.get_contact(sender)
-    recipients = [
-        EmailReception(
-            contact=controller.get_contact(recipient[1], recipient[0]),
-            kind=RecipientKind.to,
-        )
-        for recipient in to_recipients
+    recipient_kinds = [
+        (RecipientKind.to, to_recipients),
+        (RecipientKind.cc, cc_recipients or []),
+        (RecipientKind.bcc, bcc_recipients or []),
     ]
-    if cc_recipients:
-        recipients += [
-            EmailReception(
-                contact=controller.get_contact(recipient[1], recipient[0]),
-                kind=RecipientKind.cc,
-            )
-            for recipient in cc_recipients
-        ]
-    if bcc_recipients:
-        recipients += [
-            EmailReception(
-                contact=controller.get_contact(recipient[1], recipient[0]),
-                kind=RecipientKind.bcc,
-            )
-            for recipient in bcc_recipients
+    # all contacts of the email are looked up (and created) at once
+    contacts = controller.contacts.resolve(
+        [(sender, None)]
+        + [
+            (recipient[1], recipient[0])
+            for _, kind_recipients in recipient_kinds
+            for recipient in kind_recipients
         ]
+    )
+    # the ids are set instead of the contacts, so the emails are not linked to each
+    # other through the relationships of the contacts
+    recipients = [
+        EmailReception(contact_id=contacts[recipient[1]], kind=kind)
+        for kind, kind_recipients in recipient_kinds
+        for recipient in kind_recipients
+    ]
 
     email = Email(
         message_id=uid,
-        sender=sender_contact,
+        sender_id=contacts[sender],
         subject=subject,
         body=body,
         recipients=recipients,
         date=date,
+        read=read,
     )
 
-    attachments_class = [
-        Attachment(filename=filename, email=email) for filename in attachments
-    ]
-
-    email.attachments = attachments_class
+    email.attachments = attachments
 
     return email
 
 
-def safe_file(filename: str, content: bytes, message_id: str) -> str:
-    ordner_path = os.path.abspath(os.path.join("remail", "database", "attachments"))
-    message_path = os.path.join(
-        ordner_path, secure_filename(message_id).replace(".", "_")
+def safe_file(
+    filename: str,
+    content: bytes | str | Iterator[bytes],
+    encoding: str = None,
+    store: AttachmentStore = attachment_store,
+) -> Attachment:
+    """stores the attachment in the attachment store and returns the attachment
+    object referencing the stored content. content can be given as chunks, encoding
+    is the transfer encoding (eg: base64) of the content, it is decoded while
+    writing (see AttachmentWriter)"""
+    path, sha256, size = store.put(content, encoding)
+    if path:
+        os.chmod(path, rwx2dec("rwxrw-r--"))
+    return Attachment(filename=path, name=filename, sha256=sha256, size=size)
+
+
+def get_message_id(header: email.message.Message) -> Optional[str]:
+    """returns the Message-ID of the message without the whitespace of folded
+    headers, so the ids of the emails and of the location index are the same"""
+    message_id = header["Message-Id"]
+    return message_id.strip() if message_id else None
+
+
+def parse_message(raw: bytes) -> ParsedMessage:
+    """parses the raw message, runs in the processes of the parse_pool"""
+    email_message = email.message_from_bytes(raw)
+    attachments = []
+    html_parts = []
+    body = None
+    if email_message.is_multipart():
+        # iter over all parts
+        for part in email_message.walk():
+            ctype = part.get_content_type()
+            cdispo = str(part.get("Content-Disposition"))
+
+            # get attachments part
+            if part.get_content_disposition() == "attachment":
+                filename = part.get_filename()
+                # attachments are stored later while they are decoded
+                if filename:
+                    content, encoding = get_encoded_payload(part)
+                    attachments.append((decode_filename(filename), content, encoding))
+
+            # get HTML parts
+            if part.get_content_type() == "text/html":
+                html_content = part.get_payload(decode=True).decode(
+                    part.get_content_charset() or "utf-8", errors="replace"
+                )
+                html_parts.append(html_content)
+
+            # get plain text from email
+            if ctype == "text/plain" and "attachment" not in cdispo:
+                body = part.get_payload(decode=True).decode(
+                    part.get_content_charset() or "utf-8", errors="replace"
+                )
+
+    # get plain if no multipart
+    else:
+        body = email_message.get_payload(decode=True).decode(
+            email_message.get_content_charset() or "utf-8", errors="replace"
+        )
+
+    return parse_header(email_message, body, html_parts, attachments)
+
+
+def parse_header(
+    email_message: email.message.Message,
+    body: Optional[str],
+    html_parts: list[str],
+    attachments: list[tuple[str, str | bytes, Optional[str]]],
+) -> ParsedMessage:
+    """combines the header fields of the message with the already extracted
+    contents"""
+    x = getaddresses([email_message["From"]])
+    saddr = x[0][1]
+    return ParsedMessage(
+        message_id=get_message_id(email_message),
+        sender=saddr,
+        subject=email_message["Subject"],
+        body=body,
+        html_parts=html_parts,
+        attachments=attachments,
+        to_recipients=[
+            (name, addr)
+            for name, addr in getaddresses([email_message["To"]])
+            if addr and addr.lower() != "none"
+        ],
+        cc_recipients=[
+            (name, addr)
+            for name, addr in getaddresses([email_message["Cc"]])
+            if addr and addr.lower() != "none"
+        ],
+        bcc_recipients=[
+            (name, addr)
+            for name, addr in getaddresses([email_message["Bcc"]])
+            if addr and addr.lower() != "none"
+        ],
+        date=parsedate_to_datetime(email_message["Date"]).astimezone(timezone("UTC")),
+    )
+
+
+def get_encoded_payload(part: email.message.Message) -> tuple[str | bytes, str]:
+    """returns the payload of the part still in its transfer encoding together with
+    the encoding, so it is only decoded while it is written to the disk"""
+    encoding = str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+    if part.is_multipart():
+        # attached emails (message/rfc822) are stored as they are
+        return b"".join(sub_part.as_bytes() for sub_part in part.get_payload()), None
+    if encoding in STREAMED_ENCODINGS:
+        return part.get_payload(), encoding
+    return part.get_payload(decode=True), None
+
+
+def decode_filename(filename: str) -> str:
+    """decodes a file name given as encoded word (eg: "=?utf-8?q?b=C3=A4r.pdf?=")"""
+    file, encoding = decode_header(filename)[0]
+    if isinstance(file, bytes):
+        return file.decode(encoding or "utf-8", errors="replace")
+    return file
+
+
+def get_message_parts(
+    body,
+) -> tuple[list[tuple[str, str, bytes, str]], list[tuple[str, str, int]]]:
+    """splits the BODYSTRUCTURE of a message into the text parts
+    (part id, content type, transfer encoding, charset) and the attachments
+    (part id, file name, size)"""
+    if not body.is_multipart:
+        # like a fully downloaded message the whole content is the body
+        return [("1", "text/plain", body[5], _get_param(body[2], "CHARSET"))], []
+
+    texts = []
+    attachments = []
+    for part_id, part in _walk_body(body):
+        content_type = f"{part[0].decode()}/{part[1].decode()}".lower()
+        # the position of the disposition depends on the content type (RFC 3501)
+        if content_type == "message/rfc822":
+            disposition_index = 11
+        elif content_type.startswith("text/"):
+            disposition_index = 9
+        else:
+            disposition_index = 8
+        disposition = part[disposition_index] if len(part) > disposition_index else None
+        if disposition and disposition[0].lower() == b"attachment":
+            name = _get_param(disposition[1], "FILENAME") or _get_param(part[2], "NAME")
+            if name:
+                attachments.append((part_id, decode_filename(name), part[6]))
+        elif content_type in ("text/plain", "text/html"):
+            texts.append(
+                (part_id, content_type, part[5], _get_param(part[2], "CHARSET"))
+            )
+    return texts, attachments
+
+
+def _walk_body(body, part_id: str = "") -> Iterator[tuple[str, tuple]]:
+    """yields the MIME part id and BODYSTRUCTURE of all single parts"""
+    for number, part in enumerate(body[0], start=1):
+        sub_part_id = f"{part_id}.{number}" if part_id else str(number)
+        if part.is_multipart:
+            yield from _walk_body(part, sub_part_id)
+        else:
+            yield sub_part_id, part
+
+
+def _get_param(params: tuple, name: str) -> Optional[str]:
+    """returns a parameter of a BODYSTRUCTURE parameter list like
+    (b"CHARSET", b"utf-8"), RFC 2231 encoded values (name*) are decoded"""
+    if not params:
+        return None
+    values = {
+        key.decode().upper(): value for key, value in zip(params[::2], params[1::2])
+    }
+    if values.get(name) is not None:
+        return values[name].decode(errors="replace")
+    if values.get(f"{name}*") is not None:
+        return collapse_rfc2231_value(
+            decode_rfc2231(values[f"{name}*"].decode(errors="replace"))
+        )
+    return None
+
+
+def decode_part(content: bytes, encoding: bytes, charset: str = None) -> str:
+    """decodes the content of a text part downloaded with BODY[part id]"""
+    part = email.message_from_bytes(
+        b"Content-Transfer-Encoding: " + (encoding or b"7bit") + b"\r\n\r\n" + content
     )
-    max_size = 200 * 1024 * 1024  # muss noch von wo anders bestimmt werden 10 MB
-    if len(content) > max_size:
-        raise BufferError(f"File size exceeds limit of {max_size} bytes")
-    if not os.path.exists(ordner_path):
-        os.mkdir(ordner_path)
-    if not os.path.exists(message_path):
-        os.mkdir(message_path)
-
-    name, ending = os.path.splitext(filename)
-    no_dots = name.replace(".", "")[:50] + ending
-    safe_filename = secure_filename(no_dots.strip())
-    if not safe_filename:
-        raise ValueError("Invalid filename")
-    filepath = os.path.join(message_path, safe_filename)
+    content = part.get_payload(decode=True)
     try:
-        with open(filepath, "wb") as f:
-            f.write(content)
-        os.chmod(filepath,rwx2dec("rwxrw-r--"))
-        return filepath
-    except Exception as e:
-        raise e
-    
+        return content.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        # unknown charset
+        return content.decode("utf-8", errors="replace")
+
+
 def rwx2dec(string):
     if len(string) != 9:
         return False
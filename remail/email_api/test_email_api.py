@@ -1,14 +1,90 @@
-from remail.database.models import Email, EmailReception, Contact, RecipientKind
-from remail.email_api.service import ImapProtocol, ExchangeProtocol
+from remail.database.models import (
+    Email,
+    EmailReception,
+    Contact,
+    RecipientKind,
+    FolderSyncState,
+    Attachment,
+    Protocol,
+    User,
+)
+from remail.database.migrations import migrate
+from remail.email_api.service import (
+    create_email,
+    ImapProtocol,
+    ExchangeProtocol,
+    EXCHANGE_EMAIL_FIELDS,
+    EXCHANGE_ID_PAGE_SIZE,
+    EXCHANGE_SYNC_FIELDS,
+    EXCHANGE_SYNC_PAGE_SIZE,
+)
+from remail.email_api.push import ExchangeStreamingListener, ImapIdleListener
+from remail.email_api.pool import ConnectionPool
+import remail.email_api.imap_raw as imap_raw
+from remail.database.contacts import ContactResolver
+from remail.database.bulk import bulk_insert
+from remail.email_api.folder_cache import ExchangeFolderCache
+from remail.email_api.throttling import ThrottlingScheduler
+import remail.email_api.email_errors as ee
+from remail.email_api.attachments import (
+    AttachmentStore,
+    AttachmentWriter,
+    PackedAttachmentStore,
+    iter_chunks,
+)
+from sqlmodel import Session, SQLModel, create_engine, select
+from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientError
+from imapclient.response_parser import parse_fetch_response
 import remail.email_api.credentials_helper as ch
+from benchmarks.mailbox import MailboxGenerator, MailboxSpec
+from benchmarks.standin import ImapStandIn, MailStore, SmtpStandIn
+from benchmarks.sync_benchmark import ACCOUNT, Benchmark
+import base64
+import os
+import gc
+import hashlib
+import quopri
+import smtplib
+import threading
+import pytest
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
+import multiprocessing
 from datetime import datetime
 from email.utils import format_datetime
 from email.message import EmailMessage
-from exchangelib import Message, EWSDateTime, Mailbox
+from exchangelib import (
+    DELEGATE,
+    Account,
+    Build,
+    Configuration,
+    Credentials,
+    EWSDateTime,
+    Mailbox,
+    Message,
+    Version,
+)
+from exchangelib import errors as exch_errors
+from exchangelib.properties import (
+    ItemId,
+    MovedEvent,
+    NewMailEvent,
+    Notification,
+    OldParentFolderId,
+    ParentFolderId,
+    StatusEvent,
+)
+from exchangelib.folders import Inbox, Root
+from exchangelib.items import MOVE_TO_DELETED_ITEMS
+from exchangelib.services.common import EWSService
+from exchangelib.util import DummyResponse, xml_to_str
 from pytz import timezone
+from sqlalchemy import BigInteger, event, inspect
+from sqlalchemy.exc import DBAPIError
 
-from remail.controller import controller
+from remail.controller import _safe_file_name, controller
 
 
 @contextmanager
@@ -28,6 +104,25 @@ def email_test_context():
         exchange.logout()
 
 
+def bind_imap_fetch_methods(mocked_self):
+    mocked_self.pool = None
+    mocked_self.lazy_attachments = False
+    mocked_self.parse_pool = None
+    for name in (
+        "iter_emails",
+        "_get_emails",
+        "_fetch_batches",
+        "_get_fetch_batches",
+        "_fetch_messages",
+        "_create_emails",
+        "_create_email",
+        "_create_lazy_email",
+        "_build_email",
+        "_save_batch",
+    ):
+        setattr(mocked_self, name, getattr(ImapProtocol, name).__get__(mocked_self))
+
+
 def test_get_emails_with_mocking_imap(mocker):
     mocked_imap = mocker.Mock()
     mocked_imap.list_folders.return_value = [
@@ -45,16 +140,29 @@ def test_get_emails_with_mocking_imap(mocker):
     email_message["To"] = "recipient@example.com"
     email_message["Date"] = "Mon, 01 Jan 2024 12:00:00 +0000"
     email_message.set_content("This is the email body.")
-    mocked_imap.fetch.return_value = {1: {b"RFC822": email_message.as_bytes()}}
+    mocked_imap.fetch.side_effect = lambda uids, data: {
+        1: {
+            b"BODY[]": email_message.as_bytes(),
+            b"FLAGS": (b"\\Seen",),
+            b"RFC822.SIZE": 100,
+        }
+    }
+
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 1, b"UIDNEXT": 2}
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(controller, "remove_message_locations")
+    add_locations = mocker.patch.object(controller, "add_message_locations")
 
     mocked_self = mocker.Mock()
     mocked_self.IMAP = mocked_imap
     mocked_self.controller = controller
     mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
 
     # Testmethoden patchen
     mocked_self._get_folder_names = ImapProtocol._get_folder_names.__get__(mocked_self)
-    mocked_self._get_emails = ImapProtocol._get_emails.__get__(mocked_self)
+    bind_imap_fetch_methods(mocked_self)
 
     # Testdaten vorbereiten
     date_filter = datetime(2024, 1, 1)
@@ -67,6 +175,7 @@ def test_get_emails_with_mocking_imap(mocker):
     assert result[0].message_id == "test-id"
     assert result[0].subject == "Test Subject"
     assert result[0].body == "This is the email body.\n"
+    assert result[0].read
 
     # Überprüfen, ob _get_folder_names korrekt gearbeitet hat
     mocked_imap.list_folders.assert_called_once()
@@ -76,6 +185,1415 @@ def test_get_emails_with_mocking_imap(mocker):
     mocked_imap.select_folder.assert_any_call("INBOX")
     mocked_imap.select_folder.assert_any_call("SENT")
 
+    # Überprüfen, ob der Sync-Zustand pro Ordner gespeichert wurde
+    update_state.assert_any_call(
+        "recipient@example.com", "INBOX", uidvalidity=1, last_uid=1
+    )
+    add_locations.assert_any_call("recipient@example.com", "INBOX", {1: "test-id"})
+
+
+def test_get_emails_parse_pool_imap(mocker):
+    def create_message(number):
+        email_message = EmailMessage()
+        email_message["Message-Id"] = f"<id-{number}>"
+        email_message["From"] = "sender@example.com"
+        email_message["To"] = "recipient@example.com"
+        email_message["Subject"] = f"Subject {number}"
+        email_message["Date"] = "Mon, 01 Jan 2024 12:00:00 +0000"
+        email_message.set_content(f"Body {number}")
+        email_message.add_attachment(
+            b"attachment", maintype="text", subtype="plain", filename="a.txt"
+        )
+        return email_message.as_bytes()
+
+    count = 20
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 1, b"UIDNEXT": count + 1}
+    mocked_imap.search.return_value = list(range(1, count + 1))
+    mocked_imap.fetch.side_effect = lambda uids, data: {
+        uid: {
+            b"BODY[]": create_message(uid),
+            b"FLAGS": (),
+            b"RFC822.SIZE": 100,
+        }
+        for uid in uids
+    }
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(controller, "remove_message_locations")
+    mocker.patch.object(controller, "add_message_locations")
+    store = mocker.patch.object(controller, "attachment_store")
+    store.put.return_value = (None, "digest", 10)
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.user_username = "recipient@example.com"
+    bind_imap_fetch_methods(mocked_self)
+
+    with ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    ) as parse_pool:
+        mocked_self.parse_pool = parse_pool
+        result = list(ImapProtocol._get_emails(mocked_self, "INBOX"))
+
+    # the order of the messages is kept
+    assert [mail.subject for mail in result] == [
+        f"Subject {number}" for number in range(1, count + 1)
+    ]
+    assert result[0].body == "Body 1\n"
+    assert [attachment.name for attachment in result[0].attachments] == ["a.txt"]
+
+
+def test_get_emails_incremental_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 7, b"UIDNEXT": 43}
+    # "UID 42:*" also returns the newest already synced message
+    mocked_imap.search.return_value = [41]
+    mocked_imap.fetch.return_value = {}
+
+    state = FolderSyncState(
+        account="recipient@example.com", folder="INBOX", uidvalidity=7, last_uid=41
+    )
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=state)
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(controller, "add_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.user_username = "recipient@example.com"
+    bind_imap_fetch_methods(mocked_self)
+
+    result = list(
+        ImapProtocol._get_emails(
+            mocked_self, "INBOX", datetime(2024, 1, 1, tzinfo=timezone("UTC"))
+        )
+    )
+
+    assert result == []
+    mocked_imap.search.assert_called_once_with(["UID", "42:*"])
+    mocked_imap.fetch.assert_not_called()
+    update_state.assert_called_once_with(
+        "recipient@example.com", "INBOX", uidvalidity=7, last_uid=42
+    )
+
+
+def test_get_emails_parallel_imap(mocker):
+    def create_client(folder):
+        email_message = EmailMessage()
+        email_message["Message-Id"] = f"<{folder}-id>"
+        email_message["From"] = "sender@example.com"
+        email_message["To"] = "recipient@example.com"
+        email_message["Date"] = "Mon, 01 Jan 2024 12:00:00 +0000"
+        email_message.set_content("This is the email body.")
+        client = mocker.Mock()
+        client.select_folder.return_value = {b"UIDVALIDITY": 1, b"UIDNEXT": 2}
+        client.search.return_value = [1]
+        client.fetch.side_effect = lambda uids, data: {
+            1: {b"BODY[]": email_message.as_bytes(), b"RFC822.SIZE": 100}
+        }
+        return client
+
+    clients = [create_client("INBOX"), create_client("SENT")]
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(controller, "remove_message_locations")
+    mocker.patch.object(controller, "add_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    bind_imap_fetch_methods(mocked_self)
+    mocked_self.folder_workers = 2
+    mocked_self.pool = mocker.Mock()
+    mocked_self.pool.imap.return_value.__enter__ = mocker.Mock(side_effect=clients)
+    mocked_self.pool.imap.return_value.__exit__ = mocker.Mock(return_value=False)
+    mocked_self._get_folder_names.return_value = ["INBOX", "SENT"]
+    mocked_self._get_emails_parallel = ImapProtocol._get_emails_parallel.__get__(
+        mocked_self
+    )
+
+    result = list(ImapProtocol.iter_emails(mocked_self))
+
+    # every folder was fetched with an own connection of the pool
+    assert sorted(mail.message_id for mail in result) == ["<INBOX-id>", "<SENT-id>"]
+    assert mocked_self.pool.imap.call_count == 2
+    mocked_self.IMAP.select_folder.assert_not_called()
+    update_state.assert_any_call(
+        "recipient@example.com", "INBOX", uidvalidity=1, last_uid=1
+    )
+    update_state.assert_any_call(
+        "recipient@example.com", "SENT", uidvalidity=1, last_uid=1
+    )
+
+
+def test_get_emails_parallel_pooled_connections_imap(database):
+    store = MailStore(qresync=True)
+    store.add_account(ACCOUNT, "password", ("INBOX", "Archive", "Sent"))
+    MailboxGenerator(MailboxSpec(messages=6, attachment_ratio=0), ACCOUNT).fill(store)
+    server = ImapStandIn(store).start()
+    pool = ConnectionPool(max_connections=3, ssl=False, imap_port=server.port)
+    protocol = ImapProtocol(
+        ACCOUNT, "password", "127.0.0.1", controller, pool=pool, folder_workers=2
+    )
+    try:
+        protocol.login()
+        assert len(list(protocol.iter_emails())) == 6
+        protocol.logout()
+
+        # the connections of the folder workers are handed out by login() too, so
+        # QRESYNC has to be enabled on all of them
+        clients = [
+            pool.acquire_imap(
+                ACCOUNT, "password", "127.0.0.1", ImapProtocol._enable_extensions
+            )
+            for _ in range(3)
+        ]
+        for client in clients:
+            client.select_folder("INBOX")
+            # BAD without ENABLE QRESYNC
+            imap_raw.fetch_changes(client, 1)
+            client.close_folder()
+            pool.release_imap(ACCOUNT, "127.0.0.1", client)
+    finally:
+        pool.close_all()
+        server.stop()
+
+
+def test_get_emails_parallel_failure_imap(mocker):
+    failing = mocker.Mock()
+    failing.select_folder.side_effect = IMAPClientError("connection lost")
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+
+    mocked_self = mocker.Mock()
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    bind_imap_fetch_methods(mocked_self)
+    mocked_self.folder_workers = 2
+    mocked_self.pool = mocker.Mock()
+    mocked_self.pool.imap.return_value.__enter__ = mocker.Mock(return_value=failing)
+    mocked_self.pool.imap.return_value.__exit__ = mocker.Mock(return_value=False)
+    mocked_self._get_folder_names.return_value = ["INBOX", "SENT", "Archive"]
+    mocked_self._get_emails_parallel = ImapProtocol._get_emails_parallel.__get__(
+        mocked_self
+    )
+
+    with pytest.raises(ee.ServerConnectionFail):
+        list(ImapProtocol.iter_emails(mocked_self))
+
+    # the folder that was still waiting is not fetched anymore
+    assert mocker.call("Archive") not in failing.select_folder.call_args_list
+    update_state.assert_not_called()
+
+
+def test_get_fetch_batches_imap(mocker):
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP.fetch.return_value = {
+        1: {b"RFC822.SIZE": 6 * 1024 * 1024},
+        2: {b"RFC822.SIZE": 6 * 1024 * 1024},
+        3: {b"RFC822.SIZE": 6 * 1024 * 1024},
+        5: {b"RFC822.SIZE": 1024},
+    }
+
+    # UID 4 was deleted in the meantime, the batches stay below 16 MB
+    batches = list(
+        ImapProtocol._get_fetch_batches(mocked_self, mocked_self.IMAP, [1, 2, 3, 4, 5])
+    )
+
+    assert batches == [[1, 2], [3, 5]]
+    mocked_self.IMAP.fetch.assert_called_once_with([1, 2, 3, 4, 5], ["RFC822.SIZE"])
+
+
+def test_get_emails_lazy_attachments_imap(mocker):
+    header = (
+        b"Message-Id: <lazy-id>\r\nFrom: sender@example.com\r\n"
+        b"To: recipient@example.com\r\nSubject: Report\r\n"
+        b"Date: Mon, 01 Jan 2024 12:00:00 +0000\r\n\r\n"
+    )
+    bodystructure = parse_fetch_response(
+        [
+            b'1 (UID 1 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL '
+            b'"QUOTED-PRINTABLE" 12 1 NIL NIL NIL NIL)("APPLICATION" "PDF" '
+            b'("NAME" "report.pdf") NIL NIL "BASE64" 4096 NIL ("ATTACHMENT" '
+            b'("FILENAME" "=?utf-8?q?B=C3=A4rbel.pdf?=")) NIL NIL) "MIXED" '
+            b'("BOUNDARY" "x") NIL NIL NIL))'
+        ],
+        True,
+    )[1][b"BODYSTRUCTURE"]
+
+    def fetch(uids, data):
+        if data == ["RFC822.SIZE"]:
+            return {1: {b"RFC822.SIZE": 5000}}
+        if data == ["BODY.PEEK[HEADER]", "BODYSTRUCTURE", "FLAGS"]:
+            return {
+                1: {
+                    b"BODY[HEADER]": header,
+                    b"BODYSTRUCTURE": bodystructure,
+                    b"FLAGS": (),
+                }
+            }
+        if data == ["BODY.PEEK[1]"]:
+            return {1: {b"BODY[1]": b"Gr=C3=BC=C3=9Fe"}}
+        raise AssertionError(f"unexpected fetch {data}")
+
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 1, b"UIDNEXT": 2}
+    mocked_imap.search.return_value = [1]
+    mocked_imap.fetch.side_effect = fetch
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(controller, "remove_message_locations")
+    mocker.patch.object(controller, "add_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.user_username = "recipient@example.com"
+    bind_imap_fetch_methods(mocked_self)
+    mocked_self.lazy_attachments = True
+
+    result = list(ImapProtocol._get_emails(mocked_self, "INBOX"))
+
+    assert len(result) == 1
+    assert result[0].body == "Grüße"
+    assert not result[0].read
+    [attachment] = result[0].attachments
+    assert attachment.filename is None
+    assert attachment.name == "Bärbel.pdf"
+    assert attachment.size == 4096
+    assert attachment.part_id == "2"
+
+
+def test_get_attachment_download_error(mocker):
+    mocker.patch.object(
+        controller, "_get_stored_attachment", side_effect=ee.ServerConnectionFail()
+    )
+
+    # the failed download is reported to the caller instead of returning None
+    with pytest.raises(ee.ServerConnectionFail):
+        controller.get_attachment_file(1)
+    with pytest.raises(ee.ServerConnectionFail):
+        controller.get_attachment_content(1)
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("report.pdf", "report.pdf"),
+        ("../report.pdf", "report.pdf"),
+        ("..\\..\\report.pdf", "report.pdf"),
+        ("..", "attachment"),
+        (None, "attachment"),
+    ],
+)
+def test_safe_file_name(name, expected):
+    assert _safe_file_name(name) == expected
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_get_attachment_file_lazy_imap(database, tmp_path, mocker, packed):
+    content = bytes(range(256)) * 40
+    message = EmailMessage()
+    message["From"] = "sender@example.com"
+    message["To"] = ACCOUNT
+    message["Subject"] = "Lazy"
+    message["Message-ID"] = "<lazy@example.com>"
+    message["Date"] = format_datetime(datetime(2024, 1, 1, tzinfo=timezone("UTC")))
+    message.set_content("Body")
+    # the name is chosen by the sender of the email
+    message.add_attachment(
+        content, maintype="application", subtype="pdf", filename="../report.pdf"
+    )
+    store = MailStore()
+    store.add_account(ACCOUNT, "password")
+    store.folder(ACCOUNT, "INBOX").append(message.as_bytes())
+    server = ImapStandIn(store).start()
+
+    mocker.patch("remail.controller.keyring.get_password", return_value="password")
+    mocker.patch.object(
+        controller, "pool", ConnectionPool(ssl=False, imap_port=server.port)
+    )
+    mocker.patch.object(controller, "lazy_attachments", True)
+    mocker.patch.object(
+        controller,
+        "attachment_store",
+        PackedAttachmentStore(database, tmp_path)
+        if packed
+        else AttachmentStore(tmp_path),
+    )
+    mocker.patch.object(controller, "_attachment_files", None)
+    # the attachment is downloaded in several partial fetches
+    mocker.patch("remail.email_api.service.DOWNLOAD_CHUNK_SIZE", 1000)
+    with Session(database) as session:
+        session.add(
+            User(
+                name="User",
+                email=ACCOUNT,
+                protocol=Protocol.IMAP,
+                extra_information="127.0.0.1",
+            )
+        )
+        session.commit()
+    try:
+        controller.refresh_folder(ACCOUNT, "INBOX")
+        with Session(database) as session:
+            attachment = session.exec(select(Attachment)).one()
+        assert (attachment.filename, attachment.sha256) == (None, None)
+
+        path = controller.get_attachment_file(attachment.id)
+        with open(path, "rb") as file:
+            assert hashlib.sha256(file.read()).hexdigest() == (
+                hashlib.sha256(content).hexdigest()
+            )
+        assert bytes(controller.get_attachment_content(attachment.id)) == content
+    finally:
+        controller.pool.close_all()
+        server.stop()
+    with Session(database) as session:
+        attachment = session.get(Attachment, attachment.id)
+    assert attachment.sha256 == hashlib.sha256(content).hexdigest()
+    # the copy named like the attachment stays in the temporary folder of the
+    # controller, the stored file is named after the digest
+    assert os.path.basename(path) == "report.pdf"
+    assert os.path.dirname(os.path.dirname(path)) == controller._attachment_files.name
+    controller._attachment_files.cleanup()
+    assert not os.path.exists(path)
+    assert controller.attachment_store.contains(attachment.sha256)
+
+
+def test_get_deleted_emails_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 7}
+    mocked_imap.search.return_value = [1, 3]
+    mocked_imap.fetch.return_value = {
+        3: {b"BODY[HEADER.FIELDS (MESSAGE-ID)]": b"Message-Id: <new-id>\r\n\r\n"}
+    }
+
+    state = FolderSyncState(
+        account="recipient@example.com", folder="INBOX", uidvalidity=7, last_uid=2
+    )
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=state)
+    mocker.patch.object(
+        controller,
+        "get_message_locations",
+        return_value={1: "<kept-id>", 2: "<deleted-id>"},
+    )
+    remove_locations = mocker.patch.object(controller, "remove_message_locations")
+    add_locations = mocker.patch.object(controller, "add_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._get_folder_names.return_value = ["INBOX"]
+    mocked_self._get_message_ids = ImapProtocol._get_message_ids.__get__(mocked_self)
+
+    result = ImapProtocol.get_deleted_emails(
+        mocked_self, ["<kept-id>", "<deleted-id>", "<new-id>"]
+    )
+
+    assert result == ["<deleted-id>"]
+    # only the Message-ID header of the unknown UID is fetched
+    mocked_imap.fetch.assert_called_once_with(
+        [3], ["BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"]
+    )
+    remove_locations.assert_called_once_with("recipient@example.com", "INBOX", [2])
+    add_locations.assert_called_once_with(
+        "recipient@example.com", "INBOX", {3: "<new-id>"}
+    )
+
+
+def test_get_deleted_emails_of_folders_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 7}
+    mocked_imap.search.return_value = [1]
+
+    state = FolderSyncState(
+        account="recipient@example.com", folder="INBOX", uidvalidity=7, last_uid=2
+    )
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=state)
+    mocker.patch.object(
+        controller,
+        "get_message_locations",
+        side_effect=lambda account, folder: (
+            {1: "<kept-id>", 2: "<deleted-id>"} if folder == "INBOX" else {}
+        ),
+    )
+    mocker.patch.object(controller, "remove_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._get_folder_names.return_value = ["INBOX", "Archive"]
+    mocked_self._get_message_ids = ImapProtocol._get_message_ids.__get__(mocked_self)
+
+    result = ImapProtocol.get_deleted_emails(
+        mocked_self, ["<kept-id>", "<deleted-id>", "<archived-id>"], folders=["INBOX"]
+    )
+
+    # the emails of the not indexed Archive folder are kept
+    assert result == ["<deleted-id>"]
+    mocked_imap.select_folder.assert_called_once_with("INBOX", readonly=True)
+
+
+def test_get_deleted_emails_unsynced_folder_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {b"UIDVALIDITY": 7, b"HIGHESTMODSEQ": 20}
+    mocked_imap.search.return_value = [3]
+    # folded header
+    mocked_imap.fetch.return_value = {
+        3: {b"BODY[HEADER.FIELDS (MESSAGE-ID)]": b"Message-Id:\r\n <new-id>\r\n\r\n"}
+    }
+
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    mocker.patch.object(controller, "remove_message_locations")
+    add_locations = mocker.patch.object(controller, "add_message_locations")
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._get_folder_names.return_value = ["INBOX"]
+    mocked_self._get_message_ids = ImapProtocol._get_message_ids.__get__(mocked_self)
+
+    result = ImapProtocol.get_deleted_emails(mocked_self, ["<new-id>"])
+
+    assert result == []
+    add_locations.assert_called_once_with(
+        "recipient@example.com", "INBOX", {3: "<new-id>"}
+    )
+    # the location index is reused by the next check, the emails are still synced
+    update_state.assert_called_once_with(
+        "recipient@example.com",
+        "INBOX",
+        uidvalidity=7,
+        last_uid=None,
+        highest_modseq=20,
+    )
+
+
+def test_get_deleted_emails_qresync_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.select_folder.return_value = {
+        b"UIDVALIDITY": 7,
+        b"HIGHESTMODSEQ": 20,
+    }
+    mocked_imap._imap.uid.return_value = (
+        "OK",
+        [b"1 (UID 1 FLAGS (\\Seen) MODSEQ (15))"],
+    )
+    mocked_imap._imap.untagged_responses = {"VANISHED": [b"(EARLIER) 2:3"]}
+
+    state = FolderSyncState(
+        account="recipient@example.com",
+        folder="INBOX",
+        uidvalidity=7,
+        last_uid=3,
+        highest_modseq=10,
+    )
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=state)
+    mocker.patch.object(
+        controller,
+        "get_message_locations",
+        return_value={1: "<read-id>", 2: "<deleted-id>"},
+    )
+    remove_locations = mocker.patch.object(controller, "remove_message_locations")
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+    update_read = mocker.patch.object(controller, "update_read_state")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self._qresync = True
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._get_changes_since = ImapProtocol._get_changes_since.__get__(
+        mocked_self
+    )
+    mocked_self._update_read_state = ImapProtocol._update_read_state.__get__(
+        mocked_self
+    )
+
+    result = ImapProtocol._get_message_ids(mocked_self, "INBOX")
+
+    assert result == {"<read-id>"}
+    # flags and deleted messages are requested with one command, no full scan
+    mocked_imap._imap.uid.assert_called_once_with(
+        "FETCH", "1:*", "(FLAGS)", "(CHANGEDSINCE 10 VANISHED)"
+    )
+    mocked_imap.search.assert_not_called()
+    mocked_imap.fetch.assert_not_called()
+    update_read.assert_any_call(["<read-id>"], True)
+    remove_locations.assert_called_once_with("recipient@example.com", "INBOX", [2])
+    update_state.assert_called_once_with(
+        "recipient@example.com", "INBOX", highest_modseq=20
+    )
+
+
+def test_fetch_changes_imap():
+    # a real IMAPClient, whose imaplib connection is used
+    store = MailStore(qresync=True)
+    store.add_account("user@example.com", "password")
+    inbox = store.folder("user@example.com", "INBOX")
+    for number in range(3):
+        inbox.append(f"Message-Id: <id-{number}>\r\n\r\nbody\r\n".encode())
+    server = ImapStandIn(store).start()
+    client = IMAPClient("127.0.0.1", port=server.port, ssl=False)
+    try:
+        client.login("user@example.com", "password")
+        client.enable("QRESYNC")
+        modseq = client.select_folder("INBOX")[b"HIGHESTMODSEQ"]
+        client.add_flags([1], [b"\\Seen"])
+        client.delete_messages([2])
+        client.expunge([2])
+
+        assert imap_raw.is_supported(client)
+        assert imap_raw.has_selected_folder(client)
+        changed, vanished = imap_raw.fetch_changes(client, modseq)
+        assert changed[1][b"FLAGS"] == (b"\\Seen",)
+        assert list(changed) == [1]
+        assert vanished == [2]
+
+        client.close_folder()
+        assert not imap_raw.has_selected_folder(client)
+    finally:
+        client.logout()
+        server.stop()
+
+
+def test_standin_imap():
+    store = MailStore()
+    store.add_account(ACCOUNT, "password", ("INBOX", "Archive"))
+    generator = MailboxGenerator(
+        MailboxSpec(messages=4, folders=("INBOX",), attachment_ratio=1), ACCOUNT
+    )
+    generator.fill(store)
+    inbox = store.folder(ACCOUNT, "INBOX")
+    server = ImapStandIn(store).start()
+    client = IMAPClient("127.0.0.1", port=server.port, ssl=False)
+    try:
+        client.login(ACCOUNT, "password")
+        assert client.select_folder("INBOX")[b"EXISTS"] == 4
+        uids = client.search(["ALL"])
+        assert uids == [1, 2, 3, 4]
+        messages = client.fetch(uids, ["BODY.PEEK[]", "BODYSTRUCTURE"])
+        assert [messages[uid][b"BODY[]"] for uid in uids] == [
+            inbox.messages[uid].raw for uid in uids
+        ]
+        # the generated messages have attachments
+        assert messages[1][b"BODYSTRUCTURE"].is_multipart
+
+        # only fetching the body marks a message as read
+        client.add_flags([1], [b"\\Seen"])
+        client.fetch([3], ["BODY[]"])
+        assert client.search(["UNSEEN"]) == [2, 4]
+        client.move([2], "Archive")
+        assert inbox.uids() == [1, 3, 4]
+        assert client.folder_status("Archive", [b"MESSAGES"])[b"MESSAGES"] == 1
+    finally:
+        client.logout()
+        server.stop()
+
+
+def test_standin_smtp():
+    store = MailStore()
+    store.add_account(ACCOUNT, "password")
+    server = SmtpStandIn(store).start()
+    raw = b"Subject: Test\r\n\r\n.starts with a dot\r\n"
+    try:
+        with smtplib.SMTP("127.0.0.1", server.port) as smtp:
+            smtp.login(ACCOUNT, "password")
+            smtp.sendmail("sender@example.com", [ACCOUNT, "unknown@example.com"], raw)
+    finally:
+        server.stop()
+    # only the known account gets the message, without the dot stuffing
+    (message,) = store.folder(ACCOUNT, "INBOX").messages.values()
+    assert message.raw == raw
+
+
+def test_benchmark_measure(database, mocker):
+    store = MailStore()
+    store.add_account(ACCOUNT, "password", ("INBOX", "Archive"))
+    generator = MailboxGenerator(MailboxSpec(messages=10), ACCOUNT)
+    bench_controller = mocker.Mock(engine=database)
+    bench_controller.safe_email.side_effect = controller.safe_email
+    benchmark = Benchmark(bench_controller, store, generator)
+
+    size = generator.fill(store)
+    assert size == benchmark.mailbox_size()
+    assert benchmark.delete_on_server(3) == 3
+    assert benchmark.mailbox_size() < size
+
+    mail = create_email(
+        "<benchmark@example.com>",
+        "sender@example.com",
+        "Subject",
+        "Body",
+        [],
+        [("", ACCOUNT)],
+        [],
+        [],
+        datetime(2024, 1, 1),
+        controller,
+    )
+    benchmark.measure(
+        "store", lambda: bench_controller.safe_email([mail]), 1, 100, expected=1
+    )
+    result = benchmark.results["store"]
+    assert result["ok"]
+    assert (result["messages"], result["bytes"], result["stored_emails"]) == (1, 100, 1)
+    # the time of the database writes is measured
+    assert 0 < result["db_write_seconds"] <= result["seconds"]
+    assert result["peak_rss_bytes"] > 0
+
+
+def test_bulk_insert_datetimes(tmp_path):
+    engine = create_engine(f"duckdb:///{tmp_path / 'database.db'}")
+    # like a process started with TZ=America/New_York, DuckDB takes its time zone
+    # only once when it is loaded
+    event.listen(
+        engine,
+        "connect",
+        lambda connection, _: connection.execute("SET TimeZone = 'America/New_York'"),
+    )
+    SQLModel.metadata.create_all(engine)
+    dates = [
+        datetime(2024, 1, 1, 12),
+        timezone("Europe/Berlin").localize(datetime(2024, 1, 1, 12)),
+    ]
+
+    def create_user(name: str, date: datetime) -> dict:
+        return {
+            "name": name,
+            "email": f"{name}@example.com",
+            "protocol": Protocol.IMAP,
+            "extra_information": "",
+            "last_refresh": date,
+        }
+
+    with Session(engine) as session:
+        bulk_insert(
+            session,
+            User.__table__,
+            [create_user(f"bulk{number}", date) for number, date in enumerate(dates)],
+        )
+        session.add_all(
+            User(**create_user(f"orm{number}", date))
+            for number, date in enumerate(dates)
+        )
+        session.commit()
+        stored = dict(session.exec(select(User.name, User.last_refresh)).all())
+
+    # the same dates as stored by the ORM, naive ones keep their time
+    assert stored["bulk0"] == stored["orm0"] == datetime(2024, 1, 1, 12)
+    assert stored["bulk1"] == stored["orm1"] == datetime(2024, 1, 1, 6)
+
+
+def test_migrate_database(tmp_path):
+    engine = create_engine(f"duckdb:///{tmp_path / 'database.db'}")
+    with engine.begin() as connection:
+        # tables as created by older versions
+        for statement in (
+            "CREATE TABLE email (id INTEGER PRIMARY KEY, message_id VARCHAR NOT NULL)",
+            "CREATE TABLE foldersyncstate (id INTEGER PRIMARY KEY, folder VARCHAR,"
+            " uidvalidity INTEGER, last_uid INTEGER)",
+            "CREATE TABLE attachment (id INTEGER PRIMARY KEY, filename VARCHAR NOT NULL)",
+            "CREATE TABLE messagelocation (id INTEGER PRIMARY KEY, account VARCHAR,"
+            " uid INTEGER NOT NULL)",
+            "CREATE INDEX ix_messagelocation_account ON messagelocation (account)",
+            "INSERT INTO attachment VALUES (1, '/attachments/report.pdf')",
+            "CREATE TABLE contact (id INTEGER PRIMARY KEY, email_address VARCHAR)",
+        ):
+            connection.exec_driver_sql(statement)
+
+    # runs on every start
+    migrate(engine)
+    migrate(engine)
+
+    columns = {
+        table: {column["name"]: column for column in inspect(engine).get_columns(table)}
+        for table in ("email", "foldersyncstate", "attachment", "messagelocation")
+    }
+    assert "read" in columns["email"]
+    assert {"highest_modseq", "sync_state"} <= columns["foldersyncstate"].keys()
+    assert {"name", "size", "part_id", "sha256"} <= columns["attachment"].keys()
+    assert columns["attachment"]["filename"]["nullable"]
+    with engine.connect() as connection:
+        assert (
+            connection.exec_driver_sql("SELECT name FROM attachment").scalar()
+            == "report.pdf"
+        )
+    assert "item_id" in columns["messagelocation"]
+    assert columns["messagelocation"]["uid"]["nullable"]
+    # UIDs and MODSEQs don't fit into INTEGER
+    for table, column in (
+        ("foldersyncstate", "uidvalidity"),
+        ("foldersyncstate", "last_uid"),
+        ("foldersyncstate", "highest_modseq"),
+        ("messagelocation", "uid"),
+    ):
+        assert isinstance(columns[table][column]["type"], BigInteger)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO foldersyncstate (id, uidvalidity, last_uid, highest_modseq)"
+            " VALUES (1, 4294967295, 4294967295, 9223372036854775807)"
+        )
+    # the indexes are created again
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT index_name FROM duckdb_indexes() WHERE table_name = 'messagelocation'"
+        ).all() == [("ix_messagelocation_account",)]
+        assert connection.exec_driver_sql(
+            "SELECT is_unique FROM duckdb_indexes() WHERE table_name = 'contact'"
+        ).all() == [(True,)]
+
+
+def test_migrate_database_duplicate_contacts(tmp_path):
+    engine = create_engine(f"duckdb:///{tmp_path / 'database.db'}")
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_contact_email_address")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO contact (id, email_address) VALUES"
+            " (2, 'twice@example.com'), (1, 'twice@example.com')"
+        )
+
+    # the unique index is skipped, the first contact is used
+    migrate(engine)
+    assert ContactResolver(engine).get("twice@example.com").id == 1
+
+
+def test_mark_and_delete_emails_imap(mocker):
+    mocked_imap = mocker.Mock()
+    mocked_imap.has_capability.return_value = True
+    mocker.patch.object(
+        controller,
+        "get_locations_of_messages",
+        return_value=[("INBOX", 3, "<id-3>"), ("Archive", 8, "<id-8>")],
+    )
+    remove_locations = mocker.patch.object(controller, "remove_message_locations")
+    mocked_imap.folder_status.return_value = {b"UIDVALIDITY": 7}
+    mocker.patch.object(
+        controller,
+        "get_folder_sync_state",
+        return_value=FolderSyncState(uidvalidity=7, last_uid=8),
+    )
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.logged_in = True
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._locate_emails = ImapProtocol._locate_emails.__get__(mocked_self)
+    mocked_self._has_valid_uids = ImapProtocol._has_valid_uids.__get__(mocked_self)
+    mocked_self._get_folder_name_with_flags.return_value = ["Trash"]
+
+    ImapProtocol.mark_emails(mocked_self, ["<id-3>", "<id-8>"], True)
+    mocked_imap.add_flags.assert_has_calls(
+        [
+            mocker.call([3], [b"\\Seen"], silent=True),
+            mocker.call([8], [b"\\Seen"], silent=True),
+        ]
+    )
+
+    ImapProtocol.delete_emails(mocked_self, ["<id-3>", "<id-8>"])
+    mocked_imap.move.assert_has_calls(
+        [mocker.call([3], "Trash"), mocker.call([8], "Trash")]
+    )
+    remove_locations.assert_any_call("recipient@example.com", "INBOX", [3])
+    remove_locations.assert_any_call("recipient@example.com", "Archive", [8])
+
+    ImapProtocol.delete_emails(mocked_self, ["<id-3>", "<id-8>"], hard_delete=True)
+    mocked_imap.delete_messages.assert_has_calls([mocker.call([3]), mocker.call([8])])
+    # only the deleted UIDs are expunged (UIDPLUS)
+    mocked_imap.expunge.assert_has_calls([mocker.call([3]), mocker.call([8])])
+
+    # all emails were found in the index, nothing is searched on the server
+    mocked_imap.search.assert_not_called()
+
+
+def test_locate_emails_changed_uidvalidity_imap(mocker):
+    mocked_imap = mocker.Mock()
+    # the UIDs of the folder were reassigned since the last sync
+    mocked_imap.folder_status.return_value = {b"UIDVALIDITY": 8}
+    mocked_imap.search.return_value = [5]
+    mocker.patch.object(
+        controller,
+        "get_locations_of_messages",
+        return_value=[("INBOX", 3, "<id-3>")],
+    )
+    mocker.patch.object(
+        controller,
+        "get_folder_sync_state",
+        return_value=FolderSyncState(uidvalidity=7, last_uid=3),
+    )
+    remove_locations = mocker.patch.object(controller, "remove_message_locations")
+
+    mocked_self = mocker.Mock()
+    mocked_self.IMAP = mocked_imap
+    mocked_self.controller = controller
+    mocked_self.user_username = "recipient@example.com"
+    mocked_self._has_valid_uids = ImapProtocol._has_valid_uids.__get__(mocked_self)
+    mocked_self._get_folder_names.return_value = ["INBOX"]
+
+    result = ImapProtocol._locate_emails(mocked_self, ["<id-3>"])
+
+    # the stale UID is not used, the email is searched by its Message-ID
+    assert result == {"INBOX": [5]}
+    mocked_imap.search.assert_called_once_with(["HEADER", "Message-ID", "<id-3>"])
+    remove_locations.assert_called_once_with("recipient@example.com", "INBOX")
+
+
+def test_idle_listener_imap(mocker):
+    mocked_client = mocker.Mock()
+    mocked_client.idle_check.side_effect = [
+        [(b"OK", b"Still here")],
+        [(3, b"EXISTS")],
+    ]
+    mocked_client.idle_done.return_value = (b"Idle terminated", [])
+
+    on_change = mocker.Mock()
+    listener = ImapIdleListener(
+        "recipient@example.com", "password", "imap.example.com", "INBOX", on_change
+    )
+    on_change.side_effect = lambda email, folder: listener.stop()
+
+    listener._idle(mocked_client)
+
+    on_change.assert_called_once_with("recipient@example.com", "INBOX")
+    assert mocked_client.idle_check.call_count == 2
+    mocked_client.idle_done.assert_called_once()
+
+
+def test_idle_listener_connection_imap(mocker):
+    store = MailStore()
+    store.add_account(ACCOUNT, "password")
+    server = ImapStandIn(store).start()
+    # the stand-in has no IDLE, the folder is polled
+    mocker.patch.object(ImapIdleListener, "NOOP_INTERVAL", 0.01)
+    changed = threading.Event()
+    listener = ImapIdleListener(
+        ACCOUNT,
+        "password",
+        "127.0.0.1",
+        "INBOX",
+        lambda email, folder: changed.set(),
+        ssl=False,
+        port=server.port,
+    )
+    try:
+        listener.start()
+        assert changed.wait(5)
+    finally:
+        listener.stop()
+        listener.join(5)
+        server.stop()
+
+
+def test_push_restarted_for_password(database, mocker):
+    mocker.patch("remail.controller.keyring.set_password")
+    mocker.patch.object(controller, "push_listeners", [])
+    mocker.patch.object(controller, "_push_arguments", None)
+    listener = mocker.patch("remail.controller.ImapIdleListener")
+    mocker.patch("remail.controller.keyring.get_password", return_value="old")
+    controller.create_user("User", ACCOUNT, Protocol.IMAP, "127.0.0.1", "old")
+    # push isn't running yet
+    listener.assert_not_called()
+
+    controller.start_push(exchange=False)
+    mocker.patch("remail.controller.keyring.get_password", return_value="new")
+    controller.change_password(ACCOUNT, "new")
+
+    # the listener is started again with the new password and the pool settings
+    assert listener.call_count == 2
+    listener.return_value.stop.assert_called_once()
+    assert listener.call_args.kwargs["password"] == "new"
+    assert listener.call_args.kwargs["ssl"] == controller.pool.ssl
+    assert listener.call_args.kwargs["port"] == controller.pool.imap_port
+    controller.stop_push()
+
+
+def test_streaming_listener_exchange(mocker):
+    mocked_self = mocker.Mock()
+    mocked_self.logged_in = True
+    mocked_self._subscribed_folders = {"inbox", "archive"}
+    mocked_self.acc.inbox.get_streaming_events.return_value = [
+        Notification(events=[StatusEvent()]),
+        Notification(
+            events=[
+                NewMailEvent(parent_folder_id=ParentFolderId(id="inbox")),
+                # moved from the archive to a folder without emails
+                MovedEvent(
+                    parent_folder_id=ParentFolderId(id="calendar"),
+                    old_parent_folder_id=OldParentFolderId(id="archive"),
+                ),
+            ]
+        ),
+    ]
+
+    changed = list(ExchangeProtocol.iter_changed_folders(mocked_self, "subscription"))
+
+    assert changed == [{"inbox", "archive"}]
+    mocked_self.acc.inbox.get_streaming_events.assert_called_once_with(
+        "subscription", connection_timeout=1
+    )
+
+    protocol = mocker.Mock()
+    protocol.subscribe.return_value = "subscription"
+    protocol.iter_changed_folders.return_value = iter(changed)
+    on_change = mocker.Mock()
+    listener = ExchangeStreamingListener(
+        "recipient@example.com", lambda: protocol, on_change
+    )
+    on_change.side_effect = lambda email, folders: listener.stop()
+
+    listener._listen()
+
+    on_change.assert_called_once_with("recipient@example.com", ["archive", "inbox"])
+    protocol.login.assert_called_once()
+    protocol.unsubscribe.assert_called_once_with("subscription")
+    protocol.logout.assert_called_once()
+
+
+def test_connection_pool_imap(mocker):
+    mocked_imapclient = mocker.patch("remail.email_api.pool.IMAPClient")
+    first, second = mocker.Mock(), mocker.Mock()
+    mocked_imapclient.side_effect = [first, second]
+    pool = ConnectionPool()
+
+    # the released connection is reused without a new login
+    client = pool.acquire_imap("user@example.com", "password", "imap.example.com")
+    pool.release_imap("user@example.com", "imap.example.com", client)
+    client = pool.acquire_imap("user@example.com", "password", "imap.example.com")
+    assert client is first
+    first.login.assert_called_once_with("user@example.com", "password")
+    pool.release_imap("user@example.com", "imap.example.com", first)
+
+    # a connection that fails the health check is replaced
+    pool.HEALTH_CHECK_AFTER = 0
+    first.noop.side_effect = ConnectionResetError()
+    client = pool.acquire_imap("user@example.com", "password", "imap.example.com")
+    assert client is second
+    first.logout.assert_called_once()
+
+    # broken connections are not handed out again
+    pool.release_imap("user@example.com", "imap.example.com", second, broken=True)
+    second.logout.assert_called_once()
+    assert pool._idle[("imap", "imap.example.com", "user@example.com")] == []
+
+
+def test_connection_pool_timeout(mocker):
+    mocker.patch("remail.email_api.pool.IMAPClient")
+    pool = ConnectionPool(max_connections=1, acquire_timeout=0.1)
+
+    # all connections of the account are in use
+    pool.acquire_imap("user@example.com", "password", "imap.example.com")
+    with pytest.raises(ee.ConnectionPoolTimeout):
+        pool.acquire_imap("user@example.com", "password", "imap.example.com")
+
+
+@pytest.fixture
+def database(tmp_path, mocker):
+    """points the controller to an empty database"""
+    engine = create_engine(f"duckdb:///{tmp_path / 'database.db'}")
+    SQLModel.metadata.create_all(engine)
+    migrate(engine)
+    mocker.patch.object(controller, "engine", engine)
+    mocker.patch.object(controller, "contacts", ContactResolver(engine))
+    return engine
+
+
+def test_contact_resolver(database, mocker):
+    resolver = ContactResolver(controller.engine)
+    known = resolver.get("known@example.com", "Known")
+    load = mocker.spy(resolver, "_load")
+
+    # the new addresses are looked up and created together
+    contacts = resolver.resolve(
+        [
+            ("known@example.com", None),
+            ("new1@example.com", None),
+            ("new1@example.com", "New"),
+            ("new2@example.com", None),
+        ]
+    )
+    assert contacts["known@example.com"] == known.id
+    assert contacts["new2@example.com"] is not None
+    assert load.call_args_list == [
+        mocker.call(["new1@example.com", "new2@example.com"]),
+        mocker.call(["new1@example.com", "new2@example.com"]),
+    ]
+
+    # known contacts are taken from memory
+    assert resolver.get("new2@example.com").id == contacts["new2@example.com"]
+    assert load.call_count == 2
+    # the created contacts are stored
+    new1 = ContactResolver(controller.engine).get("new1@example.com")
+    assert (new1.id, new1.name) == (contacts["new1@example.com"], "New")
+
+
+def test_create_email_garbage_collected(database):
+    # the contacts are cached, the emails of a sync must not be kept alive by them
+    mails = []
+    for number in range(10):
+        mail = create_email(
+            f"<gc-{number}@example.com>",
+            "gc-sender@example.com",
+            "Subject",
+            "Body",
+            [Attachment(name="a.pdf")],
+            [("", "gc-recipient@example.com")],
+            [("", "gc-sender@example.com")],
+            [],
+            datetime(2024, 1, 1),
+            controller,
+        )
+        mails.append(weakref.ref(mail))
+    controller.safe_email([mail])
+    del mail
+    gc.collect()
+    assert not [ref for ref in mails if ref() is not None]
+
+
+def test_email_records(database):
+    sender = controller.get_contact("records-sender@example.com")
+    recipient = controller.get_contact("records-recipient@example.com")
+    with Session(controller.engine) as session:
+        mails = [
+            Email(
+                message_id="<records-1@example.com>",
+                sender_id=sender.id,
+                subject="Subject",
+                body="Body",
+                date=datetime(2024, 1, 1, 12),
+                urgency=None,
+                recipients=[
+                    EmailReception(contact_id=recipient.id, kind=RecipientKind.to),
+                    EmailReception(contact_id=sender.id, kind=RecipientKind.cc),
+                ],
+                attachments=[
+                    Attachment(name="a.pdf"),
+                    Attachment(name="b.txt"),
+                    # a part without a file name
+                    Attachment(part_id="3"),
+                ],
+            ),
+            Email(
+                message_id="<records-2@example.com>",
+                sender_id=recipient.id,
+                subject="Reply",
+                body="Reply body",
+                date=datetime(2024, 1, 2, 12),
+                urgency=2,
+            ),
+        ]
+        session.add_all(mails)
+        session.commit()
+        ids = [mail.id for mail in mails]
+
+    first, second = controller.iter_email_records(email_ids=ids)
+    assert first.sender == "records-sender@example.com"
+    assert first.to == ["records-recipient@example.com"]
+    assert first.cc == ["records-sender@example.com"]
+    assert first.bcc == []
+    assert sorted(first.attachments) == ["a.pdf", "b.txt"]
+    assert second.sender == "records-recipient@example.com"
+    assert (second.to, second.attachments, second.urgency) == ([], [], 2)
+
+    records = controller.iter_email_records(
+        recipient_email="records-recipient@example.com"
+    )
+    assert [record.id for record in records] == ids[:1]
+    data = controller.get_full_email_data(second)
+    assert data["date"] == "2024-01-02 12:00:00"
+    assert data["recipients"] == ""
+
+
+def test_email_records_sent_attachments(database, mocker):
+    protocol = mocker.patch.object(controller, "_create_protocol").return_value
+    sent = []
+
+    def send_email(email: Email):
+        sent.extend((att.filename, att.name) for att in email.attachments)
+        # the protocol sets the message id of the sent email
+        email.message_id = "<sent-1@example.com>"
+
+    protocol.send_email.side_effect = send_email
+    controller.get_contact("sent-sender@example.com")
+    controller.get_contact("sent-recipient@example.com")
+    controller.send_email(
+        None,
+        "sent-sender@example.com",
+        ["sent-recipient@example.com"],
+        [],
+        [],
+        "Subject",
+        "Body",
+        attachments=["outbox/report.pdf"],
+        date=datetime(2024, 1, 1, 12),
+    )
+
+    assert sent == [("outbox/report.pdf", "report.pdf")]
+    (record,) = controller.iter_email_records(sender_email="sent-sender@example.com")
+    assert record.attachments == ["report.pdf"]
+
+
+def test_safe_email(database):
+    def create_mail(read: bool = None) -> Email:
+        return create_email(
+            "<safe-1@example.com>",
+            "safe-sender@example.com",
+            "Subject",
+            "Body",
+            [Attachment(name="a.pdf", size=10)],
+            [("Recipient", "safe-recipient@example.com")],
+            [("Recipient", "safe-recipient@example.com")],
+            [],
+            timezone("Europe/Berlin").localize(datetime(2024, 1, 1, 12)),
+            controller,
+            read=read,
+        )
+
+    controller.safe_email([create_mail(), create_mail()])
+    (record,) = controller.iter_email_records(sender_email="safe-sender@example.com")
+    # the recipient is stored once, datetimes are stored in UTC
+    assert record.to == ["safe-recipient@example.com"]
+    assert record.cc == []
+    assert record.attachments == ["a.pdf"]
+    assert record.date == datetime(2024, 1, 1, 11)
+    assert record.read is None
+
+    # a stored email only gets its read state updated
+    controller.safe_email([create_mail(read=True)])
+    records = list(
+        controller.iter_email_records(sender_email="safe-sender@example.com")
+    )
+    assert [(r.id, r.read, r.attachments) for r in records] == [
+        (record.id, True, ["a.pdf"])
+    ]
+
+
+def test_store_emails(mocker):
+    safe_email = mocker.patch.object(controller, "safe_email")
+    mocker.patch.object(controller, "SAVE_BATCH_SIZE", 3)
+    saved = []
+
+    def iter_emails(flush):
+        # two pages of the server, the sync state is saved after each page
+        for page in ("abcd", "e"):
+            yield from page
+            flush()
+            saved.append(len(safe_email.call_args_list))
+
+    controller._store_emails(iter_emails)
+
+    batches = [call.args[0] for call in safe_email.call_args_list]
+    assert batches == [list("abc"), ["d"], ["e"], []]
+    # the emails of a page are stored before its sync state
+    assert saved == [2, 3]
+
+    # a failing batch is not stored again
+    safe_email.reset_mock()
+    safe_email.side_effect = [ValueError("failed"), None]
+    with pytest.raises(ValueError):
+        controller._store_emails(iter_emails)
+    assert [call.args[0] for call in safe_email.call_args_list] == [list("abc"), []]
+
+
+def test_delete_emails(database, mocker):
+    store = mocker.patch.object(controller, "attachment_store")
+    mails = [
+        create_email(
+            f"<delete-{number}@example.com>",
+            "delete-sender@example.com",
+            "Subject",
+            "Body",
+            [Attachment(name="a.pdf", sha256=f"delete-digest-{number % 2}")],
+            [("", "delete-recipient@example.com")],
+            [],
+            [],
+            datetime(2024, 1, 1),
+            controller,
+        )
+        for number in range(3)
+    ]
+    controller.safe_email(mails)
+    ids = [
+        record.id
+        for record in controller.iter_email_records(
+            sender_email="delete-sender@example.com"
+        )
+    ]
+
+    controller.delete_emails(ids[:2])
+
+    records = controller.iter_email_records(sender_email="delete-sender@example.com")
+    assert [record.id for record in records] == ids[2:]
+    with Session(controller.engine) as session:
+        for table, column in (
+            (EmailReception, EmailReception.email_id),
+            (Attachment, Attachment.email_id),
+        ):
+            assert not session.exec(select(table).where(column.in_(ids[:2]))).all()
+    # the content of the third email's attachment is still used
+    store.remove.assert_called_once_with("delete-digest-1")
+
+
+def test_delete_emails_failure(database, mocker):
+    mocker.patch.object(controller, "attachment_store")
+    mail = create_email(
+        "<failure@example.com>",
+        "failure-sender@example.com",
+        "Subject",
+        "Body",
+        [Attachment(name="a.pdf", sha256="failure-digest")],
+        [("", "failure-recipient@example.com")],
+        [],
+        [],
+        datetime(2024, 1, 1),
+        controller,
+    )
+    controller.safe_email([mail])
+    (record,) = controller.iter_email_records(sender_email="failure-sender@example.com")
+    execute = Session.exec
+    failures = []
+
+    def exec_failing(session, statement, *args, **kwargs):
+        if statement.is_delete and statement.table.name == "email" and failures:
+            raise DBAPIError("DELETE", None, failures.pop())
+        return execute(session, statement, *args, **kwargs)
+
+    mocker.patch.object(Session, "exec", exec_failing)
+
+    # the deletion of the emails is repeated
+    failures[:] = [Exception("conflict")] * (controller.DELETE_ATTEMPTS - 1)
+    controller.delete_emails([record.id])
+    assert not failures
+    assert not list(
+        controller.iter_email_records(sender_email="failure-sender@example.com")
+    )
+
+    # if it keeps failing, the email is left without recipients and attachments,
+    # until it is deleted again
+    controller.safe_email([mail])
+    (record,) = controller.iter_email_records(sender_email="failure-sender@example.com")
+    failures[:] = [Exception("conflict")] * controller.DELETE_ATTEMPTS
+    with pytest.raises(DBAPIError):
+        controller.delete_emails([record.id])
+    (left,) = controller.iter_email_records(sender_email="failure-sender@example.com")
+    assert (left.id, left.to, left.attachments) == (record.id, [], [])
+    controller.delete_emails([record.id])
+    assert not list(
+        controller.iter_email_records(sender_email="failure-sender@example.com")
+    )
+
+
+def test_hard_refresh_keeps_attachment_files(database, mocker):
+    store = mocker.patch.object(controller, "attachment_store")
+
+    def create_mail(number: int) -> Email:
+        return create_email(
+            f"<refresh-{number}@example.com>",
+            "refresh-sender@example.com",
+            "Subject",
+            "Body",
+            [Attachment(name="a.pdf", sha256=f"refresh-digest-{number}")],
+            [("", "refresh-recipient@example.com")],
+            [],
+            [],
+            datetime(2024, 1, 1),
+            controller,
+        )
+
+    controller.safe_email([create_mail(0), create_mail(1)])
+
+    def refresh(observe_last_refresh: bool):
+        # the files of the synced emails are still there
+        store.remove.assert_not_called()
+        controller.safe_email([create_mail(0)])
+
+    mocker.patch.object(controller, "refresh", side_effect=refresh)
+    controller.hard_refresh()
+
+    # only the file of the email, that wasn't synced again, is removed
+    store.remove.assert_called_once_with("refresh-digest-1")
+
+
+def test_attachment_writer(tmp_path):
+    content = bytes(range(256)) * 1000
+    path = tmp_path / "attachment"
+
+    # chunks don't end at the borders of base64 groups or lines
+    with AttachmentWriter(path, "base64") as writer:
+        for chunk in iter_chunks(base64.encodebytes(content), 1001):
+            writer.write(chunk)
+    assert path.read_bytes() == content
+    assert writer.sha256 == hashlib.sha256(content).hexdigest()
+
+    with AttachmentWriter(path, "quoted-printable") as writer:
+        for chunk in iter_chunks(quopri.encodestring(content), 333):
+            writer.write(chunk)
+    assert path.read_bytes() == content
+
+    # the file is removed as soon as the limit is exceeded
+    with pytest.raises(BufferError):
+        with AttachmentWriter(path, max_size=1000) as writer:
+            for chunk in iter_chunks(content, 600):
+                writer.write(chunk)
+    assert writer.size <= 1200
+    assert not path.exists()
+
+
+def test_attachment_store(tmp_path):
+    store = AttachmentStore(tmp_path)
+    content = b"%PDF-1.4 report" * 100
+    digest = hashlib.sha256(content).hexdigest()
+
+    path, sha256, size = store.put(base64.encodebytes(content), "base64")
+    assert (sha256, size) == (digest, len(content))
+    # the same content is only stored once, also when it is streamed
+    assert store.put(content)[0] == path
+    assert store.put(iter_chunks(content, 100))[0] == path
+    assert [file.name for file in tmp_path.rglob("*") if file.is_file()] == [digest]
+
+    store.remove(digest)
+    assert not tmp_path.joinpath(digest[:2], digest).exists()
+
+
+def test_packed_attachment_store(tmp_path):
+    engine = create_engine(f"duckdb:///{tmp_path / 'test.db'}")
+    SQLModel.metadata.create_all(engine)
+    store = PackedAttachmentStore(engine, tmp_path, segment_size=1000)
+    contents = [bytes([i]) * size for i, size in enumerate((700, 300, 500))]
+
+    digests = [store.put(content)[1] for content in contents]
+    # streamed duplicates are not kept
+    assert store.put(iter_chunks(contents[0], 100))[1] == digests[0]
+    # a new segment is started as soon as one is full
+    segments = sorted(tmp_path.joinpath("segments").iterdir())
+    assert [segment.stat().st_size for segment in segments] == [1000, 500]
+    assert [bytes(store.read(digest)) for digest in digests] == contents
+
+    # the first segment is less than half used and moved to the current one, its
+    # file is removed as soon as its memory map isn't used anymore
+    content = store.read(digests[1])
+    store.remove(digests[0])
+    assert segments[0].exists()
+    content.release()
+    store.remove(digests[0])
+    assert not segments[0].exists()
+    assert not store.contains(digests[0])
+    assert [bytes(store.read(digest)) for digest in digests[1:]] == contents[1:]
+
 
 def test_get_emails_with_mocking_exchange(mocker):
     mocked_exchange = mocker.Mock()
@@ -104,6 +1622,9 @@ def test_get_emails_with_mocking_exchange(mocker):
     mocked_self._get_email_exchange = ExchangeProtocol._get_email_exchange.__get__(
         mocked_self
     )
+    mocked_self._store_attachments = ExchangeProtocol._store_attachments.__get__(
+        mocked_self
+    )
 
     result = ExchangeProtocol.get_emails(mocked_self, date=date_filter)
     print(result)
@@ -112,3 +1633,385 @@ def test_get_emails_with_mocking_exchange(mocker):
     assert result[0].message_id == "test-id"
     assert result[0].subject == "Test Subject"
     assert result[0].body == "This is the email body.\n"
+
+
+def bind_exchange_sync_methods(mocked_self):
+    mocked_self.scheduler = ThrottlingScheduler()
+    for name in (
+        "_sync_folder",
+        "_apply_changes",
+        "_fetch_items",
+        "_fetch_batch",
+        "_get_batch_items",
+        "_store_attachments",
+        "_get_email_exchange",
+    ):
+        setattr(mocked_self, name, getattr(ExchangeProtocol, name).__get__(mocked_self))
+
+
+def create_exchange_item(item_id: str) -> Message:
+    item = Message(id=item_id, changekey=f"{item_id}-key")
+    item.message_id = f"{item_id}-message"
+    item.datetime_received = EWSDateTime.from_datetime(
+        datetime(2024, 1, 1, 1, 0, 0, tzinfo=timezone("UTC"))
+    )
+    item.text_body = "This is the email body.\n"
+    item.sender = Mailbox(email_address="sender@example.com")
+    item.subject = "Test Subject"
+    item.to_recipients = [Mailbox(email_address="recipient@example.com")]
+    return item
+
+
+def test_sync_folder_exchange(mocker):
+    item = Message(id="new-item")
+    item.message_id = "new-id"
+    item.datetime_received = EWSDateTime.from_datetime(
+        datetime(2024, 1, 1, 1, 0, 0, tzinfo=timezone("UTC"))
+    )
+    item.text_body = "This is the email body.\n"
+    item.sender = Mailbox(email_address="sender@example.com")
+    item.subject = "Test Subject"
+    item.to_recipients = [Mailbox(email_address="recipient@example.com")]
+
+    folder = mocker.Mock()
+    folder.id = "folder-id"
+    changes = [
+        ("create", item),
+        ("read_flag_change", (ItemId(id="read-item"), True)),
+        ("delete", ItemId(id="deleted-item")),
+    ]
+
+    state = FolderSyncState(
+        account="recipient@example.com", folder="folder-id", sync_state="state-1"
+    )
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=state)
+    mocker.patch.object(
+        controller,
+        "get_item_locations",
+        return_value={"read-item": "read-id", "deleted-item": "deleted-id"},
+    )
+    update_read_state = mocker.patch.object(controller, "update_read_state")
+    remove_locations = mocker.patch.object(controller, "remove_item_locations")
+    add_locations = mocker.patch.object(controller, "add_item_locations")
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+    mocker.patch.object(
+        controller,
+        "get_locations_of_messages",
+        return_value=[("folder-id", None, "read-id")],
+    )
+
+    mocked_self = mocker.Mock()
+    mocked_self.logged_in = True
+    mocked_self.email = "recipient@example.com"
+    mocked_self.controller = controller
+    mocked_self.fetch_workers = 1
+    mocked_self._get_email_folders.return_value = [folder]
+    mocked_self._sync_page.return_value = (changes, "state-2", True)
+    bind_exchange_sync_methods(mocked_self)
+
+    result = list(
+        ExchangeProtocol.iter_emails(
+            mocked_self, datetime(2024, 1, 2, tzinfo=timezone("UTC"))
+        )
+    )
+
+    # with sync state, all created items are returned regardless of the date
+    assert [email.message_id for email in result] == ["new-id"]
+    mocked_self._sync_page.assert_called_once_with(
+        folder, "state-1", EXCHANGE_EMAIL_FIELDS
+    )
+    update_read_state.assert_any_call(["read-id"], True)
+    remove_locations.assert_called_once_with(
+        "recipient@example.com", "folder-id", ["deleted-item"]
+    )
+    add_locations.assert_called_once_with(
+        "recipient@example.com", "folder-id", {"new-item": "new-id"}
+    )
+    update_state.assert_called_once_with(
+        "recipient@example.com", "folder-id", sync_state="state-2"
+    )
+    assert ExchangeProtocol.get_deleted_emails(
+        mocked_self, ["read-id", "deleted-id"]
+    ) == ["deleted-id"]
+
+
+def test_get_deleted_emails_projection_exchange(mocker):
+    folder_collection = mocker.patch(
+        "remail.email_api.service.FolderCollection"
+    ).return_value
+    queryset = folder_collection.all.return_value.only.return_value
+    item = Message()
+    item.message_id = "server-id"
+    queryset.__iter__ = mocker.Mock(return_value=iter([item]))
+
+    mocked_self = mocker.Mock()
+    mocked_self.logged_in = True
+    mocked_self._synced = False
+    mocked_self.scheduler = ThrottlingScheduler()
+    mocked_self._get_items = ExchangeProtocol._get_items.__get__(mocked_self)
+
+    result = ExchangeProtocol.get_deleted_emails(mocked_self, ["server-id", "gone-id"])
+
+    assert result == ["gone-id"]
+    # only the message ids are requested, with large pages
+    folder_collection.all.return_value.only.assert_called_once_with("message_id")
+    assert queryset.page_size == EXCHANGE_ID_PAGE_SIZE
+
+
+def test_folder_cache_exchange(mocker):
+    account = mocker.Mock()
+    connect = mocker.Mock(return_value=account)
+    folder = mocker.Mock()
+    folder.account = account
+    load = mocker.Mock(return_value=[folder])
+    cache = ExchangeFolderCache()
+
+    assert cache.get_account("a@example.com", "a", "pw", connect) is account
+    assert cache.get_account("a@example.com", "a", "pw", connect) is account
+    connect.assert_called_once()
+    assert cache.get_folders("a@example.com", account, load) == [folder]
+    assert cache.get_folders("a@example.com", account, load) == [folder]
+    load.assert_called_once_with(account)
+
+    # the folders are loaded again after the ttl and with a new password
+    cache.ttl = 0
+    cache.get_folders("a@example.com", account, load)
+    account.root.clear_cache.assert_called_once()
+    assert load.call_count == 2
+    cache.ttl = ExchangeFolderCache.TTL
+    cache.get_account("a@example.com", "a", "new", connect)
+    assert connect.call_count == 2
+    cache.get_folders("a@example.com", account, load)
+    assert load.call_count == 3
+
+
+def test_sync_folder_two_phase_exchange(mocker):
+    items = [create_exchange_item(f"item-{number}") for number in range(3)]
+    folder = mocker.Mock()
+    folder.id = "folder-id"
+    # the first phase only returns ids and a few fields
+    changes = [
+        (
+            "create",
+            Message(id=item.id, changekey=item.changekey, message_id=item.message_id),
+        )
+        for item in items
+    ]
+
+    mocker.patch.object(controller, "get_folder_sync_state", return_value=None)
+    mocker.patch.object(controller, "remove_item_locations")
+    mocker.patch.object(controller, "update_read_state")
+    add_locations = mocker.patch.object(controller, "add_item_locations")
+    update_state = mocker.patch.object(controller, "update_folder_sync_state")
+
+    mocked_self = mocker.Mock()
+    mocked_self.logged_in = True
+    mocked_self.email = "recipient@example.com"
+    mocked_self.controller = controller
+    mocked_self.fetch_workers = 2
+    mocked_self.fetch_batch_size = 1
+    mocked_self._get_email_folders.return_value = [folder]
+    # two pages, the third item is deleted again on the second page
+    mocked_self._sync_page.side_effect = [
+        (changes[:2], "state-1", False),
+        (changes[2:] + [("delete", ItemId(id="item-2"))], "state-2", True),
+    ]
+    by_id = {item.id: item for item in items}
+    mocked_self.acc.fetch.side_effect = lambda ids, only_fields: [
+        by_id[item_id] for item_id, _ in ids
+    ]
+    bind_exchange_sync_methods(mocked_self)
+    flushed = []
+
+    result = list(
+        ExchangeProtocol.iter_emails(
+            mocked_self, flush=lambda: flushed.append(update_state.call_count)
+        )
+    )
+
+    assert [email.message_id for email in result] == [
+        "item-0-message",
+        "item-1-message",
+    ]
+    # the emails of a page are stored before its sync state
+    assert flushed == [0, 1]
+    mocked_self._sync_page.assert_any_call(folder, None, EXCHANGE_SYNC_FIELDS)
+    # the sync state is stored after every page
+    mocked_self._sync_page.assert_called_with(folder, "state-1", EXCHANGE_SYNC_FIELDS)
+    assert [call.kwargs["sync_state"] for call in update_state.call_args_list] == [
+        "state-1",
+        "state-2",
+    ]
+    # one GetItem request per batch, the deleted item is not downloaded
+    assert mocked_self.acc.fetch.call_count == 2
+    mocked_self.acc.fetch.assert_any_call(
+        ids=[("item-0", "item-0-key")], only_fields=EXCHANGE_EMAIL_FIELDS
+    )
+    add_locations.assert_called_once_with(
+        "recipient@example.com",
+        "folder-id",
+        {"item-0": "item-0-message", "item-1": "item-1-message"},
+    )
+
+
+def test_fetch_items_server_busy_exchange(mocker):
+    items = [create_exchange_item(f"item-{number}") for number in range(2)]
+    busy = exch_errors.ErrorServerBusy("busy", back_off=0.01)
+    mocked_self = mocker.Mock()
+    mocked_self.fetch_workers = 2
+    mocked_self.fetch_batch_size = 2
+    # the server is busy after it returned the first item
+    mocked_self.acc.fetch.side_effect = [[items[0], busy], items]
+    bind_exchange_sync_methods(mocked_self)
+    store_attachments = mocker.patch.object(
+        mocked_self, "_store_attachments", return_value=[]
+    )
+
+    ids = [(item.id, item.changekey) for item in items]
+    result = list(ExchangeProtocol._fetch_items(mocked_self, ids))
+
+    assert [item for item, _ in result] == items
+    # the attachments are only stored for the complete response
+    assert store_attachments.call_args_list == [mocker.call(item) for item in items]
+
+    # errors of the worker threads are translated
+    store_attachments.side_effect = OSError("disk full")
+    with pytest.raises(ee.UnknownError):
+        list(ExchangeProtocol._fetch_items(mocked_self, ids))
+
+
+SYNC_FOLDER_ITEMS_RESPONSE = b"""<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+<s:Body>
+<m:SyncFolderItemsResponse
+    xmlns:m="http://schemas.microsoft.com/exchange/services/2006/messages"
+    xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types">
+<m:ResponseMessages>
+<m:SyncFolderItemsResponseMessage ResponseClass="Success">
+<m:ResponseCode>NoError</m:ResponseCode>
+<m:SyncState>state-2</m:SyncState>
+<m:IncludesLastItemInRange>false</m:IncludesLastItemInRange>
+<m:Changes>
+<t:Create><t:Message><t:ItemId Id="item-1" ChangeKey="key-1"/></t:Message></t:Create>
+<t:ReadFlagChange>
+<t:ItemId Id="item-2" ChangeKey="key-2"/><t:IsRead>true</t:IsRead>
+</t:ReadFlagChange>
+<t:Delete><t:ItemId Id="item-3" ChangeKey="key-3"/></t:Delete>
+</m:Changes>
+</m:SyncFolderItemsResponseMessage>
+</m:ResponseMessages>
+</m:SyncFolderItemsResponse>
+</s:Body>
+</s:Envelope>"""
+
+
+def test_sync_page_exchange(mocker):
+    # _sync_page uses the SyncFolderItems service of exchangelib directly, only the
+    # HTTP request is replaced
+    post = mocker.patch.object(
+        EWSService,
+        "_get_response",
+        return_value=DummyResponse(content=SYNC_FOLDER_ITEMS_RESPONSE, status_code=200),
+    )
+    config = Configuration(
+        service_endpoint="https://127.0.0.1/EWS/Exchange.asmx",
+        credentials=Credentials("user", "password"),
+        version=Version(Build(15, 1)),
+    )
+    mocked_self = mocker.Mock()
+    mocked_self.acc = Account(
+        "user@example.com", config=config, autodiscover=False, access_type=DELEGATE
+    )
+    root = Root(account=mocked_self.acc, id="root-id", changekey="root-key")
+    folder = Inbox(root=root, id="folder-id", changekey="folder-key")
+
+    changes, sync_state, last = ExchangeProtocol._sync_page(
+        mocked_self, folder, "state-1", EXCHANGE_SYNC_FIELDS
+    )
+
+    assert [(change_type, type(item)) for change_type, item in changes] == [
+        ("create", Message),
+        ("read_flag_change", tuple),
+        ("delete", ItemId),
+    ]
+    assert changes[0][1].id == "item-1"
+    assert changes[1][1] == (ItemId(id="item-2", changekey="key-2"), True)
+    assert (sync_state, last) == ("state-2", False)
+    request = xml_to_str(post.call_args.kwargs["payload"])
+    assert "<m:SyncState>state-1</m:SyncState>" in request
+    assert f"<m:MaxChangesReturned>{EXCHANGE_SYNC_PAGE_SIZE}<" in request
+    assert "message:InternetMessageId" in request
+
+
+def test_exchange_scheduler_per_account(mocker):
+    mocker.patch("remail.controller.keyring.get_password", return_value="password")
+
+    def create_protocol(email: str) -> ExchangeProtocol:
+        return controller._create_protocol(
+            User(
+                name="User",
+                email=email,
+                protocol=Protocol.EXCHANGE,
+                extra_information="user",
+            )
+        )
+
+    first = create_protocol("scheduler-a@example.com")
+    # the requests of all protocol objects of an account are throttled together
+    assert create_protocol("scheduler-a@example.com").scheduler is first.scheduler
+    assert create_protocol("scheduler-b@example.com").scheduler is not first.scheduler
+    assert first.scheduler.max_concurrency == controller.exchange_fetch_workers
+
+
+def test_throttling_scheduler(mocker):
+    sleep = mocker.patch("threading.Condition.wait")
+    busy = exch_errors.ErrorServerBusy("busy", back_off=0.01)
+    request = mocker.Mock(side_effect=[busy, busy, "result"])
+    scheduler = ThrottlingScheduler(max_concurrency=4, max_wait=1)
+
+    # the request is repeated, the concurrency is halved on every back off
+    # (4 -> 2 -> 1) and increased after the successful request
+    assert scheduler.call(request, 1) == "result"
+    assert request.call_count == 3
+    assert scheduler.limit == 2
+    assert sleep.called
+    # after successful requests, more concurrent requests are allowed again
+    for _ in range(3):
+        scheduler.call(lambda: None)
+    assert scheduler.limit == 3
+
+    scheduler.max_wait = 0
+    with pytest.raises(ee.ServerBusy):
+        scheduler.call(mocker.Mock(side_effect=busy))
+
+
+def test_mark_and_delete_emails_exchange(mocker):
+    folder_collection = mocker.patch(
+        "remail.email_api.service.FolderCollection"
+    ).return_value
+    items = [create_exchange_item(f"item-{number}") for number in range(3)]
+    folder_collection.filter.return_value.only.return_value = items
+
+    mocked_self = mocker.Mock()
+    mocked_self.logged_in = True
+    mocked_self.acc.bulk_update.return_value = [True] * 3
+    mocked_self.acc.bulk_delete.return_value = [True] * 3
+    mocked_self.scheduler = ThrottlingScheduler()
+    mocked_self._bulk_request = ExchangeProtocol._bulk_request
+    for name in ("_find_items", "_get_items"):
+        setattr(mocked_self, name, getattr(ExchangeProtocol, name).__get__(mocked_self))
+    message_ids = [item.message_id for item in items]
+
+    ExchangeProtocol.mark_emails(mocked_self, message_ids, True)
+    ExchangeProtocol.delete_emails(mocked_self, message_ids)
+
+    # one search and one bulk request for all messages
+    assert folder_collection.filter.call_count == 2
+    folder_collection.filter.assert_called_with(message_id__in=message_ids)
+    assert all(item.is_read for item in items)
+    mocked_self.acc.bulk_update.assert_called_once_with(
+        items=[(item, ["is_read"]) for item in items]
+    )
+    mocked_self.acc.bulk_delete.assert_called_once_with(
+        ids=items, delete_type=MOVE_TO_DELETED_ITEMS
+    )
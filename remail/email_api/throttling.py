@@ -0,0 +1,86 @@
+from collections.abc import Callable
+import threading
+import time
+from exchangelib import errors as exch_errors
+import remail.email_api.email_errors as ee
+
+
+class ThrottlingScheduler:
+    """Runs the requests to a throttled server (EWS) with an adaptive number of
+    concurrent requests.
+
+    If the server is busy (ErrorServerBusy), no request is started until the
+    requested back off has passed, the number of concurrent requests is halved and
+    the request is repeated. After as many successful requests in a row as are
+    currently allowed at the same time, one more concurrent request is allowed
+    (additive increase, multiplicative decrease)."""
+
+    MAX_WAIT = 15 * 60
+    """seconds a request waits for the server at most, before ServerBusy is raised"""
+    DEFAULT_BACK_OFF = 5
+    """seconds to wait, if the server doesn't say how long"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        min_concurrency: int = 1,
+        max_wait: float = MAX_WAIT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_wait = max_wait
+        self.limit = max_concurrency
+        """number of requests, that may run at the same time"""
+        self._active = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._condition = threading.Condition()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """calls func, once a request may be started, and repeats it as long as the
+        server is busy. Raises ServerBusy after max_wait seconds of waiting"""
+        waited = 0.0
+        while True:
+            self._acquire()
+            try:
+                result = func(*args, **kwargs)
+            except exch_errors.ErrorServerBusy as e:
+                back_off = self._throttled(e.back_off)
+                waited += back_off
+                if waited > self.max_wait:
+                    raise ee.ServerBusy(back_off) from e
+                continue
+            finally:
+                self._release()
+            self._succeeded()
+            return result
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                delay = self._resume_at - time.monotonic()
+                if delay <= 0 and self._active < self.limit:
+                    break
+                self._condition.wait(delay if delay > 0 else None)
+            self._active += 1
+
+    def _release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def _throttled(self, back_off: float = None) -> float:
+        back_off = back_off or self.DEFAULT_BACK_OFF
+        with self._condition:
+            self._resume_at = max(self._resume_at, time.monotonic() + back_off)
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            self._successes = 0
+        return back_off
+
+    def _succeeded(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
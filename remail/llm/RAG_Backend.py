@@ -200,13 +200,10 @@ class LLM(object):
 #---------------------------------------------
     def _db_to_nodes(self):
         """"Converts all Emails to Documents to embed into Vector DB"""
-        emails = controller.controller.get_emails()
         docstore = []
 
-        for mail in emails:
-            # Use get_full_email_data to retrieve all email-related data
-            email_data = controller.controller.get_full_email_data(mail)
-
+        # all email-related data is retrieved with one query
+        for email_data in controller.controller.iter_full_email_data():
             # Define document using the data retrieved
             doc = Document(
                 text=email_data["body"],